@@ -1,1435 +1,4396 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Blueprint
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, current_user, login_user, logout_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
-import random
-import json
-import os
-import copy
-import mercadopago
-from datetime import datetime, timedelta
-import hashlib
-import hmac
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import requests
-from dotenv import load_dotenv
-
-# Cargar variables de entorno
-if os.path.exists('.env'):
-    load_dotenv()
-
-# ==============================
-# APP
-# ==============================
-app = Flask(__name__)
-basedir = os.path.abspath(os.path.dirname(__file__))
-
-# ==============================
-# CONFIGURACIÓN
-# ==============================
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'fallback-key-change-in-production')
-
-# DEBUG: Ver si la SECRET_KEY se cargó
-print(f"🔍 SECRET_KEY detectada: {app.config['SECRET_KEY'][:20]}..." if app.config['SECRET_KEY'] else "❌ SECRET_KEY NO DETECTADA")
-print(f"🔍 Variables de entorno disponibles: {list(os.environ.keys())[:10]}")
-
-# DEBUG: Ver qué base de datos se va a usar
-database_url = os.getenv('DATABASE_URL', 'sqlite:///instance/users.db')
-
-# Fix: PostgreSQL URL debe usar postgresql+psycopg en vez de postgresql
-if database_url and database_url.startswith('postgresql://'):
-    database_url = database_url.replace('postgresql://', 'postgresql+psycopg://')
-    print(f"🔍 DATABASE_URL convertida a: {database_url[:50]}...")
-else:
-    print(f"🔍 DATABASE_URL encontrada: {database_url[:50] if database_url else 'NO ENCONTRADA'}")
-
-# Usar PostgreSQL si DATABASE_URL existe, sino SQLite local
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# ==============================
-# SPOTIFY CONFIGURATION CON OAUTH
-# ==============================
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-
-SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
-SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
-SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "https://www.progressivejourney.net/spotify/callback")
-
-# ==============================
-# YOUTUBE API CONFIGURATION
-# ==============================
-YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", "")  # Agregar tu API key aquí
-
-# Cache de tokens por usuario
-spotify_tokens = {}
-
-def get_spotify_client(user_id):
-    """Obtiene un cliente de Spotify autenticado para el usuario."""
-    cache_path = f".spotify_cache_{user_id}"
-    
-    auth_manager = SpotifyOAuth(
-        client_id=SPOTIFY_CLIENT_ID,
-        client_secret=SPOTIFY_CLIENT_SECRET,
-        redirect_uri=SPOTIFY_REDIRECT_URI,
-        scope="user-read-private",
-        cache_path=cache_path,
-        show_dialog=False
-    )
-    
-    return spotipy.Spotify(auth_manager=auth_manager)
-
-# ==============================
-# SPOTIFY CLIENT CREDENTIALS (SIN OAUTH)
-# ==============================
-def get_spotify_token_public():
-    """Obtiene token público de Spotify (Client Credentials)."""
-    try:
-        auth_response = requests.post('https://accounts.spotify.com/api/token', {
-            'grant_type': 'client_credentials',
-            'client_id': SPOTIFY_CLIENT_ID,
-            'client_secret': SPOTIFY_CLIENT_SECRET,
-        })
-        
-        if auth_response.status_code == 200:
-            return auth_response.json()['access_token']
-        return None
-    except Exception as e:
-        print(f"Error getting Spotify token: {e}")
-        return None
-
-def search_spotify_id(artist, track):
-    """Busca el Spotify ID de un track (sin OAuth)."""
-    try:
-        token = get_spotify_token_public()
-        if not token:
-            return None
-        
-        headers = {'Authorization': f'Bearer {token}'}
-        search_url = 'https://api.spotify.com/v1/search'
-        
-        params = {
-            'q': f'artist:{artist} track:{track}',
-            'type': 'track',
-            'limit': 1
-        }
-        
-        response = requests.get(search_url, headers=headers, params=params)
-        
-        if response.status_code == 200:
-            results = response.json()
-            if results['tracks']['items']:
-                return results['tracks']['items'][0]['id']
-        
-        return None
-        
-    except Exception as e:
-        print(f"Error searching Spotify ID: {e}")
-        return None
-
-# ==============================
-# YOUTUBE SEARCH
-# ==============================
-def search_youtube_id(artist, track):
-    """Busca el YouTube ID de un track."""
-    if not YOUTUBE_API_KEY:
-        print("⚠️ YouTube API Key no configurada")
-        return None
-    
-    print(f"✅ YouTube API Key encontrada: {YOUTUBE_API_KEY[:20]}...")  # ← AGREGAR
-    
-    try:
-        from googleapiclient.discovery import build
-        
-        print("✅ googleapiclient importado correctamente")  # ← AGREGAR
-        
-        youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
-        
-        print("✅ Cliente de YouTube creado")  # ← AGREGAR
-        
-        search_query = f"{artist} {track} progressive house"
-        
-        print(f"🔍 Buscando en YouTube: {search_query}")
-        
-        request = youtube.search().list(
-            part="snippet",
-            q=search_query,
-            type="video",
-            maxResults=1,
-            videoCategoryId="10"
-        )
-        
-        print("✅ Request creado, ejecutando...")  # ← AGREGAR
-        
-        response = request.execute()
-        
-        print(f"✅ Response recibida: {response}")  # ← AGREGAR
-        
-        if response['items']:
-            video_id = response['items'][0]['id']['videoId']
-            print(f"✅ YouTube ID encontrado: {video_id}")
-            return video_id
-        else:
-            print(f"⚠️ No se encontró en YouTube")
-        
-        return None
-        
-    except Exception as e:
-        print(f"❌ Error searching YouTube: {e}")
-        import traceback
-        traceback.print_exc()  # ← AGREGAR (muestra error completo)
-        return None
-
-# ==============================
-# DATABASE
-# ==============================
-db = SQLAlchemy(app)
-
-# ==============================
-# LOGIN
-# ==============================
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# ==============================
-# MODELOS (ANTES DE db.create_all())
-# ==============================
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(256), nullable=False)
-    role = db.Column(db.String(20), default='trial') 
-    trial_uses_left = db.Column(db.Integer, default=2)
-    pro_until = db.Column(db.DateTime, nullable=True)
-    plan = db.Column(db.String(10))
-    last_payment_id = db.Column(db.String(100))
-
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
-
-    def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-
-class SharedSet(db.Model):
-    id = db.Column(db.String(10), primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
-    setlist_json = db.Column(db.Text, nullable=False)
-    duration_hours = db.Column(db.Integer, default=1)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    views = db.Column(db.Integer, default=0)
-    
-    def __repr__(self):
-        return f'<SharedSet {self.id}>'
-
-class PaymentRequest(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    plan = db.Column(db.String(20), nullable=False)  # 'monthly' o 'annual'
-    amount_usdt = db.Column(db.Float, nullable=False)
-    tx_id = db.Column(db.String(200), nullable=True)
-    screenshot_data = db.Column(db.Text, nullable=True)  # Base64 de la imagen
-    status = db.Column(db.String(20), default='pending')  # pending, approved, rejected
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    processed_at = db.Column(db.DateTime, nullable=True)
-    
-    user = db.relationship('User', backref='payment_requests')
-    
-    def __repr__(self):
-        return f'<PaymentRequest {self.id} - {self.user.email} - {self.plan}>'
-
-# ==============================
-# INICIALIZAR DB (DESPUÉS DE DEFINIR MODELOS)
-# ==============================
-with app.app_context():
-    db.create_all()
-    print("✅ Base de datos inicializada correctamente")
-    print("📍 Ubicación:", db.engine.url)
-    
-    # 👇 AGREGAR ESTO ACÁ
-    owner_email = os.getenv('OWNER_EMAIL', 'elidj269@gmail.com')
-    owner_password = os.getenv('OWNER_PASSWORD', 'password_default')
-    
-    existing_owner = User.query.filter_by(email=owner_email).first()
-    
-    if not existing_owner:
-        owner = User(email=owner_email, role='owner')
-        owner.set_password(owner_password)
-        owner.pro_until = datetime.utcnow() + timedelta(days=3650)
-        owner.plan = 'lifetime'
-        db.session.add(owner)
-        db.session.commit()
-        print(f"✅ Usuario owner {owner_email} creado")
-    else:
-        print(f"✅ Usuario owner ya existe")
-        
-@login_manager.user_loader
-def load_user(user_id):
-    return db.session.get(User, int(user_id))
-
-def check_pro(user):
-    if user.role == 'owner' and user.pro_until:
-        if datetime.utcnow() > user.pro_until:
-            user.role = 'trial'
-            db.session.commit()
-            return False
-    return user.role == 'owner'
-
-# ==============================
-# MERCADOPAGO
-# ==============================
-MP_ACCESS_TOKEN = os.getenv("MP_ACCESS_TOKEN")
-if not MP_ACCESS_TOKEN:
-    print("⚠️ ADVERTENCIA: MP_ACCESS_TOKEN no configurado. Los pagos no funcionarán.")
-else:
-    sdk = mercadopago.SDK(MP_ACCESS_TOKEN)
-
-CATTANEO_STATE = {
-    "rep_count": 0, 
-    "last_phase": "",
-    "tracks_since_fifth": 0,
-    "fifth_count": 0,
-    "last_two_keys": [],
-    "switch_pair": None,
-    "switch_pair_count": 0
-}
-
-CATEGORY_MAP = {
-    "warm-up": "warmup",
-    "building": "build",
-    "mid-peak": ["mid_peak", "midpeaks"],
-    "peak time": "peaktime",
-    "driving": "driving",
-    "closing": "closing"
-}
-
-ENERGY_RANGES_PRO = {
-    "warmup": {
-        "bpm": (115, 120), 
-        "keys": ["1A","2A","3A","4A","5A","6A","7A","8A","12A"],
-        "energy": (1, 4)
-    },
-    "build": {
-        "bpm": (118, 122), 
-        "keys": ["5A","6A","7A","8A","9A","10A","11A","12A","7B","8B","9B"],
-        "energy": (4, 6)
-    },
-    "mid_peak": {
-        "bpm": (121, 123), 
-        "keys": ["8A","9A","10A","11A","12A","1A","2A","8B","9B","10B","11B","12B","1B"],
-        "energy": (6, 8)
-    },
-    "peak_time": {
-        "bpm": (123, 125), 
-        "keys": ["11A","12A","1A","2A","3A","11B","12B","1B","2B","3B"],
-        "energy": (7, 9)
-    },
-    "driving": {
-        "bpm": (124, 126), 
-        "keys": ["12B","1B","2B","3B","4B","12A","1A","2A","3A"],
-        "energy": (8, 10)
-    },
-    "closing": {
-        "bpm": (120, 124), 
-        "keys": ["10B", "11B", "12B", "1B", "2B", "3B", "7A", "8B", "9B"],
-        "energy": (4, 7),
-        "bpm_step_max": 4
-    }
-}
-
-MUSICAL_TO_CAMELOT = {
-    "C Minor": "5A", "G Minor": "6A", "D Minor": "7A", "A Minor": "8A",
-    "E Minor": "9A", "B Minor": "10A", "F# Minor": "11A", "Gb Minor": "11A",
-    "C# Minor": "12A", "Db Minor": "12A", "Ab Minor": "1A", "G# Minor": "1A",
-    "Eb Minor": "2A", "D# Minor": "2A", "Bb Minor": "3A", "A# Minor": "3A",
-    "F Minor": "4A", "C Major": "8B", "G Major": "9B", "D Major": "10B", 
-    "A Major": "11B", "E Major": "12B", "B Major": "1B", "F# Major": "2B", 
-    "Gb Major": "2B", "Db Major": "3B", "C# Major": "3B", "Ab Major": "4B", 
-    "G# Major": "4B", "Eb Major": "5B", "D# Major": "5B", "Bb Major": "6B", 
-    "A# Major": "6B", "F Major": "7B"
-}
-
-PHASE_VARIANTS = {
-    1: [
-        ["warmup"]*2 + ["build"]*3 + ["mid_peak"]*5 + ["peak_time"]*1 + ["closing"]*1,
-        ["warmup"]*3 + ["build"]*3 + ["mid_peak"]*5 + ["peak_time"]*1 + ["closing"]*1,
-        ["warmup"]*2 + ["build"]*4 + ["mid_peak"]*4 + ["peak_time"]*1 + ["closing"]*1,
-        ["warmup"]*3 + ["build"]*4 + ["mid_peak"]*4 + ["peak_time"]*1 + ["closing"]*1,
-    ],
-    2: [
-        ["warmup"]*4 + ["build"]*5 + ["mid_peak"]*7 + ["peak_time"]*3 + ["driving"]*2 + ["closing"]*1,
-        ["warmup"]*5 + ["build"]*5 + ["mid_peak"]*6 + ["peak_time"]*3 + ["driving"]*2 + ["closing"]*1,
-        ["warmup"]*4 + ["build"]*6 + ["mid_peak"]*6 + ["peak_time"]*3 + ["driving"]*2 + ["closing"]*1,
-        ["warmup"]*5 + ["build"]*4 + ["mid_peak"]*7 + ["peak_time"]*3 + ["driving"]*2 + ["closing"]*1,
-    ],
-    3: [
-        ["warmup"]*6 + ["build"]*7 + ["mid_peak"]*8 + ["peak_time"]*4 + ["driving"]*2 + ["closing"]*1,
-        ["warmup"]*7 + ["build"]*7 + ["mid_peak"]*7 + ["peak_time"]*4 + ["driving"]*2 + ["closing"]*1,
-        ["warmup"]*6 + ["build"]*8 + ["mid_peak"]*7 + ["peak_time"]*4 + ["driving"]*2 + ["closing"]*1,
-        ["warmup"]*6 + ["build"]*6 + ["mid_peak"]*9 + ["peak_time"]*4 + ["driving"]*2 + ["closing"]*1,
-    ],
-    4: [
-        ["warmup"]*8 + ["build"]*9 + ["mid_peak"]*9 + ["peak_time"]*6 + ["driving"]*3 + ["closing"]*2,
-        ["warmup"]*7 + ["build"]*7 + ["mid_peak"]*9 + ["peak_time"]*6 + ["driving"]*3 + ["closing"]*2,
-        ["warmup"]*6 + ["build"]*9 + ["mid_peak"]*10 + ["peak_time"]*5 + ["driving"]*3 + ["closing"]*2,
-        ["warmup"]*8 + ["build"]*8 + ["mid_peak"]*10 + ["peak_time"]*5 + ["driving"]*3 + ["closing"]*2,
-    ],
-    5: [
-        ["warmup"]*9 + ["build"]*10 + ["mid_peak"]*11 + ["peak_time"]*6 + ["driving"]*5 + ["closing"]*3,
-        ["warmup"]*8 + ["build"]*11 + ["mid_peak"]*11 + ["peak_time"]*6 + ["driving"]*5 + ["closing"]*3,
-        ["warmup"]*8 + ["build"]*10 + ["mid_peak"]*12 + ["peak_time"]*6 + ["driving"]*5 + ["closing"]*3,
-        ["warmup"]*10 + ["build"]*10 + ["mid_peak"]*10 + ["peak_time"]*6 + ["driving"]*5 + ["closing"]*3,
-    ]
-}
-
-def normalize_key(key_str):
-    if not key_str: return key_str
-    key_str = key_str.strip()
-    if len(key_str) >= 2 and key_str[:-1].isdigit() and key_str[-1] in ["A","B"]: return key_str
-    return MUSICAL_TO_CAMELOT.get(key_str, key_str)
-
-tracks_cache = []
-def load_tracks():
-    global tracks_cache
-    if tracks_cache: return tracks_cache
-    path = os.path.join("data", "tracks.json")
-    if not os.path.exists(path): return []
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        tracks_cache = data if isinstance(data, list) else data.get("tracks", [])
-    for t in tracks_cache: t["key"] = normalize_key(t.get("key"))
-    return tracks_cache
-
-def save_tracks(tracks):
-    """Guarda los tracks actualizados en el JSON."""
-    path = os.path.join("data", "tracks.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(tracks, f, ensure_ascii=False, indent=2)
-    
-    # Actualizar cache
-    global tracks_cache
-    tracks_cache = tracks
-
-def is_track_valid_for_phase(track, phase, attempt=1):
-    config = ENERGY_RANGES_PRO.get(phase)
-    if not config: return True
-    try:
-        bpm = float(track.get("bpm", 0))
-        key_val = track.get("key", "")
-        energy = int(track.get("energy", 5))
-    except: 
-        return False
-    
-    min_bpm, max_bpm = config["bpm"]
-    min_energy, max_energy = config["energy"]
-    
-    margin = 2 if attempt > 1 else 0
-    energy_margin = 1 if attempt > 1 else 0
-    
-    bpm_ok = (min_bpm - margin) <= bpm <= (max_bpm + margin)
-    key_ok = key_val in config["keys"]
-    energy_ok = (min_energy - energy_margin) <= energy <= (max_energy + energy_margin)
-    
-    return bpm_ok and key_ok and energy_ok
-
-def camelot_relation(prev_key, curr_key):
-    try:
-        n1, l1 = int(prev_key[:-1]), prev_key[-1]
-        n2, l2 = int(curr_key[:-1]), curr_key[-1]
-        if n1 == n2 and l1 == l2: return "same"
-        if n1 == n2 and l1 != l2: return "switch"
-        if l1 == l2:
-            if (n1 % 12) + 1 == n2: return "up"
-            if (n1 - 2) % 12 + 1 == n2: return "down"
-            if (n1 + 4) % 12 + 1 == n2 or (n1 - 6) % 12 + 1 == n2: return "fifth"
-        return "invalid"
-    except: return "invalid"
-
-def get_max_fifths_allowed(duration_hours):
-    if duration_hours <= 1:
-        return 1
-    elif duration_hours == 2:
-        return 2
-    else:
-        return min(4, 3 + (duration_hours - 3))
-
-def check_repetition_pattern(current_key, last_two_keys):
-    if len(last_two_keys) < 2:
-        return True
-    if last_two_keys[0] == last_two_keys[1] == current_key:
-        return False
-    return True
-
-def get_key_pair(key1, key2):
-    num1, mode1 = int(key1[:-1]), key1[-1]
-    num2, mode2 = int(key2[:-1]), key2[-1]
-    if num1 == num2 and mode1 != mode2:
-        return f"{num1}A-{num1}B"
-    return None
-
-def find_compatible_track(prev_track, target_energy, used_tracks_names, duration_hours=1, recent_keys=None):
-    """Encuentra el mejor track compatible con VARIEDAD FORZADA."""
-    global CATTANEO_STATE
-    all_tracks = load_tracks()
-    
-    if recent_keys is None:
-        recent_keys = []
-    
-    # Filtrar candidatos válidos
-    candidates = [t for t in all_tracks if t["track"] not in used_tracks_names and is_track_valid_for_phase(t, target_energy)]
-    if not candidates:
-        candidates = [t for t in all_tracks if t["track"] not in used_tracks_names and is_track_valid_for_phase(t, target_energy, attempt=2)]
-    if not candidates:
-        return None
-    
-    # Si no hay track previo, elegir uno al azar
-    if not prev_track:
-        chosen = random.choice(candidates).copy()
-        chosen["stage"] = target_energy
-        return chosen
-    
-    prev_key = prev_track.get("key", "7A")
-    prev_mode = prev_key[-1]
-    
-    max_fifths = get_max_fifths_allowed(duration_hours)
-
-    if CATTANEO_STATE["last_phase"] != target_energy:
-        CATTANEO_STATE["rep_count"] = 0
-        CATTANEO_STATE["last_phase"] = target_energy
-
-    # 🔥 PENALIZACIÓN POR KEYS RECIENTES (últimas 5)
-    recent_keys_set = set(recent_keys[-5:]) if len(recent_keys) > 0 else set()
-    
-    scored = []
-    
-    for t in candidates:
-        rel = camelot_relation(prev_key, t["key"])
-        if rel == "invalid":
-            continue
-        
-        current_key = t["key"]
-        
-        if not check_repetition_pattern(current_key, CATTANEO_STATE["last_two_keys"]):
-            continue
-        
-        current_pair = get_key_pair(prev_key, current_key)
-        if rel == "switch" and current_pair:
-            if CATTANEO_STATE["switch_pair"] == current_pair:
-                if CATTANEO_STATE["switch_pair_count"] >= 2:
-                    continue
-        
-        score = random.uniform(20, 40)
-
-        # 🔥 PENALIZACIÓN FUERTE SI LA KEY YA SE USÓ RECIENTEMENTE
-        if current_key in recent_keys_set:
-            score -= 500
-        
-        # 🔥 PENALIZACIÓN ADICIONAL SI ES LA MISMA KEY QUE LA ANTERIOR
-        if current_key == prev_key:
-            score -= 200
-
-        fifth_penalty = 0
-        if rel == "fifth":
-            if CATTANEO_STATE["fifth_count"] >= max_fifths:
-                continue
-            if CATTANEO_STATE["tracks_since_fifth"] < 10:
-                fifth_penalty = -300
-            else:
-                fifth_penalty = 100
-
-        if rel == "same":
-            if CATTANEO_STATE["rep_count"] < 1:
-                score += 40
-            elif CATTANEO_STATE["rep_count"] == 1:
-                score += 20
-            else:
-                score -= 300
-        elif rel == "up":
-            base_up_score = 200
-            if CATTANEO_STATE["switch_pair_count"] >= 2:
-                base_up_score += 100
-            score += base_up_score
-        elif rel == "down":
-            score += 120
-        elif rel == "switch":
-            switch_score = 180
-            if current_pair and CATTANEO_STATE["switch_pair"] == current_pair:
-                if CATTANEO_STATE["switch_pair_count"] >= 1:
-                    switch_score -= 80
-            score += switch_score
-        elif rel == "fifth":
-            score += fifth_penalty
-
-        if target_energy in ["build", "mid_peak"] and prev_mode == "A" and current_key.endswith("B"):
-            score += 150
-
-        if target_energy in ["warmup", "build"] and current_key.endswith("A"):
-            score += 80
-
-        scored.append((score, t))
-
-    if not scored:
-        return None
-    
-    scored.sort(key=lambda x: x[0], reverse=True)
-    
-    # 🔥 SELECCIÓN CON VARIEDAD: Top 10% con algo de randomness
-    top_candidates = scored[:max(1, len(scored) // 10)]
-    ganador = random.choice(top_candidates)[1].copy()
-    ganador_key = ganador["key"]
-    ganador_rel = camelot_relation(prev_key, ganador_key)
-
-    CATTANEO_STATE["last_two_keys"].append(ganador_key)
-    if len(CATTANEO_STATE["last_two_keys"]) > 2:
-        CATTANEO_STATE["last_two_keys"].pop(0)
-    
-    ganador_pair = get_key_pair(prev_key, ganador_key)
-    if ganador_rel == "switch" and ganador_pair:
-        if CATTANEO_STATE["switch_pair"] == ganador_pair:
-            CATTANEO_STATE["switch_pair_count"] += 1
-        else:
-            CATTANEO_STATE["switch_pair"] = ganador_pair
-            CATTANEO_STATE["switch_pair_count"] = 1
-    else:
-        CATTANEO_STATE["switch_pair"] = None
-        CATTANEO_STATE["switch_pair_count"] = 0
-    
-    if ganador_rel == "fifth":
-        CATTANEO_STATE["tracks_since_fifth"] = 0
-        CATTANEO_STATE["fifth_count"] += 1
-    else:
-        CATTANEO_STATE["tracks_since_fifth"] += 1
-
-    if ganador_key == prev_key:
-        CATTANEO_STATE["rep_count"] += 1
-    else:
-        CATTANEO_STATE["rep_count"] = 0
-
-    ganador["stage"] = target_energy
-    return ganador
-
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if current_user.is_authenticated:
-        return redirect(url_for("index"))
-    if request.method == "POST":
-        email = request.form["email"]
-        password = request.form["password"]
-        user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
-            login_user(user)
-        else:
-            flash("Email o contraseña inválidos")
-    return redirect(url_for("index", login_attempt=True)) 
-
-@app.route("/signup", methods=["GET", "POST"])
-def signup():
-    if current_user.is_authenticated:
-        return redirect(url_for("index"))
-    if request.method == "POST":
-        email = request.form["email"]
-        password = request.form["password"]
-        if User.query.filter_by(email=email).first():
-            flash("Ese email ya está registrado.")
-            return redirect(url_for("index", signup_attempt=True)) 
-        new_user = User(email=email)
-        new_user.set_password(password)
-        db.session.add(new_user)
-        db.session.commit()
-        flash("¡Registro exitoso! Ya puedes iniciar sesión.")
-    return redirect(url_for("index", signup_attempt=True)) 
-
-@app.route("/logout")
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for("index"))
-
-@app.route("/")
-def index():
-    show_signup = request.args.get("signup_attempt", False)
-    return render_template("index.html", user=current_user, show_signup=show_signup) 
-
-@app.route("/api/search")
-@login_required 
-def api_search():
-    tracks = load_tracks()
-    q = request.args.get("q", "").lower()
-    energy_web = request.args.get("energy", "").lower() 
-    page = int(request.args.get("page", 1))
-    per_page = 100 
-    results = []
-    
-    web_to_internal = {
-        "warm-up": "warmup",
-        "building": "build",
-        "mid-peak": "mid_peak",
-        "peak time": "peaktime",
-        "driving": "driving",
-        "closing": "closing"
-    }
-    
-    target_stage = web_to_internal.get(energy_web)
-
-    for t in tracks:
-        full = f"{t.get('artist','')} {t.get('track','')}".lower()
-        if q and q not in full: continue
-        
-        current_stage = t.get("stage", "").lower()
-
-        if target_stage:
-            if target_stage == "mid_peak":
-                if current_stage not in ["mid_peak", "midpeaks"]:
-                    continue
-            else:
-                if current_stage != target_stage:
-                    continue
-            
-        results.append(t)
-        
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_results = results[start:end]
-    return jsonify({"tracks": paginated_results, "has_more": end < len(results)})
-
-@app.route("/generate", methods=["POST"])
-@login_required 
-def generate():
-    if current_user.role == 'trial':
-        data = request.json or {}
-        hours = int(data.get("hours", 1))
-        if hours > 1: 
-            return jsonify({"error": "Los usuarios de prueba solo pueden generar sets de 1 hora."}), 403
-        if current_user.trial_uses_left <= 0: 
-            return jsonify({"error": "Has agotado tus 2 pruebas gratuitas."}), 403
-        current_user.trial_uses_left -= 1
-        db.session.commit()
-    
-    global CATTANEO_STATE
-    CATTANEO_STATE = {
-        "rep_count": 0, 
-        "last_phase": "",
-        "tracks_since_fifth": 0,
-        "fifth_count": 0,
-        "last_two_keys": [],
-        "switch_pair": None,
-        "switch_pair_count": 0
-    }
-    
-    data = request.json or {}
-    hours = int(data.get("hours", 1))
-    start_name = data.get("start_track", "").lower()
-    tracks = load_tracks()
-    
-    available_phases = PHASE_VARIANTS.get(hours, PHASE_VARIANTS[1])
-    selected_phase = random.choice(available_phases)
-    target_length = len(selected_phase)
-    
-    first = None
-    target_energy_first = selected_phase[0]
-
-    if start_name:
-        for t in tracks:
-            full = f"{t.get('artist','')} - {t.get('track','')}".lower()
-            if start_name in full:
-                first = t.copy()
-                break
-    
-    if not first:
-        warmups = [t for t in tracks if is_track_valid_for_phase(t, target_energy_first)]
-        first = random.choice(warmups if warmups else tracks).copy()
-    
-    first["stage"] = target_energy_first
-    
-    setlist = [first]
-    used_tracks = {first["track"]}
-    recent_keys = [first["key"]]
-    
-    for i in range(1, target_length):
-        prev = setlist[-1]
-        target_energy = selected_phase[i]
-        chosen = find_compatible_track(prev, target_energy, used_tracks, duration_hours=hours, recent_keys=recent_keys)
-        if chosen:
-            chosen["stage"] = target_energy
-            setlist.append(chosen)
-            used_tracks.add(chosen["track"])
-            recent_keys.append(chosen["key"])
-        else:
-            fallback_tracks = [t for t in tracks if t["track"] not in used_tracks and is_track_valid_for_phase(t, target_energy, attempt=2)]
-            if fallback_tracks:
-                fallback = random.choice(fallback_tracks).copy()
-                fallback["stage"] = target_energy
-                setlist.append(fallback)
-                used_tracks.add(fallback["track"])
-                recent_keys.append(fallback["key"])
-    
-    final_setlist = setlist[:target_length]
-    
-    return jsonify(final_setlist)
-
-@app.route("/api/change_track/<int:index>", methods=["POST"])
-@login_required 
-def change_track(index):
-    data = request.json or {}
-    setlist_in = data.get("current_setlist", []) 
-    if index < 0 or index >= len(setlist_in): return jsonify({"error": "Index out of range"}), 400
-    
-    prev_track = setlist_in[index - 1] if index > 0 else None
-    used_track_names = {t["track"] for t in setlist_in}
-    
-    target_stage = setlist_in[index].get("stage", "warmup")
-    
-    if prev_track:
-        replacement_track = find_compatible_track(
-            prev_track, target_stage, used_track_names
-        )
-        if replacement_track: 
-            replacement_track["stage"] = target_stage
-            return jsonify(replacement_track)
-        else: return jsonify({"error": "No compatible alternative found"}), 404
-    return jsonify({"error": "Cannot change the first track via this endpoint"}), 400
-
-@app.route("/api/generate_locked", methods=["POST"])
-@login_required 
-def generate_locked():
-    if current_user.role == 'trial':
-        hours = int(request.json.get("hours", 1))
-        if hours > 1: return jsonify({"error": "Los usuarios de prueba solo pueden generar sets de 1 hora."}), 403
-        if current_user.trial_uses_left <= 0: return jsonify({"error": "Has agotado tus pruebas."}), 403
-        current_user.trial_uses_left -= 1
-        db.session.commit()
-    
-    data = request.json or {}
-    hours = int(data.get("hours", 1))
-    locked_setlist = data.get("locked_setlist", [])
-    fixed_setlist = [t for t in locked_setlist if t.get("isLocked")]
-    phases = random.choice(PHASE_VARIANTS.get(hours, PHASE_VARIANTS[1]))
-    
-    if len(fixed_setlist) > len(phases): fixed_setlist = fixed_setlist[:len(phases)]
-    setlist = copy.deepcopy(fixed_setlist)
-    used = {t["track"] for t in setlist}
-    
-    for i in range(len(setlist), len(phases)):
-        if not setlist: break
-        prev = setlist[-1]
-        target_energy = phases[i]
-        chosen = find_compatible_track(prev, target_energy, used, duration_hours=hours)
-        if chosen:
-            if "isLocked" in chosen: del chosen["isLocked"]
-            chosen["stage"] = target_energy
-            setlist.append(chosen)
-            used.add(chosen["track"])
-        else: break
-    return jsonify(setlist)
-
-# ==============================
-# 🎵 NUEVO: ENDPOINT PARA OBTENER PREVIEW (SPOTIFY + YOUTUBE)
-# ==============================
-@app.route("/api/get_preview", methods=["POST"])
-@login_required
-def get_preview():
-    """
-    Busca preview de un track:
-    1. Intenta buscar Spotify ID
-    2. Si no encuentra, busca YouTube ID
-    3. Guarda el resultado en el JSON
-    4. Retorna el ID + tipo
-    """
-    data = request.json or {}
-    artist = data.get("artist", "")
-    track_name = data.get("track", "")
-    
-    if not artist or not track_name:
-        return jsonify({"error": "Missing artist or track"}), 400
-    
-    tracks = load_tracks()
-    track_found = None
-    track_index = -1
-    
-    # Buscar el track en el JSON
-    for i, t in enumerate(tracks):
-        if t.get("artist") == artist and t.get("track") == track_name:
-            track_found = t
-            track_index = i
-            break
-    
-    if not track_found:
-        return jsonify({"error": "Track not found in database"}), 404
-    
-    # Si ya tiene spotify_id, retornarlo
-    if track_found.get("spotify_id"):
-        return jsonify({
-            "type": "spotify",
-            "id": track_found["spotify_id"]
-        }), 200
-    
-    # Si ya tiene youtube_id, retornarlo
-    if track_found.get("youtube_id"):
-        return jsonify({
-            "type": "youtube",
-            "id": track_found["youtube_id"]
-        }), 200
-    
-    # Intentar buscar en Spotify primero
-    spotify_id = search_spotify_id(artist, track_name)
-    
-    if spotify_id:
-        # Guardar en el JSON
-        tracks[track_index]["spotify_id"] = spotify_id
-        save_tracks(tracks)
-        
-        return jsonify({
-            "type": "spotify",
-            "id": spotify_id
-        }), 200
-    
-    # Si no encontró en Spotify, buscar en YouTube
-    youtube_id = search_youtube_id(artist, track_name)
-    
-    if youtube_id:
-        # Guardar en el JSON
-        tracks[track_index]["youtube_id"] = youtube_id
-        save_tracks(tracks)
-        
-        return jsonify({
-            "type": "youtube",
-            "id": youtube_id
-        }), 200
-    
-    # No se encontró preview
-    return jsonify({"error": "No preview found"}), 404
-
-@app.route("/api/mercadopago-webhook", methods=["POST"])
-def mercadopago_webhook():
-    try:
-        data = request.get_json()
-        
-        x_signature = request.headers.get('x-signature')
-        x_request_id = request.headers.get('x-request-id')
-        
-        if not x_signature or not x_request_id:
-            app.logger.warning("Webhook sin headers de MercadoPago")
-            return jsonify({"status": "invalid headers"}), 400
-        
-        topic = data.get("topic") or data.get("type")
-        
-        if topic == "payment":
-            payment_id = data.get("data", {}).get("id") or data.get("id")
-            
-            if not payment_id:
-                return jsonify({"status": "no payment_id"}), 400
-            
-            payment_info = sdk.payment().get(payment_id)
-            payment_status = payment_info["response"]["status"]
-            
-            if payment_status == "approved":
-                user_id = payment_info["response"].get("external_reference")
-                
-                if not user_id:
-                    app.logger.error(f"Payment {payment_id} sin external_reference")
-                    return jsonify({"status": "no user reference"}), 400
-                
-                user = User.query.get(int(user_id))
-                
-                if not user:
-                    app.logger.error(f"Usuario {user_id} no encontrado")
-                    return jsonify({"status": "user not found"}), 404
-                
-                if user.last_payment_id == str(payment_id):
-                    app.logger.info(f"Pago duplicado ignorado: {payment_id}")
-                    return jsonify({"status": "already processed"}), 200
-                
-                items = payment_info["response"].get("additional_info", {}).get("items", [])
-                title = items[0].get("title", "") if items else ""
-                
-                if "Mensual" in title:
-                    user.pro_until = datetime.utcnow() + timedelta(days=30)
-                    user.plan = 'monthly'
-                elif "Anual" in title:
-                    user.pro_until = datetime.utcnow() + timedelta(days=365)
-                    user.plan = 'annual'
-                
-                user.role = 'owner'
-                user.last_payment_id = str(payment_id)
-                
-                db.session.commit()
-                
-                app.logger.info(f"✅ Pago aprobado para user {user_id}, plan: {user.plan}")
-                return jsonify({"status": "processed"}), 200
-            
-            else:
-                app.logger.info(f"Pago {payment_id} en estado: {payment_status}")
-                return jsonify({"status": "payment not approved"}), 200
-        
-        return jsonify({"status": "not a payment notification"}), 200
-        
-    except Exception as e:
-        app.logger.error(f"Error en webhook: {str(e)}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-@app.route("/create-payment", methods=["POST"])
-@login_required
-def create_payment():
-    if check_pro(current_user): 
-        return jsonify({"error": "Ya eres usuario PRO activo."}), 400
-    
-    data = request.get_json() or {}
-    subscription_type = data.get("type") 
-    
-    if subscription_type == 'monthly':
-        price, title = 10000.00, "Suscripción PRO Mensual"
-    elif subscription_type == 'annual':
-        price, title = 50000.00, "Suscripción PRO Anual"
-    else: 
-        return jsonify({"error": "Tipo de suscripción inválido"}), 400
-
-    preference_data = {
-        "items": [
-            {
-                "title": title,
-                "quantity": 1,
-                "unit_price": price,
-                "currency_id": "ARS"
-            }
-        ],
-        "payer": {
-            "email": current_user.email
-        },
-        "external_reference": str(current_user.id),
-        "notification_url": "https://www.progressivejourney.net/api/mercadopago-webhook",
-        "auto_return": "approved",
-        "back_urls": {
-            "success": "https://www.progressivejourney.net/?payment=success",
-            "pending": "https://www.progressivejourney.net/?payment=pending",
-            "failure": "https://www.progressivejourney.net/?payment=failure"
-        }
-    }
-
-    preference = sdk.preference().create(preference_data)
-    return jsonify({"preference_id": preference["response"]["id"]}), 200
-
-@app.route("/api/share_set", methods=["POST"])
-@login_required
-def share_set():
-    """Guarda un set y genera un link único para compartir."""
-    data = request.json or {}
-    setlist = data.get("setlist", [])
-    hours = data.get("hours", 1)
-    
-    if not setlist or len(setlist) == 0:
-        return jsonify({"error": "No hay setlist para compartir"}), 400
-    
-    # Generar ID único de 6 caracteres
-    import string
-    while True:
-        share_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
-        if not SharedSet.query.get(share_id):
-            break
-    
-    # Guardar en la DB
-    shared_set = SharedSet(
-        id=share_id,
-        user_id=current_user.id,
-        setlist_json=json.dumps(setlist),
-        duration_hours=hours
-    )
-    db.session.add(shared_set)
-    db.session.commit()
-    
-    # Retornar el link
-    share_url = f"https://www.progressivejourney.net/set/{share_id}"
-    return jsonify({"share_url": share_url, "share_id": share_id}), 200
-
-
-@app.route("/set/<share_id>")
-def view_shared_set(share_id):
-    """Página pública para ver un set compartido."""
-    shared_set = SharedSet.query.get(share_id)
-    
-    if not shared_set:
-        return render_template("404.html"), 404
-    
-    # Incrementar views
-    shared_set.views += 1
-    db.session.commit()
-    
-    # Parsear el setlist
-    setlist = json.loads(shared_set.setlist_json)
-    
-    return render_template(
-        "shared_set.html",
-        setlist=setlist,
-        duration=shared_set.duration_hours,
-        views=shared_set.views,
-        created_at=shared_set.created_at,
-        share_id=share_id
-    )
-
-# ==============================
-# ENDPOINTS DE SPOTIFY CON OAUTH
-# ==============================
-
-@app.route("/spotify/login")
-@login_required
-def spotify_login():
-    """Redirige al usuario a Spotify para autenticarse."""
-    cache_path = f".spotify_cache_{current_user.id}"
-    
-    auth_manager = SpotifyOAuth(
-        client_id=SPOTIFY_CLIENT_ID,
-        client_secret=SPOTIFY_CLIENT_SECRET,
-        redirect_uri=SPOTIFY_REDIRECT_URI,
-        scope="user-read-private",
-        cache_path=cache_path,
-        show_dialog=True
-    )
-    
-    auth_url = auth_manager.get_authorize_url()
-    return redirect(auth_url)
-
-
-@app.route("/spotify/callback")
-@login_required
-def spotify_callback():
-    """Callback después de que el usuario autoriza en Spotify."""
-    cache_path = f".spotify_cache_{current_user.id}"
-    
-    auth_manager = SpotifyOAuth(
-        client_id=SPOTIFY_CLIENT_ID,
-        client_secret=SPOTIFY_CLIENT_SECRET,
-        redirect_uri=SPOTIFY_REDIRECT_URI,
-        scope="user-read-private",
-        cache_path=cache_path
-    )
-    
-    code = request.args.get('code')
-    if code:
-        token_info = auth_manager.get_access_token(code)
-        if token_info:
-            print(f"✅ Usuario {current_user.id} autenticado en Spotify")
-            return redirect("/?spotify_connected=true")
-    
-    return redirect("/?spotify_error=true")
-
-
-@app.route("/api/spotify/search", methods=["GET"])
-@login_required
-def spotify_search():
-    """Busca canciones en Spotify con OAuth (sin 403)."""
-    query = request.args.get("q", "")
-    if not query:
-        return jsonify({"tracks": []}), 200
-    
-    try:
-        # Obtener cliente autenticado del usuario
-        sp = get_spotify_client(current_user.id)
-        
-        # Verificar si el usuario está autenticado
-        token_info = sp.auth_manager.get_cached_token()
-        if not token_info:
-            return jsonify({
-                "error": "not_authenticated",
-                "message": "Necesitas conectar tu cuenta de Spotify primero"
-            }), 401
-        
-        # Buscar en Spotify
-        results = sp.search(q=query, type='track', limit=20)
-        tracks = []
-        
-        for item in results['tracks']['items']:
-            track_id = item['id']
-            
-            # Valores por defecto
-            bpm = 122
-            key_camelot = "8A"
-            energy = 5
-            
-            try:
-                # Obtener audio_features (ahora SÍ funciona con OAuth)
-                audio_features = sp.audio_features([track_id])[0]
-                
-                if audio_features:
-                    # BPM real
-                    bpm = round(audio_features['tempo'])
-                    
-                    # Key real (convertir a Camelot)
-                    spotify_key = audio_features['key']
-                    spotify_mode = audio_features['mode']
-                    key_camelot = convert_spotify_key(spotify_key, spotify_mode)
-                    
-                    # Energy real
-                    energy = round(audio_features['energy'] * 10)
-                    
-                    print(f"✅ {item['name']} - BPM:{bpm} Key:{key_camelot}")
-                    
-            except Exception as audio_error:
-                print(f"⚠️ Error en audio_features: {audio_error}")
-            
-            track_data = {
-                "spotify_id": track_id,
-                "artist": item['artists'][0]['name'],
-                "track": item['name'],
-                "album": item['album']['name'],
-                "image": item['album']['images'][0]['url'] if item['album']['images'] else None,
-                "preview_url": item['preview_url'],
-                "bpm": bpm,
-                "key": key_camelot,
-                "energy": energy,
-            }
-            tracks.append(track_data)
-        
-        return jsonify({"tracks": tracks}), 200
-    
-    except spotipy.exceptions.SpotifyException as e:
-        if e.http_status == 401:
-            return jsonify({
-                "error": "not_authenticated",
-                "message": "Tu sesión de Spotify expiró. Volvé a conectar."
-            }), 401
-        return jsonify({"error": str(e)}), 500
-    
-    except Exception as e:
-        print(f"❌ Error en Spotify search: {e}")
-        return jsonify({"error": str(e)}), 500
-
-
-def convert_spotify_key(key_number, mode):
-    """Convierte key de Spotify (0-11) a Camelot."""
-    camelot_minor = {
-        0: "5A", 1: "12A", 2: "7A", 3: "2A", 4: "9A", 5: "4A",
-        6: "11A", 7: "6A", 8: "1A", 9: "8A", 10: "3A", 11: "10A"
-    }
-    
-    camelot_major = {
-        0: "8B", 1: "3B", 2: "10B", 3: "5B", 4: "12B", 5: "7B",
-        6: "2B", 7: "9B", 8: "4B", 9: "11B", 10: "6B", 11: "1B"
-    }
-    
-    if mode == 0:  # Minor
-        return camelot_minor.get(key_number, "8A")
-    else:  # Major
-        return camelot_major.get(key_number, "8B")
-
-from io import BytesIO
-import base64
-
-@app.route("/api/get_energy_data", methods=["POST"])
-@login_required
-def get_energy_data():
-    """Retorna datos para el gráfico de energía."""
-    data = request.json or {}
-    setlist = data.get("setlist", [])
-    
-    if not setlist:
-        return jsonify({"error": "No setlist provided"}), 400
-    
-    # Mapear energy levels
-    energy_map = {
-        "warmup": 3,
-        "build": 5,
-        "mid_peak": 7,
-        "peak_time": 9,
-        "peaktime": 9,
-        "driving": 10,
-        "closing": 6
-    }
-    
-    labels = []
-    energy_values = []
-    
-    for i, track in enumerate(setlist, 1):
-        stage = track.get("stage", "warmup").lower()
-        energy = energy_map.get(stage, 5)
-        
-        labels.append(f"#{i}")
-        energy_values.append(energy)
-    
-    return jsonify({
-        "labels": labels,
-        "data": energy_values
-    }), 200
-
-
-@app.route("/api/get_key_wheel_data", methods=["POST"])
-@login_required
-def get_key_wheel_data():
-    """Retorna datos para el Key Wheel."""
-    data = request.json or {}
-    setlist = data.get("setlist", [])
-    
-    if not setlist:
-        return jsonify({"error": "No setlist provided"}), 400
-    
-    # Contar frecuencia de cada key
-    key_counts = {}
-    key_sequence = []
-    
-    for track in setlist:
-        key = track.get("key", "8A")
-        key_sequence.append(key)
-        key_counts[key] = key_counts.get(key, 0) + 1
-    
-    # Todas las keys del Camelot Wheel
-    all_keys = [
-        "12A", "1A", "2A", "3A", "4A", "5A", "6A", "7A", "8A", "9A", "10A", "11A",
-        "12B", "1B", "2B", "3B", "4B", "5B", "6B", "7B", "8B", "9B", "10B", "11B"
-    ]
-    
-    return jsonify({
-        "key_counts": key_counts,
-        "key_sequence": key_sequence,
-        "all_keys": all_keys
-    }), 200
-
-@app.route("/api/submit_crypto_payment", methods=["POST"])
-@login_required
-def submit_crypto_payment():
-    """Usuario envía comprobante de pago USDT."""
-    data = request.json or {}
-    plan = data.get("plan")  # 'monthly' o 'annual'
-    tx_id = data.get("tx_id", "")
-    screenshot = data.get("screenshot")
-    
-    if not plan or plan not in ['monthly', 'annual']:
-        return jsonify({"error": "Plan inválido"}), 400
-    
-    if not screenshot:
-        return jsonify({"error": "Falta la captura de pantalla"}), 400
-    
-    # Determinar monto
-    amount = 10.0 if plan == 'monthly' else 45.0
-    
-    # Crear solicitud de pago
-    payment_request = PaymentRequest(
-        user_id=current_user.id,
-        plan=plan,
-        amount_usdt=amount,
-        tx_id=tx_id,
-        screenshot_data=screenshot,
-        status='pending'
-    )
-    
-    db.session.add(payment_request)
-    db.session.commit()
-    
-    app.logger.info(f"✅ Nueva solicitud de pago USDT: User {current_user.email}, Plan {plan}, Amount {amount} USDT")
-    
-    return jsonify({
-        "success": True,
-        "message": "Comprobante enviado correctamente. Será revisado en 24hs."
-    }), 200
-
-
-@app.route("/admin")
-@login_required
-def admin_panel():
-    """Panel de administración para aprobar pagos."""
-    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
-    
-    # DEBUG
-    print(f"🔍 Usuario accediendo: {current_user.email}")
-    print(f"🔍 Admin email configurado: {ADMIN_EMAIL}")
-    print(f"🔍 ¿Es admin? {current_user.email == ADMIN_EMAIL}")
-    
-    if current_user.email != ADMIN_EMAIL:
-        return "❌ Acceso denegado", 403
-    
-    # Obtener solicitudes pendientes
-    pending_requests = PaymentRequest.query.filter_by(status='pending').order_by(PaymentRequest.created_at.desc()).all()
-    
-    # Obtener historial (últimas 50)
-    history = PaymentRequest.query.filter(PaymentRequest.status.in_(['approved', 'rejected'])).order_by(PaymentRequest.processed_at.desc()).limit(50).all()
-    
-    return render_template('admin.html', pending=pending_requests, history=history)
-@app.route("/admin/approve/<int:request_id>", methods=["POST"])
-@login_required
-def approve_payment(request_id):
-    """Aprobar solicitud de pago."""
-    ADMIN_EMAIL = "tu_email@ejemplo.com"  # ← CAMBIÁ ESTO POR TU EMAIL
-    
-    if current_user.email != ADMIN_EMAIL:
-        return jsonify({"error": "No autorizado"}), 403
-    
-    payment_req = PaymentRequest.query.get(request_id)
-    if not payment_req:
-        return jsonify({"error": "Solicitud no encontrada"}), 404
-    
-    if payment_req.status != 'pending':
-        return jsonify({"error": "Esta solicitud ya fue procesada"}), 400
-    
-    # Activar usuario PRO
-    user = payment_req.user
-    user.role = 'owner'
-    
-    if payment_req.plan == 'monthly':
-        user.pro_until = datetime.utcnow() + timedelta(days=30)
-        user.plan = 'monthly'
-    else:
-        user.pro_until = datetime.utcnow() + timedelta(days=365)
-        user.plan = 'annual'
-    
-    # Marcar solicitud como aprobada
-    payment_req.status = 'approved'
-    payment_req.processed_at = datetime.utcnow()
-    
-    db.session.commit()
-    
-    app.logger.info(f"✅ Pago aprobado: User {user.email}, Plan {payment_req.plan}")
-    
-    return jsonify({"success": True, "message": f"Usuario {user.email} activado como PRO"}), 200
-
-
-@app.route("/admin/reject/<int:request_id>", methods=["POST"])
-@login_required
-def reject_payment(request_id):
-    """Rechazar solicitud de pago."""
-    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
-    
-    if current_user.email != ADMIN_EMAIL:
-        return jsonify({"error": "No autorizado"}), 403
-    
-    payment_req = PaymentRequest.query.get(request_id)
-    if not payment_req:
-        return jsonify({"error": "Solicitud no encontrada"}), 404
-    
-    if payment_req.status != 'pending':
-        return jsonify({"error": "Esta solicitud ya fue procesada"}), 400
-    
-    payment_req.status = 'rejected'
-    payment_req.processed_at = datetime.utcnow()
-    
-    db.session.commit()
-    
-    app.logger.info(f"❌ Pago rechazado: User {payment_req.user.email}")
-    
-    return jsonify({"success": True, "message": "Solicitud rechazada"}), 200
-
-@app.route("/make_me_owner_secret_route_12345")
-@login_required
-def make_me_owner():
-    """Ruta temporal para hacerte owner"""
-    if current_user.email == "elidj269@gmail.com":  # ← CAMBIÁ ESTO POR TU EMAIL REAL
-        current_user.role = 'owner'
-        current_user.pro_until = datetime.utcnow() + timedelta(days=365)
-        current_user.plan = 'annual'
-        db.session.commit()
-        return "✅ Ahora sos OWNER!"
-    return "❌ No autorizado"
-
-if __name__ == "__main__":
-    with app.app_context():
-        db.create_all() 
-
-    app.run(debug=True, port=5000)
-
-
-
-
-
-
-
-
-
-
+import time
+_BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Blueprint, current_app, send_file, stream_with_context, send_from_directory, make_response, abort, session
+from flask.cli import with_appcontext
+from flask.json.provider import DefaultJSONProvider
+from flask_sqlalchemy import SQLAlchemy
+from flask_login import LoginManager, UserMixin, current_user, login_user, logout_user, login_required
+from werkzeug.security import generate_password_hash, check_password_hash
+import click
+import random
+import json
+import os
+import copy
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from operator import itemgetter
+from datetime import datetime, timedelta
+import hashlib
+import hmac
+import base64
+import uuid
+import secrets
+import string
+import io
+import csv
+import zipfile
+import gzip
+import re
+import math
+import functools
+import itertools
+import bisect
+import heapq
+import unicodedata
+import sys
+from array import array
+from xml.sax.saxutils import quoteattr
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+if os.path.exists('.env'):
+    load_dotenv()
+
+# ==============================
+# EXTENSIONES (se enlazan a la app en create_app)
+# ==============================
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+
+bp = Blueprint('main', __name__)
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Métricas de arranque (cold start)
+BOOT_STATS = {}
+
+# ==============================
+# CONFIGURACIÓN
+# ==============================
+def get_database_url(env_var='DATABASE_URL', default='sqlite:///instance/users.db'):
+    """URL de la base: PostgreSQL si DATABASE_URL existe, sino SQLite local."""
+    database_url = os.getenv(env_var, default)
+    # Fix: PostgreSQL URL debe usar postgresql+psycopg en vez de postgresql
+    if database_url and database_url.startswith('postgresql://'):
+        database_url = database_url.replace('postgresql://', 'postgresql+psycopg://')
+    return database_url
+
+def get_engine_options(database_url):
+    """Opciones del pool de SQLAlchemy para una URL, configurables por env.
+
+    Cada worker abre hasta DB_POOL_SIZE + DB_MAX_OVERFLOW conexiones por
+    base; si están todas ocupadas más de DB_POOL_TIMEOUT segundos, el
+    request responde 503 en vez de quedar colgado.
+    """
+    url = make_url(database_url)
+    options = {
+        # Descarta conexiones que el server cerró (Render corta las ociosas)
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options  # SQLite en memoria: una sola conexión, sin tamaño de pool
+    options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "5"))
+    options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+    options["pool_timeout"] = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+    if url.get_driver_name() == "psycopg":
+        # psycopg prepara del lado del server las consultas que se repiten
+        # DB_PREPARE_THRESHOLD veces; con PgBouncer en modo transaction hay
+        # que apagarlo (DB_PREPARE_THRESHOLD=none)
+        threshold = os.getenv("DB_PREPARE_THRESHOLD", "5")
+        options["connect_args"] = {
+            "prepare_threshold": None if threshold.lower() in ("", "none", "off") else int(threshold)
+        }
+    return options
+
+# ==============================
+# SPOTIFY CONFIGURATION CON OAUTH
+# ==============================
+SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "https://www.progressivejourney.net/spotify/callback")
+
+# ==============================
+# YOUTUBE API CONFIGURATION
+# ==============================
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", "")  # Agregar tu API key aquí
+
+# Timeout (segundos) de cada llamada a Spotify/YouTube para previews
+PREVIEW_TIMEOUT = float(os.getenv("PREVIEW_TIMEOUT", "4"))
+
+# ==============================
+# MERCADOPAGO CONFIGURATION
+# ==============================
+MP_ACCESS_TOKEN = os.getenv("MP_ACCESS_TOKEN")
+
+# ==============================
+# CACHÉ EN MEMORIA
+# ==============================
+class TTLCache:
+    """Caché por proceso con expiración por entrada y desalojo LRU."""
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._data)
+
+# ==============================
+# JSON (PROVIDER RÁPIDO)
+# ==============================
+# orjson es opcional: si está instalado se usa para jsonify y request.json;
+# si no, el json de la stdlib. En los dos casos sin ordenar claves (Flask las
+# ordena por defecto y eso cuesta en listas largas de tracks).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider de la app: orjson cuando está disponible, stdlib si no."""
+
+    sort_keys = False
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj) + b"\n", mimetype=self.mimetype)
+
+    def encode(self, obj):
+        """Serializa directo a bytes UTF-8 (sin pasar por str)."""
+        if orjson is not None:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return json.dumps(obj, default=self.default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# ==============================
+# CLIENTES EXTERNOS (LAZY)
+# ==============================
+# mercadopago, spotipy, requests y googleapiclient se importan recién en el
+# primer uso: importar app.py (workers de gunicorn, CLI) no paga ese costo.
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name, factory):
+    """Devuelve el cliente `name`, construyéndolo con `factory` la primera vez."""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+def get_http():
+    """Sesión HTTP compartida (reusa conexiones keep-alive)."""
+    def factory():
+        import requests
+        return requests.Session()
+    return _get_client("http", factory)
+
+def get_mp_sdk():
+    """SDK de MercadoPago, construido en el primer uso."""
+    if not MP_ACCESS_TOKEN:
+        raise RuntimeError("MP_ACCESS_TOKEN no configurado. Los pagos no funcionarán.")
+    def factory():
+        import mercadopago
+        return mercadopago.SDK(MP_ACCESS_TOKEN)
+    return _get_client("mercadopago", factory)
+
+def get_youtube_client():
+    """Cliente de YouTube Data API, construido en el primer uso."""
+    def factory():
+        import httplib2
+        from googleapiclient.discovery import build
+        return build('youtube', 'v3', developerKey=YOUTUBE_API_KEY, cache_discovery=False,
+                     http=httplib2.Http(timeout=PREVIEW_TIMEOUT))
+    return _get_client("youtube", factory)
+
+# ==============================
+# SPOTIFY TOKENS POR USUARIO
+# ==============================
+# Tokens OAuth en la tabla spotify_token con un LRU en memoria adelante:
+# una búsqueda no toca disco y el token sirve en cualquier instancia.
+SPOTIFY_TOKEN_CACHE = TTLCache(ttl=600, maxsize=5000)
+# Clientes spotipy.Spotify ya armados, por usuario
+SPOTIFY_CLIENTS = TTLCache(ttl=3600, maxsize=500)
+# Refrescar el access token si le quedan menos de estos segundos
+SPOTIFY_REFRESH_MARGIN = 300
+
+def load_spotify_token(user_id):
+    """Token del usuario: LRU, después DB (y por única vez el viejo archivo de caché).
+
+    Solo se cachean los tokens encontrados: un "no conectado" guardado en el
+    LRU de un worker seguiría respondiendo 401 después de que el usuario se
+    conecte a Spotify en otro.
+    """
+    token_info = SPOTIFY_TOKEN_CACHE.get(user_id)
+    if token_info is not None:
+        return token_info
+    row = db.session.get(SpotifyToken, user_id)
+    token_info = json.loads(row.token_json) if row else None
+    if token_info is None:
+        token_info = _import_legacy_spotify_cache(user_id)
+    if token_info:
+        SPOTIFY_TOKEN_CACHE.set(user_id, token_info)
+    return token_info
+
+def save_spotify_token(user_id, token_info):
+    """Guarda el token en la DB y en el LRU."""
+    row = db.session.get(SpotifyToken, user_id)
+    if row is None:
+        row = SpotifyToken(user_id=user_id)
+        db.session.add(row)
+    row.token_json = json.dumps(token_info)
+    db.session.commit()
+    SPOTIFY_TOKEN_CACHE.set(user_id, token_info)
+
+def _import_legacy_spotify_cache(user_id):
+    """Migra un `.spotify_cache_<id>` de la versión anterior a la DB y lo borra."""
+    legacy_path = f".spotify_cache_{user_id}"
+    if not os.path.exists(legacy_path):
+        return None
+    try:
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            token_info = json.load(f)
+        save_spotify_token(user_id, token_info)
+        os.remove(legacy_path)
+        return token_info
+    except Exception as e:
+        print(f"⚠️ No se pudo migrar {legacy_path}: {e}")
+        return None
+
+def _spotify_cache_handler_class():
+    """Subclase de CacheHandler de spotipy (se define en el primer uso)."""
+    def factory():
+        from spotipy.cache_handler import CacheHandler
+
+        class DBTokenCacheHandler(CacheHandler):
+            def __init__(self, user_id):
+                self.user_id = user_id
+
+            def get_cached_token(self):
+                return load_spotify_token(self.user_id)
+
+            def save_token_to_cache(self, token_info):
+                save_spotify_token(self.user_id, token_info)
+
+        return DBTokenCacheHandler
+    return _get_client("spotify_cache_handler", factory)
+
+def get_spotify_oauth(user_id, show_dialog=False):
+    """SpotifyOAuth del usuario con el token store de la DB."""
+    from spotipy.oauth2 import SpotifyOAuth
+    return SpotifyOAuth(
+        client_id=SPOTIFY_CLIENT_ID,
+        client_secret=SPOTIFY_CLIENT_SECRET,
+        redirect_uri=SPOTIFY_REDIRECT_URI,
+        scope="user-read-private",
+        cache_handler=_spotify_cache_handler_class()(user_id),
+        show_dialog=show_dialog
+    )
+
+def get_spotify_client(user_id):
+    """Obtiene un cliente de Spotify autenticado para el usuario (reusado entre requests)."""
+    sp = SPOTIFY_CLIENTS.get(user_id)
+    if sp is None:
+        import spotipy
+        sp = spotipy.Spotify(auth_manager=get_spotify_oauth(user_id))
+        SPOTIFY_CLIENTS.set(user_id, sp)
+    
+    # Refresco proactivo: que la búsqueda no se encuentre el token vencido
+    token_info = load_spotify_token(user_id)
+    if token_info and token_info.get("refresh_token") and \
+            token_info.get("expires_at", 0) - time.time() < SPOTIFY_REFRESH_MARGIN:
+        try:
+            sp.auth_manager.refresh_access_token(token_info["refresh_token"])
+        except Exception as e:
+            print(f"⚠️ No se pudo refrescar el token de Spotify del usuario {user_id}: {e}")
+    
+    return sp
+
+# ==============================
+# SPOTIFY CLIENT CREDENTIALS (SIN OAUTH)
+# ==============================
+_spotify_public_token = {"token": None, "expires_at": 0}
+
+def get_spotify_token_public():
+    """Obtiene token público de Spotify (Client Credentials), cacheado hasta que expira."""
+    if _spotify_public_token["token"] and time.time() < _spotify_public_token["expires_at"]:
+        return _spotify_public_token["token"]
+    try:
+        auth_response = get_http().post('https://accounts.spotify.com/api/token', {
+            'grant_type': 'client_credentials',
+            'client_id': SPOTIFY_CLIENT_ID,
+            'client_secret': SPOTIFY_CLIENT_SECRET,
+        }, timeout=PREVIEW_TIMEOUT)
+        
+        if auth_response.status_code == 200:
+            payload = auth_response.json()
+            _spotify_public_token["token"] = payload['access_token']
+            # Renovar un minuto antes de que expire
+            _spotify_public_token["expires_at"] = time.time() + payload.get('expires_in', 3600) - 60
+            return payload['access_token']
+        return None
+    except Exception as e:
+        print(f"Error getting Spotify token: {e}")
+        return None
+
+def _spotify_lookup(artist, track):
+    """Busca el Spotify ID de un track; propaga errores de red/HTTP."""
+    token = get_spotify_token_public()
+    if not token:
+        raise RuntimeError("No se pudo obtener token de Spotify")
+    
+    headers = {'Authorization': f'Bearer {token}'}
+    search_url = 'https://api.spotify.com/v1/search'
+    
+    params = {
+        'q': f'artist:{artist} track:{track}',
+        'type': 'track',
+        'limit': 1
+    }
+    
+    response = get_http().get(search_url, headers=headers, params=params, timeout=PREVIEW_TIMEOUT)
+    response.raise_for_status()
+    
+    results = response.json()
+    if results['tracks']['items']:
+        return results['tracks']['items'][0]['id']
+    return None
+
+def search_spotify_id(artist, track):
+    """Busca el Spotify ID de un track (sin OAuth)."""
+    try:
+        return _spotify_lookup(artist, track)
+    except Exception as e:
+        print(f"Error searching Spotify ID: {e}")
+        return None
+
+# ==============================
+# YOUTUBE SEARCH
+# ==============================
+def _youtube_lookup(artist, track):
+    """Busca el YouTube ID de un track; propaga errores de red/HTTP."""
+    youtube = get_youtube_client()
+    
+    search_query = f"{artist} {track} progressive house"
+    
+    print(f"🔍 Buscando en YouTube: {search_query}")
+    
+    request = youtube.search().list(
+        part="snippet",
+        q=search_query,
+        type="video",
+        maxResults=1,
+        videoCategoryId="10"
+    )
+    
+    response = request.execute()
+    
+    if response['items']:
+        video_id = response['items'][0]['id']['videoId']
+        print(f"✅ YouTube ID encontrado: {video_id}")
+        return video_id
+    
+    print(f"⚠️ No se encontró en YouTube")
+    return None
+
+def search_youtube_id(artist, track):
+    """Busca el YouTube ID de un track."""
+    if not YOUTUBE_API_KEY:
+        print("⚠️ YouTube API Key no configurada")
+        return None
+    
+    try:
+        return _youtube_lookup(artist, track)
+    except Exception as e:
+        print(f"❌ Error searching YouTube: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+# ==============================
+# PREVIEW RESOLVER (ASYNC)
+# ==============================
+# Los workers web nunca esperan a Spotify/YouTube: el request encola la
+# búsqueda y responde "pending"; un event loop asyncio en un thread propio
+# hace las llamadas con timeout y circuit breaker por proveedor.
+class CircuitBreaker:
+    """Deja de llamar a un proveedor después de varias fallas seguidas."""
+
+    def __init__(self, name, max_failures=3, reset_after=30):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True si se puede llamar (cerrado, o abierto hace más de reset_after: prueba)."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_after:
+                # half-open: dejar pasar un intento, si falla se vuelve a abrir
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                if self.opened_at is None:
+                    print(f"⚠️ Circuit breaker abierto para {self.name}")
+                self.opened_at = time.monotonic()
+
+class PreviewResolver:
+    """Cola en proceso de búsquedas de preview, resuelta en un event loop asyncio."""
+
+    JOB_TTL = 300  # segundos que se recuerda un resultado (incluido "no encontrado")
+    RETRY_TTL = 30  # si un proveedor falló, se reintenta antes
+    MAX_JOBS = 2000
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self.providers = [
+            # (tipo, función, breaker, executor): YouTube usa un solo thread porque
+            # su cliente HTTP (httplib2) no es thread-safe.
+            ("spotify", _spotify_lookup, CircuitBreaker("spotify"), ThreadPoolExecutor(4, "preview-spotify")),
+            ("youtube", _youtube_lookup, CircuitBreaker("youtube"), ThreadPoolExecutor(1, "preview-youtube")),
+        ]
+
+    def _ensure_loop(self):
+        # El loop se arranca en el worker (después del fork), nunca en el master
+        if self._loop is not None and self._pid == os.getpid():
+            return self._loop
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="preview-resolver", daemon=True).start()
+        self._loop, self._pid = loop, os.getpid()
+        return loop
+
+    def submit(self, artist, track_name):
+        """Devuelve el estado del job para el track, encolándolo si hace falta."""
+        key = (artist, track_name)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job and (job["status"] == "pending" or time.monotonic() - job["finished_at"] < job["ttl"]):
+                return dict(job)
+            if len(self._jobs) >= self.MAX_JOBS:
+                self._prune()
+            job = {"status": "pending", "finished_at": None, "ttl": None}
+            self._jobs[key] = job
+            asyncio.run_coroutine_threadsafe(self._resolve(key, current_app._get_current_object()), self._ensure_loop())
+            return dict(job)
+
+    def _prune(self):
+        now = time.monotonic()
+        for key, job in list(self._jobs.items()):
+            if job["status"] != "pending" and now - job["finished_at"] >= job["ttl"]:
+                del self._jobs[key]
+
+    def _finish(self, key, ttl, **result):
+        with self._lock:
+            self._jobs[key] = {**result, "finished_at": time.monotonic(), "ttl": ttl}
+
+    async def _resolve(self, key, app):
+        artist, track_name = key
+        loop = asyncio.get_running_loop()
+        skipped = False
+        for kind, lookup, breaker, executor in self.providers:
+            if kind == "youtube" and not YOUTUBE_API_KEY:
+                continue
+            if not breaker.allow():
+                skipped = True
+                continue
+            try:
+                found_id = await asyncio.wait_for(
+                    loop.run_in_executor(executor, lookup, artist, track_name), PREVIEW_TIMEOUT
+                )
+            except Exception as e:
+                print(f"⚠️ Preview {kind} falló para {artist} - {track_name}: {e!r}")
+                breaker.record_failure()
+                skipped = True
+                continue
+            breaker.record_success()
+            if found_id:
+                self._finish(key, self.JOB_TTL, status="done", type=kind, id=found_id)
+                # La escritura en la DB es bloqueante: va al pool por defecto, nunca al loop
+                try:
+                    await loop.run_in_executor(None, store_preview_id, app, artist, track_name, kind, found_id)
+                except Exception as e:
+                    print(f"⚠️ No se pudo guardar el preview de {artist} - {track_name}: {e!r}")
+                return
+        if skipped:
+            self._finish(key, self.RETRY_TTL, status="unavailable")
+        else:
+            self._finish(key, self.JOB_TTL, status="not_found")
+
+preview_resolver = PreviewResolver()
+
+# ==============================
+# COMPROBANTES DE PAGO (ARCHIVOS)
+# ==============================
+# Tipos de imagen aceptados, detectados por los primeros bytes (no por el nombre)
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+SCREENSHOT_MAX_SIDE = 1600  # px del lado mayor después de reescalar
+THUMBNAIL_SIDE = 320
+
+def detect_image_ext(head):
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+class LocalFileStore:
+    """Guarda archivos en un directorio local (reemplazable por object storage)."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, ref):
+        # Las referencias son nombres generados por nosotros, sin directorios
+        return os.path.join(self.root, os.path.basename(ref))
+
+    def save_stream(self, stream, ext, max_bytes, chunk_size=64 * 1024):
+        """Copia el stream a disco por partes; ValueError si supera max_bytes."""
+        os.makedirs(self.root, exist_ok=True)
+        ref = f"{uuid.uuid4().hex}{ext}"
+        tmp_path = self.path(ref) + ".part"
+        written = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError("Archivo demasiado grande")
+                    out.write(chunk)
+            os.replace(tmp_path, self.path(ref))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return ref
+
+    def delete(self, ref):
+        if ref and os.path.exists(self.path(ref)):
+            os.remove(self.path(ref))
+
+def get_screenshot_store():
+    return LocalFileStore(current_app.config["UPLOAD_FOLDER"])
+
+def thumbnail_ref(ref):
+    return f"{os.path.splitext(ref)[0]}_thumb.jpg"
+
+def downscale_screenshot(store, ref):
+    """Reduce el comprobante y genera su miniatura (si Pillow está instalado)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    try:
+        with Image.open(store.path(ref)) as img:
+            oversized = max(img.size) > SCREENSHOT_MAX_SIDE
+            # Con JPEG, draft decodifica directo a 1/2, 1/4 u 1/8 de la escala:
+            # nunca se arma el bitmap completo de una foto de 12 MP
+            side = SCREENSHOT_MAX_SIDE if oversized else THUMBNAIL_SIDE
+            img.draft("RGB", (side, side))
+            # thumbnail trabaja sobre la misma imagen (sin copy); reducing_gap
+            # hace primero un reduce() entero y después el filtro fino
+            if oversized:
+                img.thumbnail((SCREENSHOT_MAX_SIDE, SCREENSHOT_MAX_SIDE), reducing_gap=2.0)
+                img.save(store.path(ref))
+            img.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), reducing_gap=2.0)
+            # La conversión a RGB (para el JPEG) se hace ya en miniatura
+            thumb = img if img.mode == "RGB" else img.convert("RGB")
+            thumb.save(store.path(thumbnail_ref(ref)), "JPEG", quality=80)
+    except Exception as e:
+        print(f"⚠️ No se pudo reescalar el comprobante {ref}: {e}")
+
+# ==============================
+# MODELOS
+# ==============================
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
+    role = db.Column(db.String(20), default='trial') 
+    trial_uses_left = db.Column(db.Integer, default=2)
+    pro_until = db.Column(db.DateTime, nullable=True)
+    plan = db.Column(db.String(10))
+    last_payment_id = db.Column(db.String(100), index=True)  # lookup del webhook
+    library_version = db.Column(db.Integer, nullable=True)  # sube con cada cambio en la librería personal
+
+    def set_password(self, password):
+        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+class SharedSet(db.Model):
+    id = db.Column(db.String(10), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    setlist_json = db.Column(db.Text, nullable=False)
+    # Datos de los gráficos calculados al compartir (NULL en sets viejos)
+    analytics_json = db.Column(db.Text, nullable=True)
+    duration_hours = db.Column(db.Integer, default=1)  # sets viejos; los nuevos guardan duration_minutes
+    duration_minutes = db.Column(db.Integer, nullable=True)  # 90 = 1 h 30 (entero, sin perder la media hora)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    views = db.Column(db.Integer, default=0)
+    
+    def __repr__(self):
+        return f'<SharedSet {self.id}>'
+
+class SpotifyToken(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    token_json = db.Column(db.Text, nullable=False)  # token_info de spotipy (access + refresh)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SpotifyToken {self.user_id}>'
+
+class TrackPreview(db.Model):
+    """IDs de preview resueltos en runtime para un track del catálogo (no van al JSON)."""
+    track_key = db.Column(db.String(40), primary_key=True)  # dedupe_hash del track
+    spotify_id = db.Column(db.String(40), nullable=True)
+    youtube_id = db.Column(db.String(40), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<TrackPreview {self.track_key}>'
+
+class LibraryTrack(db.Model):
+    """Track de la librería personal de un usuario (ya validado y tipado)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    dedupe_key = db.Column(db.String(40), nullable=False)  # dedupe_hash: sha1 hex de artista + título normalizados
+    artist = db.Column(db.String(200), nullable=False)
+    track = db.Column(db.String(200), nullable=False)
+    bpm = db.Column(db.Float, nullable=False)
+    key = db.Column(db.String(3), nullable=False)
+    energy = db.Column(db.Integer, nullable=False)
+    stage = db.Column(db.String(20), nullable=True)
+    spotify_id = db.Column(db.String(40), nullable=True)
+    image = db.Column(db.String(500), nullable=True)
+    preview_url = db.Column(db.String(500), nullable=True)
+    added_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'dedupe_key', name='uq_library_track_user_id_dedupe_key'),
+    )
+    
+    def to_track(self):
+        bpm = int(self.bpm) if self.bpm.is_integer() else self.bpm
+        track = {"artist": self.artist, "track": self.track, "bpm": bpm, "key": self.key,
+                 "energy": self.energy, "stage": self.stage or "", "library_id": self.id}
+        for field in ("spotify_id", "image", "preview_url"):
+            value = getattr(self, field)
+            if value:
+                track[field] = value
+        return track
+    
+    def __repr__(self):
+        return f'<LibraryTrack {self.user_id} - {self.artist} - {self.track}>'
+
+class RecentSet(db.Model):
+    """Bloom filter con los tracks de un set generado (se guardan los últimos de cada usuario)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    track_count = db.Column(db.Integer, nullable=False)
+    bloom = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<RecentSet {self.id} user={self.user_id}>'
+
+class PaymentRequest(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    plan = db.Column(db.String(20), nullable=False)  # 'monthly' o 'annual'
+    amount_usdt = db.Column(db.Float, nullable=False)
+    tx_id = db.Column(db.String(200), nullable=True)
+    # Base64 de la imagen (solicitudes viejas): diferida, solo se lee desde /admin/screenshot/<id>
+    screenshot_data = db.deferred(db.Column(db.Text, nullable=True))
+    screenshot_path = db.Column(db.String(255), nullable=True)  # referencia en el file store
+    status = db.Column(db.String(20), default='pending')  # pending, approved, rejected
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+    
+    user = db.relationship('User', backref='payment_requests')
+    
+    # Saber si hay comprobante sin traer el blob
+    has_screenshot = db.column_property(db.or_(screenshot_data.expression.isnot(None), screenshot_path.isnot(None)))
+    
+    # Consultas del panel admin: pendientes por created_at, historial por processed_at
+    __table_args__ = (
+        db.Index('ix_payment_request_status_created_at', 'status', 'created_at'),
+        db.Index('ix_payment_request_status_processed_at', 'status', 'processed_at'),
+    )
+    
+    def __repr__(self):
+        return f'<PaymentRequest {self.id} - {self.user.email} - {self.plan}>'
+
+class WebhookEvent(db.Model):
+    """Inbox de notificaciones de MercadoPago: una fila por payment_id."""
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.String(100), unique=True, nullable=False)  # dedupe entre reintentos de MP
+    topic = db.Column(db.String(50), nullable=True)
+    payload = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, processing, done, skipped, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+    
+    # Los workers buscan eventos vencidos por estado y próximo intento
+    __table_args__ = (
+        db.Index('ix_webhook_event_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<WebhookEvent {self.payment_id} - {self.status}>'
+
+# ==============================
+# INICIALIZAR / MIGRAR DB (paso único por deploy: `flask --app app init-db`)
+# ==============================
+def replica_bind():
+    """bind_arguments para leer de la réplica (None sin DATABASE_REPLICA_URL: va a la primaria)."""
+    replica = db.engines.get("replica")
+    return {"bind": replica} if replica is not None else None
+
+def read_replica_first(stmt):
+    """Primera fila leída de la réplica; si todavía no llegó (lag), de la primaria."""
+    bind = replica_bind()
+    row = db.session.execute(stmt, bind_arguments=bind).first()
+    if row is None and bind:
+        row = db.session.execute(stmt).first()
+    return row
+
+def upgrade_schema():
+    """Crea tablas nuevas y agrega a las existentes las columnas e índices que falten.
+
+    Idempotente. Las columnas nuevas de tablas existentes tienen que ser nullable.
+    """
+    db.create_all()
+    engine = db.engine
+    inspector = db.inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            col_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(db.text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {col_type}"
+                ))
+            print(f"🛠️ Columna agregada: {table.name}.{column.name}")
+        existing_indexes = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+                print(f"🛠️ Índice creado: {index.name}")
+
+_SHA1_HEX_RE = re.compile(r"[0-9a-f]{40}")
+
+def rehash_library_keys():
+    """Pasa a sha1 hex las dedupe_key de librería guardadas en claro (idempotente).
+
+    Después achica la columna a VARCHAR(40) en las bases creadas cuando era
+    de 255 (SQLite no tiene ALTER COLUMN ni controla el largo: ahí no hace falta).
+    """
+    rows = db.session.execute(
+        db.select(LibraryTrack.id, LibraryTrack.dedupe_key).execution_options(yield_per=1000)
+    )
+    # Un largo de 40 no alcanza: solo un sha1 en hex (minúsculas) cuenta como migrado
+    legacy = [(row_id, key) for row_id, key in rows if not _SHA1_HEX_RE.fullmatch(key)]
+    for row_id, key in legacy:
+        # dedupe_hash(track) es el sha1 de dedupe_key(track): alcanza con la clave guardada
+        db.session.execute(
+            db.update(LibraryTrack).where(LibraryTrack.id == row_id)
+            .values(dedupe_key=hashlib.sha1(key.encode("utf-8")).hexdigest())
+        )
+    db.session.commit()
+    if legacy:
+        print(f"🛠️ Claves de librería migradas a hash: {len(legacy)}")
+
+    engine = db.engine
+    if engine.dialect.name == "sqlite":
+        return
+    column = next(c for c in db.inspect(engine).get_columns("library_track") if c["name"] == "dedupe_key")
+    if getattr(column["type"], "length", None) != 40:
+        with engine.begin() as conn:
+            conn.execute(db.text("ALTER TABLE library_track ALTER COLUMN dedupe_key TYPE VARCHAR(40)"))
+        print("🛠️ Columna achicada: library_track.dedupe_key -> VARCHAR(40)")
+
+def bootstrap_db():
+    """Crea/migra las tablas y el usuario owner si no existe."""
+    upgrade_schema()
+    rehash_library_keys()
+    print("✅ Base de datos inicializada correctamente")
+    print("📍 Ubicación:", db.engine.url)
+    
+    owner_email = os.getenv('OWNER_EMAIL', 'elidj269@gmail.com')
+    owner_password = os.getenv('OWNER_PASSWORD', 'password_default')
+    
+    existing_owner = User.query.filter_by(email=owner_email).first()
+    
+    if not existing_owner:
+        owner = User(email=owner_email, role='owner')
+        owner.set_password(owner_password)
+        owner.pro_until = datetime.utcnow() + timedelta(days=3650)
+        owner.plan = 'lifetime'
+        db.session.add(owner)
+        db.session.commit()
+        print(f"✅ Usuario owner {owner_email} creado")
+    else:
+        print(f"✅ Usuario owner ya existe")
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """Crea o migra el esquema y el usuario owner (correr en cada deploy)."""
+    bootstrap_db()
+
+# ==============================
+# USUARIO LOGUEADO (CACHÉ + SESIÓN FIRMADA)
+# ==============================
+# Casi todos los requests autenticados solo necesitan leer el usuario. Se
+# guarda una foto (rol, pruebas, plan, library_version) en la cookie de
+# sesión firmada y en un caché por proceso, las dos por USER_CACHE_TTL
+# segundos, y current_user se arma desde la más nueva sin tocar la DB. Los
+# cambios del propio usuario (usar una prueba, tocar la librería) actualizan
+# la foto en el momento; los de otros (pagos, webhook, cambios de rol) la
+# invalidan en este proceso y el resto de los workers los ven al vencer el TTL.
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE = TTLCache(ttl=USER_CACHE_TTL, maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")))
+# user_id -> momento de la última invalidación; fotos anteriores no sirven
+USER_FORGOTTEN = TTLCache(ttl=USER_CACHE_TTL, maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")))
+USER_SESSION_KEY = "_user_snapshot"
+
+def effective_role(role, pro_until):
+    """Un owner con el PRO vencido cuenta como trial (sin escribir en la DB)."""
+    if role == 'owner' and pro_until and datetime.utcnow() > pro_until:
+        return 'trial'
+    return role
+
+def user_snapshot(user):
+    """Foto serializable (va en la cookie de sesión) de un User de la DB."""
+    return {
+        "id": user.id,
+        "email": user.email,
+        "role": user.role,
+        "trial_uses_left": user.trial_uses_left,
+        "pro_until": user.pro_until.isoformat() if user.pro_until else None,
+        "plan": user.plan,
+        "library_version": user.library_version,
+        "at": time.time(),
+    }
+
+class SessionUser(UserMixin):
+    """current_user armado desde una foto, sin sesión de SQLAlchemy atrás.
+
+    Es de solo lectura: los cambios van a la DB (UPDATE sobre User) y
+    después update_current_user o forget_user.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.id = snapshot["id"]
+        self.email = snapshot["email"]
+        self.trial_uses_left = snapshot["trial_uses_left"]
+        self.plan = snapshot["plan"]
+        self.library_version = snapshot["library_version"]
+        self.pro_until = datetime.fromisoformat(snapshot["pro_until"]) if snapshot["pro_until"] else None
+        self.role = effective_role(snapshot["role"], self.pro_until)
+
+@login_manager.user_loader
+def load_user(user_id):
+    """Usa la foto más nueva (caché del proceso o sesión); la DB solo si las dos vencieron."""
+    user_id = int(user_id)
+    now = time.time()
+    cached = USER_CACHE.get(user_id)
+    not_before = USER_FORGOTTEN.get(user_id, 0)
+    fresh = [
+        snapshot for snapshot in (cached, session.get(USER_SESSION_KEY))
+        if snapshot and snapshot.get("id") == user_id and snapshot["at"] > max(not_before, now - USER_CACHE_TTL)
+    ]
+    if fresh:
+        snapshot = max(fresh, key=itemgetter("at"))
+    else:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = user_snapshot(user)
+        session[USER_SESSION_KEY] = snapshot
+    if snapshot is not cached:
+        USER_CACHE.set(user_id, snapshot, ttl=USER_CACHE_TTL - (now - snapshot["at"]))
+    return SessionUser(snapshot)
+
+def remember_user(user):
+    """Foto recién leída de la DB para el usuario del request (login, cambios propios)."""
+    snapshot = user_snapshot(user)
+    USER_CACHE.set(user.id, snapshot)
+    session[USER_SESSION_KEY] = snapshot
+
+def update_current_user(**changes):
+    """Después de un UPDATE del propio usuario: foto nueva en el caché y en su sesión."""
+    snapshot = dict(current_user.snapshot, **changes, at=time.time())
+    USER_CACHE.set(snapshot["id"], snapshot)
+    session[USER_SESSION_KEY] = snapshot
+
+def forget_user(user_id):
+    """Después de cambiarle el rol/plan a otro usuario: este proceso lo relee de la DB."""
+    USER_CACHE.pop(user_id)
+    USER_FORGOTTEN.set(user_id, time.time())
+
+def check_pro(user):
+    """PRO activo. No escribe: el vencimiento se resuelve al leer (effective_role)."""
+    return effective_role(user.role, user.pro_until) == 'owner'
+
+def new_cattaneo_state():
+    """Estado de variedad armónica de una generación: cada set arranca con uno propio."""
+    return {
+        "rep_count": 0, 
+        "last_phase": "",
+        "tracks_since_fifth": 0,
+        "fifth_count": 0,
+        "last_two_keys": [],
+        "switch_pair": None,
+        "switch_pair_count": 0
+    }
+
+CATEGORY_MAP = {
+    "warm-up": "warmup",
+    "building": "build",
+    "mid-peak": ["mid_peak", "midpeaks"],
+    "peak time": "peaktime",
+    "driving": "driving",
+    "closing": "closing"
+}
+
+ENERGY_RANGES_PRO = {
+    "warmup": {
+        "bpm": (115, 120), 
+        "keys": ["1A","2A","3A","4A","5A","6A","7A","8A","12A"],
+        "energy": (1, 4)
+    },
+    "build": {
+        "bpm": (118, 122), 
+        "keys": ["5A","6A","7A","8A","9A","10A","11A","12A","7B","8B","9B"],
+        "energy": (4, 6)
+    },
+    "mid_peak": {
+        "bpm": (121, 123), 
+        "keys": ["8A","9A","10A","11A","12A","1A","2A","8B","9B","10B","11B","12B","1B"],
+        "energy": (6, 8)
+    },
+    "peak_time": {
+        "bpm": (123, 125), 
+        "keys": ["11A","12A","1A","2A","3A","11B","12B","1B","2B","3B"],
+        "energy": (7, 9)
+    },
+    "driving": {
+        "bpm": (124, 126), 
+        "keys": ["12B","1B","2B","3B","4B","12A","1A","2A","3A"],
+        "energy": (8, 10)
+    },
+    "closing": {
+        "bpm": (120, 124), 
+        "keys": ["10B", "11B", "12B", "1B", "2B", "3B", "7A", "8B", "9B"],
+        "energy": (4, 7),
+        "bpm_step_max": 4
+    }
+}
+
+MUSICAL_TO_CAMELOT = {
+    "C Minor": "5A", "G Minor": "6A", "D Minor": "7A", "A Minor": "8A",
+    "E Minor": "9A", "B Minor": "10A", "F# Minor": "11A", "Gb Minor": "11A",
+    "C# Minor": "12A", "Db Minor": "12A", "Ab Minor": "1A", "G# Minor": "1A",
+    "Eb Minor": "2A", "D# Minor": "2A", "Bb Minor": "3A", "A# Minor": "3A",
+    "F Minor": "4A", "C Major": "8B", "G Major": "9B", "D Major": "10B", 
+    "A Major": "11B", "E Major": "12B", "B Major": "1B", "F# Major": "2B", 
+    "Gb Major": "2B", "Db Major": "3B", "C# Major": "3B", "Ab Major": "4B", 
+    "G# Major": "4B", "Eb Major": "5B", "D# Major": "5B", "Bb Major": "6B", 
+    "A# Major": "6B", "F Major": "7B"
+}
+
+# ==============================
+# PLAN DE FASES (DURACIÓN ARBITRARIA)
+# ==============================
+# La secuencia de fases se calcula a partir de la duración del set: cuántos
+# tracks entran (según el largo estimado de cada track y cuánto se toca) y qué
+# proporción va a cada fase. Los dos perfiles salen de los planes que antes
+# estaban escritos a mano para 1 y 5 horas; en el medio se interpola y para
+# sets más largos se usa el perfil largo.
+PHASE_ORDER = ["warmup", "build", "mid_peak", "peak_time", "driving", "closing"]
+PHASE_PROFILE_SHORT = {"warmup": 0.19, "build": 0.27, "mid_peak": 0.35, "peak_time": 0.08, "driving": 0.0, "closing": 0.08}
+PHASE_PROFILE_LONG = {"warmup": 0.20, "build": 0.23, "mid_peak": 0.25, "peak_time": 0.14, "driving": 0.11, "closing": 0.07}
+# Fases que siempre tienen al menos un slot
+PHASE_MIN_SLOTS = {"warmup": 1, "build": 1, "mid_peak": 1, "peak_time": 1, "closing": 1}
+# Cada variante corre un poco las proporciones de las fases largas (como los 4 planes viejos)
+PHASE_PLAN_VARIANTS = 4
+PHASE_JITTER = {"warmup": 0.15, "build": 0.15, "mid_peak": 0.12}
+
+DEFAULT_TRACK_MINUTES = 7.5  # largo típico de un extended mix, si el catálogo no trae duraciones
+MIN_SET_MINUTES = 30
+MAX_SET_MINUTES = 24 * 60
+
+def played_fraction(minutes):
+    """Qué parte de cada track suena: ~60% en sets de 1 hora, ~90% en maratones."""
+    return 0.6 + 0.3 * (1 - math.exp(-max(minutes / 60 - 1, 0) / 1.5))
+
+def phase_profile(minutes):
+    """Proporción de slots por fase para la duración (interpolada entre 1 y 5 horas)."""
+    t = min(max((minutes / 60 - 1) / 4, 0.0), 1.0)
+    return {p: PHASE_PROFILE_SHORT[p] + (PHASE_PROFILE_LONG[p] - PHASE_PROFILE_SHORT[p]) * t for p in PHASE_ORDER}
+
+def allocate_slots(total, weights):
+    """Reparte `total` slots según los pesos (mayor resto), respetando PHASE_MIN_SLOTS."""
+    weight_sum = sum(weights.values())
+    quotas = {p: w / weight_sum * total for p, w in weights.items()}
+    counts = {p: max(PHASE_MIN_SLOTS.get(p, 0), int(q)) for p, q in quotas.items()}
+    diff = total - sum(counts.values())
+    while diff > 0:
+        phase = max(counts, key=lambda p: quotas[p] - counts[p])
+        counts[phase] += 1
+        diff -= 1
+    while diff < 0:
+        removable = [p for p in counts if counts[p] > PHASE_MIN_SLOTS.get(p, 0)]
+        phase = max(removable, key=lambda p: counts[p] - quotas[p])
+        counts[phase] -= 1
+        diff += 1
+    return counts
+
+@functools.lru_cache(maxsize=1024)
+def phase_plan(minutes, variant=0, track_minutes=DEFAULT_TRACK_MINUTES):
+    """Secuencia de fases (tupla, un elemento por slot) para un set de `minutes`.
+
+    Memoizada por (duración, variante, largo de track): se calcula una vez y
+    después es un lookup, también para maratones de cientos de slots.
+    """
+    slot_minutes = track_minutes * played_fraction(minutes)
+    total = max(len(PHASE_MIN_SLOTS), round(minutes / slot_minutes))
+    weights = phase_profile(minutes)
+    if variant:
+        rng = random.Random(f"{minutes}:{variant}")
+        weights = {p: w * (1 + rng.uniform(-PHASE_JITTER.get(p, 0), PHASE_JITTER.get(p, 0)))
+                   for p, w in weights.items()}
+    counts = allocate_slots(total, weights)
+    return tuple(p for p in PHASE_ORDER for _ in range(counts[p]))
+
+def catalog_track_minutes(catalog):
+    """Largo mediano de los tracks del catálogo en minutos (o el default si no hay datos)."""
+    def build(c):
+        durations = sorted(d for d in map(track_duration_seconds, c.tracks) if d)
+        if len(durations) < 20:
+            return DEFAULT_TRACK_MINUTES
+        return round(durations[len(durations) // 2] / 60, 1)
+    return catalog.derived("track_minutes", build)
+
+def pick_phase_plan(minutes, catalog):
+    """Una de las variantes del plan para la duración, al azar."""
+    return phase_plan(minutes, random.randrange(PHASE_PLAN_VARIANTS), catalog_track_minutes(catalog))
+
+class SetDurationError(ValueError):
+    """Duración pedida que no es un número finito (responde 400)."""
+
+def parse_set_minutes(data):
+    """Duración pedida en minutos (`minutes`, o `hours` con decimales), acotada.
+
+    Sin duración, 1 hora. Texto, "nan" o "inf" levantan SetDurationError.
+    """
+    try:
+        minutes = float(data["minutes"]) if data.get("minutes") else float(data.get("hours") or 1) * 60
+    except (TypeError, ValueError):
+        raise SetDurationError("Duración inválida")
+    if not math.isfinite(minutes):
+        raise SetDurationError("Duración inválida")
+    return int(min(max(round(minutes), MIN_SET_MINUTES), MAX_SET_MINUTES))
+
+
+def normalize_key(key_str):
+    if not key_str: return key_str
+    key_str = key_str.strip()
+    if len(key_str) >= 2 and key_str[:-1].isdigit() and key_str[-1] in ["A","B"]: return key_str
+    return MUSICAL_TO_CAMELOT.get(key_str, key_str)
+
+# ==============================
+# CATÁLOGO (SNAPSHOT + ÍNDICES)
+# ==============================
+CATALOG_PATH = os.path.join("data", "tracks.json")
+
+# Stages alternativos que se indexan también bajo el nombre canónico
+STAGE_ALIASES = {"midpeaks": "mid_peak"}
+
+class Catalog:
+    """Snapshot del catálogo con sus índices precalculados.
+
+    Se construye una vez por versión y no se muta después: las fases,
+    el texto de búsqueda y los valores numéricos ya quedan resueltos.
+    Con `graph` (TransitionGraph leído de disco) no se reevalúan las fases.
+    """
+
+    def __init__(self, tracks, version=1, graph=None):
+        self.tracks = tracks
+        self.version = version
+        self.mtime = None
+        # Estructuras derivadas (cachés) atadas a esta versión del catálogo
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+        self.by_name = {}
+        self.by_stage = {}  # stage en minúsculas -> índices en self.tracks
+        self.search_text = []
+
+        for i, t in enumerate(tracks):
+            t["key"] = normalize_key(t.get("key"))
+            self.by_name.setdefault(t.get("track"), t)
+            stage = t.get("stage", "").lower()
+            self.by_stage.setdefault(stage, []).append(i)
+            if stage in STAGE_ALIASES:
+                self.by_stage.setdefault(STAGE_ALIASES[stage], []).append(i)
+            self.search_text.append(f"{t.get('artist','')} {t.get('track','')}".lower())
+        self.graph = graph or TransitionGraph.build(tracks)
+        # fase -> (candidatos estrictos, candidatos con margen)
+        self.phase_pools = phase_pools_from_graph(tracks, self.graph)
+
+    def phase_pool(self, phase, attempt=1):
+        """Tracks válidos para la fase (attempt > 1 usa los márgenes relajados)."""
+        pools = self.phase_pools.get(phase)
+        if pools is None:
+            return self.tracks
+        return pools[1] if attempt > 1 else pools[0]
+
+    def derived(self, name, builder):
+        """Estructura derivada memoizada por versión: se descarta junto con el snapshot."""
+        value = self._derived.get(name)
+        if value is None:
+            with self._derived_lock:
+                value = self._derived.get(name)
+                if value is None:
+                    value = builder(self)
+                    self._derived[name] = value
+        return value
+
+    def find(self, artist, track_name):
+        """Busca un track exacto por artista y nombre."""
+        t = self.by_name.get(track_name)
+        if t is not None and t.get("artist") == artist:
+            return t
+        for t in self.tracks:
+            if t.get("artist") == artist and t.get("track") == track_name:
+                return t
+        return None
+
+def phase_pools_from_graph(tracks, graph):
+    """fase -> (pool estricto, pool con margen) como listas de tracks."""
+    return {phase: ([tracks[i] for i in graph.pool(phase)], [tracks[i] for i in graph.pool(phase, attempt=2)])
+            for phase in ENERGY_RANGES_PRO}
+
+_catalog = None
+_catalog_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_catalog_checked_at = 0.0
+
+# Cada cuántos segundos se mira el mtime de tracks.json (0 = desactivado)
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "10"))
+
+def catalog_mtime(path=CATALOG_PATH):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def read_catalog_file(path=CATALOG_PATH):
+    """Lee el JSON del catálogo (lista de tracks o {"tracks": [...]})."""
+    if not os.path.exists(path): return []
+    if orjson is not None:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    return data if isinstance(data, list) else data.get("tracks", [])
+
+def _build_catalog(version):
+    mtime = catalog_mtime()
+    tracks = read_catalog_file()
+    graph = load_transition_graph(mtime, len(tracks))
+    catalog = Catalog(tracks, version=version, graph=graph)
+    catalog.mtime = mtime
+    if graph is None and mtime is not None:
+        save_transition_graph(catalog.graph, mtime)
+    # El índice de similares se arma acá (warmup / reload en segundo plano), no en un request
+    get_similarity_index(catalog)
+    return catalog
+
+def reload_catalog():
+    """Construye la versión nueva del catálogo y la publica con un swap atómico.
+
+    Los requests en curso siguen usando el snapshot que ya tomaron (RCU):
+    nadie muta el catálogo viejo, simplemente deja de estar referenciado.
+    """
+    global _catalog
+    if not _reload_lock.acquire(blocking=False):
+        return None  # ya hay un reload en curso
+    try:
+        previous = _catalog
+        new_catalog = _build_catalog((previous.version if previous else 0) + 1)
+        _catalog = new_catalog
+        print(f"🔄 Catálogo v{new_catalog.version}: {len(new_catalog.tracks)} tracks, "
+              f"grafo {new_catalog.graph.nbytes // 1024} KB (pid {os.getpid()})")
+        return new_catalog
+    finally:
+        _reload_lock.release()
+
+def reload_catalog_async():
+    """Dispara reload_catalog en un thread de fondo."""
+    threading.Thread(target=reload_catalog, name="catalog-reload", daemon=True).start()
+
+def _maybe_reload(catalog):
+    """Si tracks.json cambió en disco, recarga en segundo plano."""
+    global _catalog_checked_at
+    if CATALOG_CHECK_INTERVAL <= 0:
+        return
+    now = time.monotonic()
+    if now - _catalog_checked_at < CATALOG_CHECK_INTERVAL:
+        return
+    _catalog_checked_at = now
+    if catalog_mtime() != catalog.mtime and not _reload_lock.locked():
+        reload_catalog_async()
+
+def get_catalog():
+    """Snapshot actual del catálogo; lo construye en el primer uso si nadie hizo warmup."""
+    global _catalog
+    catalog = _catalog
+    if catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                started = time.perf_counter()
+                _catalog = _build_catalog(1)
+                mark_ready(_catalog, started)
+            catalog = _catalog
+    else:
+        _maybe_reload(catalog)
+    return catalog
+
+def load_tracks():
+    return get_catalog().tracks
+
+# IDs de preview que encuentra el resolver: van a la tabla track_preview y se
+# mezclan al leer. tracks.json solo se reescribe con ingest-catalog (y el
+# reload lo toma por mtime); el snapshot vigente nunca se muta.
+PREVIEW_IDS_CACHE = TTLCache(ttl=600, maxsize=50000)
+PREVIEW_IDS_MISS_TTL = 60  # "sin IDs guardados" se recuerda menos: otro worker puede resolverlo
+
+def preview_ids(artist, track_name):
+    """{"spotify_id": ..., "youtube_id": ...} guardados para el track (solo los que hay)."""
+    key = dedupe_hash({"artist": artist, "track": track_name})
+    ids = PREVIEW_IDS_CACHE.get(key)
+    if ids is None:
+        row = db.session.get(TrackPreview, key)
+        ids = {}
+        if row is not None:
+            ids = {field: getattr(row, field) for field in ("spotify_id", "youtube_id") if getattr(row, field)}
+        PREVIEW_IDS_CACHE.set(key, ids, ttl=None if ids else PREVIEW_IDS_MISS_TTL)
+    return ids
+
+def store_preview_id(app, artist, track_name, kind, found_id):
+    """Guarda (upsert) el ID que resolvió el proveedor `kind` para el track."""
+    key = dedupe_hash({"artist": artist, "track": track_name})
+    field = f"{kind}_id"
+    with app.app_context():
+        updated = db.session.execute(
+            db.update(TrackPreview).where(TrackPreview.track_key == key)
+            .values({field: found_id, "updated_at": datetime.utcnow()})
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            db.session.add(TrackPreview(track_key=key, **{field: found_id}))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Otro worker insertó la fila entre el UPDATE y el INSERT
+            db.session.rollback()
+            db.session.execute(
+                db.update(TrackPreview).where(TrackPreview.track_key == key).values({field: found_id})
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+    PREVIEW_IDS_CACHE.pop(key)
+
+# ==============================
+# INGESTA DE CATÁLOGO (CLI)
+# ==============================
+# `flask --app app ingest-catalog biblioteca.xml export.csv ...` lee librerías
+# grandes en streaming (JSON/JSONL por objeto, CSV por fila, Rekordbox XML con
+# iterparse), valida y convierte bpm/energy/key una sola vez, descarta o
+# reporta filas rotas, deduplica por artista+título normalizados y escribe
+# el catálogo ya tipado que carga la app (bpm y energy numéricos, key Camelot).
+INGEST_CHUNK_SIZE = 1 << 16
+INGEST_BPM_RANGE = (60, 200)
+INGEST_DEFAULT_ENERGY = 5  # mismo default que usaba is_track_valid_for_phase
+# Campos opcionales que se conservan tal cual
+INGEST_PASSTHROUGH_FIELDS = ("spotify_id", "youtube_id", "image", "preview_url")
+
+# Nombres de columna aceptados en CSV (en minúsculas) -> campo del catálogo
+INGEST_COLUMN_ALIASES = {
+    "artist": "artist", "artista": "artist",
+    "track": "track", "title": "track", "name": "track", "track title": "track", "titulo": "track",
+    "bpm": "bpm", "tempo": "bpm", "averagebpm": "bpm",
+    "key": "key", "camelot": "key", "tonality": "key", "musical key": "key",
+    "energy": "energy", "energia": "energy", "energía": "energy",
+    "stage": "stage", "phase": "stage", "fase": "stage",
+    "duration": "duration", "length": "duration", "time": "duration", "totaltime": "duration",
+    "duration_ms": "duration_ms",
+    "comments": "comments", "comment": "comments",
+    "spotify_id": "spotify_id", "youtube_id": "youtube_id", "image": "image", "preview_url": "preview_url",
+}
+
+NOTE_PITCHES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+_SHORT_KEY_RE = re.compile(r"^([A-Ga-g])\s*([#b♯♭]?)\s*(m|min|minor|maj|major)?$", re.IGNORECASE)
+_ENERGY_COMMENT_RE = re.compile(r"energy\s*[:=-]?\s*(\d{1,2})", re.IGNORECASE)
+# Caracteres que importan para delimitar un elemento JSON sin parsearlo
+_JSON_STRUCTURE_RE = re.compile(r'["\\{}\[\],]')
+INGEST_MAX_ROW_CHARS = 1 << 20  # una fila sin cerrar más larga que esto corta la ingesta
+
+class IngestError(ValueError):
+    """Fila que no se puede convertir en un track válido."""
+
+def parse_camelot_key(value):
+    """Key en cualquier notación común ('8A', '08A', 'A Minor', 'Am', 'F#m', 'Eb') -> Camelot."""
+    if value is None:
+        raise IngestError("sin key")
+    text = str(value).strip()
+    if not text:
+        raise IngestError("sin key")
+    camelot = normalize_key(text)
+    if camelot_to_pitch(camelot) is not None:
+        return f"{int(camelot[:-1])}{camelot[-1].upper()}"  # '08a' -> '8A'
+    match = _SHORT_KEY_RE.match(text)
+    if not match:
+        raise IngestError(f"key inválida: {text!r}")
+    note, accidental, mode = match.groups()
+    pitch = NOTE_PITCHES[note.upper()] + {"#": 1, "♯": 1, "b": -1, "♭": -1}.get(accidental, 0)
+    minor = (mode or "").lower() in ("m", "min", "minor")
+    return PITCH_TO_CAMELOT[(pitch % 12, minor)]
+
+def coerce_track(raw):
+    """Valida y tipa un track crudo. Lanza IngestError si no sirve."""
+    artist = str(raw.get("artist") or "").strip()
+    title = str(raw.get("track") or "").strip()
+    if not artist or not title:
+        raise IngestError("sin artista o título")
+    try:
+        bpm = float(str(raw.get("bpm")).replace(",", "."))
+    except (TypeError, ValueError):
+        raise IngestError(f"bpm inválido: {raw.get('bpm')!r}")
+    if not INGEST_BPM_RANGE[0] <= bpm <= INGEST_BPM_RANGE[1]:
+        raise IngestError(f"bpm fuera de rango: {bpm}")
+    bpm = int(bpm) if bpm.is_integer() else round(bpm, 2)
+    key = parse_camelot_key(raw.get("key"))
+
+    energy = raw.get("energy")
+    if energy in (None, "") and raw.get("comments"):
+        match = _ENERGY_COMMENT_RE.search(str(raw["comments"]))
+        energy = match.group(1) if match else None
+    if energy in (None, ""):
+        energy = INGEST_DEFAULT_ENERGY
+    try:
+        energy = int(float(energy))
+    except (TypeError, ValueError):
+        raise IngestError(f"energy inválida: {energy!r}")
+    if not 1 <= energy <= 10:
+        raise IngestError(f"energy fuera de rango: {energy}")
+
+    track = {"artist": artist, "track": title, "bpm": bpm, "key": key, "energy": energy}
+    stage = str(raw.get("stage") or "").strip().lower()
+    stage = STAGE_ALIASES.get(stage, stage)
+    if not stage:
+        # Sin stage: la primera fase cuyas reglas estrictas acepta el track
+        stage = next((p for p in PHASE_ORDER if is_track_valid_for_phase(track, p)), "")
+    track["stage"] = stage
+    duration = track_duration_seconds(raw)
+    if duration:
+        track["duration"] = duration
+    for field in INGEST_PASSTHROUGH_FIELDS:
+        if raw.get(field):
+            track[field] = raw[field]
+    return track
+
+def dedupe_key(track):
+    """Artista + título normalizados (sin acentos, mayúsculas ni puntuación)."""
+    text = unicodedata.normalize("NFKD", f"{track['artist']}\x00{track['track']}").casefold()
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"[^\w\x00]+", " ", text).strip()
+
+def dedupe_hash(track):
+    """dedupe_key de largo fijo (sha1 hex) para usar como clave en la DB."""
+    return hashlib.sha1(dedupe_key(track).encode("utf-8")).hexdigest()
+
+def json_element_end(buf, pos):
+    """Índice donde termina el elemento JSON que empieza en buf[pos], o None si el buffer corta antes.
+
+    Cuenta llaves y corchetes fuera de los strings (respetando escapes); no
+    valida el contenido, así que sirve para saltear un elemento roto.
+    """
+    depth = 0
+    in_string = False
+    escaped_at = -1  # posición del caracter que sigue a una barra invertida
+    for match in _JSON_STRUCTURE_RE.finditer(buf, pos):
+        c, i = match.group(), match.start()
+        if in_string:
+            if i == escaped_at:
+                continue
+            if c == "\\":
+                escaped_at = i + 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            if depth == 0:
+                return i  # cierre del array: el elemento (escalar suelto) termina acá
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        elif c == "," and depth == 0:
+            return i
+    return None
+
+def iter_json_array(f, chunk_size=INGEST_CHUNK_SIZE):
+    """Objetos de un array JSON grande (lista suelta o {"tracks": [...]}) de a uno.
+
+    Un objeto mal formado sale como IngestError (fila descartada) y la
+    lectura sigue desde el objeto siguiente.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos = "", 0
+    while True:  # hasta el primer '['
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+        start = buf.find("[")
+        if start != -1:
+            pos = start + 1
+            break
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buf):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf, pos = chunk, 0
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            # Roto o solo incompleto (el chunk cortó a mitad del objeto): si el
+            # elemento todavía no cierra en el buffer, hay que leer más
+            end = json_element_end(buf, pos)
+            if end is None:
+                if len(buf) - pos > INGEST_MAX_ROW_CHARS:
+                    raise IngestError(f"JSON inválido: un elemento pasa los {INGEST_MAX_ROW_CHARS} caracteres sin cerrar")
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    # Sin más datos no se sabe dónde seguía: mejor cortar que perder filas
+                    raise IngestError(f"JSON inválido: el archivo termina a mitad de un elemento ({e.msg})")
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            # El elemento está completo y aun así no decodifica: se descarta entero
+            yield IngestError(f"JSON inválido: {e.msg}")
+            end = max(end, pos + 1)
+        else:
+            yield obj
+        pos = end
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+def iter_json_lines(f):
+    """Un objeto por línea; una línea mal formada sale como IngestError."""
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield IngestError(f"JSON inválido: {e.msg} (columna {e.colno})")
+
+def iter_csv_rows(f):
+    reader = csv.DictReader(f)
+    columns = {name: INGEST_COLUMN_ALIASES.get(name.strip().lower()) for name in reader.fieldnames or []}
+    for row in reader:
+        yield {columns[k]: v for k, v in row.items() if columns.get(k)}
+
+def iter_rekordbox_tracks(path):
+    """TRACKs de la COLLECTION de un XML de Rekordbox, con memoria constante."""
+    from xml.etree.ElementTree import iterparse
+    collection = None
+    for event, elem in iterparse(path, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "COLLECTION":
+                collection = elem
+            continue
+        if elem.tag == "TRACK" and collection is not None and elem.get("Name") is not None:
+            attrs = elem.attrib
+            yield {
+                "artist": attrs.get("Artist"), "track": attrs.get("Name"), "bpm": attrs.get("AverageBpm"),
+                "key": attrs.get("Tonality"), "duration": attrs.get("TotalTime"), "comments": attrs.get("Comments"),
+            }
+            collection.clear()  # los TRACK ya procesados no se acumulan
+        elif elem.tag == "COLLECTION":
+            collection = None
+
+def detect_ingest_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    return {".json": "json", ".jsonl": "jsonl", ".ndjson": "jsonl", ".csv": "csv",
+            ".xml": "rekordbox"}.get(ext)
+
+def iter_ingest_source(path, fmt):
+    """Filas crudas (dicts) del archivo según el formato."""
+    if fmt == "rekordbox":
+        yield from iter_rekordbox_tracks(path)
+        return
+    with open(path, "r", encoding="utf-8-sig", newline="" if fmt == "csv" else None) as f:
+        if fmt == "json":
+            yield from iter_json_array(f)
+        elif fmt == "jsonl":
+            yield from iter_json_lines(f)
+        else:
+            yield from iter_csv_rows(f)
+
+def ingest_catalog(sources, output=CATALOG_PATH, report=None, dry_run=False):
+    """Compila las fuentes en un catálogo tipado; devuelve las estadísticas.
+
+    Escribe a un temporal y lo publica con os.replace: los workers lo
+    levantan con el hot reload por mtime. Solo se guarda en memoria la
+    clave de deduplicación de cada track.
+    """
+    stats = {"read": 0, "written": 0, "duplicates": 0, "rejected": 0}
+    seen = set()
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    out = None if dry_run else open(tmp_path, "w", encoding="utf-8")
+    try:
+        if out:
+            out.write("[")
+        for path, fmt in sources:
+            for index, raw in enumerate(iter_ingest_source(path, fmt), 1):
+                stats["read"] += 1
+                try:
+                    if isinstance(raw, IngestError):
+                        raise raw  # fila que ni siquiera se pudo parsear
+                    if not isinstance(raw, dict):
+                        raise IngestError("no es un objeto")
+                    track = coerce_track(raw)
+                except IngestError as e:
+                    stats["rejected"] += 1
+                    if report:
+                        rejected = {"source": path, "row": index, "error": str(e)}
+                        if raw is not e:
+                            rejected["raw"] = raw
+                        report.write(json.dumps(rejected, ensure_ascii=False, default=str) + "\n")
+                    continue
+                key = dedupe_key(track)
+                if key in seen:
+                    stats["duplicates"] += 1
+                    continue
+                seen.add(key)
+                if out:
+                    out.write(",\n" if stats["written"] else "\n")
+                    out.write(json.dumps(track, ensure_ascii=False))
+                stats["written"] += 1
+        if out:
+            out.write("\n]\n")
+            out.close()
+            os.replace(tmp_path, output)
+    finally:
+        if out and not out.closed:
+            out.close()
+            os.remove(tmp_path)
+    return stats
+
+@click.command("ingest-catalog")
+@click.argument("sources", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["auto", "json", "jsonl", "csv", "rekordbox"]), default="auto",
+              help="Formato de las fuentes (auto = por extensión).")
+@click.option("--output", default=CATALOG_PATH, show_default=True, help="Catálogo a generar.")
+@click.option("--report", type=click.File("w", encoding="utf-8"), help="JSONL con las filas descartadas.")
+@click.option("--dry-run", is_flag=True, help="Solo validar y contar, sin escribir el catálogo.")
+def ingest_catalog_command(sources, fmt, output, report, dry_run):
+    """Compila librerías (JSON, JSONL, CSV, Rekordbox XML) al catálogo tipado."""
+    resolved = []
+    for path in sources:
+        source_fmt = detect_ingest_format(path) if fmt == "auto" else fmt
+        if source_fmt is None:
+            raise click.UsageError(f"No se reconoce el formato de {path}; usar --format")
+        resolved.append((path, source_fmt))
+    started = time.perf_counter()
+    try:
+        stats = ingest_catalog(resolved, output=output, report=report, dry_run=dry_run)
+    except IngestError as e:
+        # Fuente ilegible de ahí en adelante: el catálogo anterior queda como estaba
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - started
+    print(f"✅ {stats['written']} tracks {'válidos' if dry_run else 'escritos en ' + output} "
+          f"({stats['read']} leídos, {stats['duplicates']} duplicados, {stats['rejected']} descartados) "
+          f"en {elapsed:.1f} s")
+
+# ==============================
+# WARMUP / READINESS
+# ==============================
+READY = threading.Event()
+_warmup_lock = threading.Lock()
+_warmup_started = threading.Event()
+
+def mark_ready(catalog, started):
+    """Primer catálogo armado en el proceso (warmup o primer uso): habilita /readyz."""
+    BOOT_STATS["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    BOOT_STATS["tracks"] = len(catalog.tracks)
+    BOOT_STATS["graph_bytes"] = catalog.graph.nbytes
+    READY.set()
+    print(f"🔥 Warmup listo: {len(catalog.tracks)} tracks en {BOOT_STATS['warmup_ms']} ms (pid {os.getpid()})")
+
+def warmup():
+    """Carga el catálogo y arma índices antes de aceptar tráfico (idempotente)."""
+    get_catalog()
+
+def warmup_async():
+    """Dispara el warmup en segundo plano (una sola vez por proceso)."""
+    with _warmup_lock:
+        if READY.is_set() or _warmup_started.is_set():
+            return
+        _warmup_started.set()
+    threading.Thread(target=warmup, name="catalog-warmup", daemon=True).start()
+
+# ==============================
+# RESPUESTAS DE TRACKS (PROYECCIÓN + FRAGMENTOS)
+# ==============================
+# Campos que viajan al cliente: lo que renderiza más lo que el front devuelve
+# después (change_track, generate_locked, share, export). Con ?fields=a,b se
+# pide un subconjunto.
+TRACK_FIELDS = ("artist", "track", "bpm", "key", "energy", "stage", "spotify_id", "youtube_id",
+                "image", "preview_url", "duration_ms", "duration", "isLocked")
+
+def requested_track_fields():
+    """Campos pedidos con ?fields= (solo de TRACK_FIELDS); por defecto todos."""
+    raw = request.args.get("fields")
+    if not raw:
+        return TRACK_FIELDS
+    wanted = {f.strip() for f in raw.split(",")}
+    return tuple(f for f in TRACK_FIELDS if f in wanted) or TRACK_FIELDS
+
+def project_track(track, fields=TRACK_FIELDS):
+    return {f: track[f] for f in fields if f in track}
+
+def project_tracks(tracks, fields=TRACK_FIELDS):
+    """Proyecta la lista; los tracks que no tienen campos de más se pasan tal cual."""
+    allowed = frozenset(fields)
+    return [t if t.keys() <= allowed else project_track(t, fields) for t in tracks]
+
+# Tope de fragmentos por versión del catálogo (incluye tracks que manda el cliente)
+TRACK_FRAGMENTS_MAX = 200000
+
+def encode_tracks(tracks, fields=TRACK_FIELDS, catalog=None):
+    """Lista de tracks proyectada y serializada a bytes JSON.
+
+    Con JSON_TRACK_FRAGMENTS se arma con el JSON precodificado de cada track
+    (guardado sin "stage", que en un setlist cambia según la fase). Cada
+    fragmento se valida contra los valores actuales del track, así uno
+    mutado o editado por el cliente nunca sale con datos viejos.
+    """
+    encode = current_app.json.encode
+    if not current_app.config.get("JSON_TRACK_FRAGMENTS"):
+        return encode(project_tracks(tracks, fields))
+    fragments = (catalog or get_catalog()).derived("json_fragments", lambda c: {})
+    body_fields = tuple(f for f in fields if f != "stage")
+    with_stage = "stage" in fields
+    stages = {}
+    parts = []
+    for t in tracks:
+        values = tuple(map(t.get, body_fields))
+        key = (t.get("artist"), t.get("track"), body_fields)
+        cached = fragments.get(key)
+        if cached is None or cached[0] != values:
+            cached = (values, encode({f: t[f] for f in body_fields if f in t})[:-1])
+            if len(fragments) < TRACK_FRAGMENTS_MAX:
+                fragments[key] = cached
+        stage = t.get("stage") if with_stage else None
+        if stage is None:
+            parts.append(cached[1] + b"}")
+            continue
+        suffix = stages.get(stage)
+        if suffix is None:
+            suffix = stages[stage] = b'"stage":' + encode(stage) + b"}"
+        parts.append(cached[1] + (b"," if len(cached[1]) > 1 else b"") + suffix)
+    return b"[" + b",".join(parts) + b"]"
+
+def tracks_response(tracks, fields=None, catalog=None, **extra):
+    """Respuesta JSON con la lista de tracks; con `extra` va como {"tracks": [...], **extra}."""
+    body = encode_tracks(tracks, fields or requested_track_fields(), catalog)
+    if extra:
+        body = b'{"tracks":' + body + b"," + current_app.json.encode(extra)[1:]
+    return current_app.response_class(body, mimetype="application/json")
+
+def is_track_valid_for_phase(track, phase, attempt=1):
+    config = ENERGY_RANGES_PRO.get(phase)
+    if not config: return True
+    bpm = track.get("bpm", 0)
+    key_val = track.get("key", "")
+    energy = track.get("energy", 5)
+    # Catálogo compilado con ingest-catalog: ya vienen como números
+    if type(bpm) not in (int, float) or type(energy) is not int:
+        try:
+            bpm = float(bpm)
+            energy = int(energy)
+        except: 
+            return False
+    
+    min_bpm, max_bpm = config["bpm"]
+    min_energy, max_energy = config["energy"]
+    
+    margin = 2 if attempt > 1 else 0
+    energy_margin = 1 if attempt > 1 else 0
+    
+    bpm_ok = (min_bpm - margin) <= bpm <= (max_bpm + margin)
+    key_ok = key_val in config["keys"]
+    energy_ok = (min_energy - energy_margin) <= energy <= (max_energy + energy_margin)
+    
+    return bpm_ok and key_ok and energy_ok
+
+def _compute_camelot_relation(prev_key, curr_key):
+    try:
+        n1, l1 = int(prev_key[:-1]), prev_key[-1]
+        n2, l2 = int(curr_key[:-1]), curr_key[-1]
+        if n1 == n2 and l1 == l2: return "same"
+        if n1 == n2 and l1 != l2: return "switch"
+        if l1 == l2:
+            if (n1 % 12) + 1 == n2: return "up"
+            if (n1 - 2) % 12 + 1 == n2: return "down"
+            if (n1 + 4) % 12 + 1 == n2 or (n1 - 6) % 12 + 1 == n2: return "fifth"
+        return "invalid"
+    except: return "invalid"
+
+CAMELOT_KEYS = [f"{n}{mode}" for mode in "AB" for n in range(1, 13)]
+
+# Tabla precompilada de relaciones entre las 24 keys (lookup O(1) en el scoring)
+CAMELOT_RELATIONS = {
+    (k1, k2): _compute_camelot_relation(k1, k2) for k1 in CAMELOT_KEYS for k2 in CAMELOT_KEYS
+}
+
+def camelot_relation(prev_key, curr_key):
+    rel = CAMELOT_RELATIONS.get((prev_key, curr_key))
+    if rel is None:
+        return _compute_camelot_relation(prev_key, curr_key)
+    return rel
+
+def get_max_fifths_allowed(duration_hours):
+    if duration_hours <= 1:
+        return 1
+    elif duration_hours <= 2:
+        return 2
+    else:
+        return min(4, max(3, int(duration_hours)))
+
+def check_repetition_pattern(current_key, last_two_keys):
+    if len(last_two_keys) < 2:
+        return True
+    if last_two_keys[0] == last_two_keys[1] == current_key:
+        return False
+    return True
+
+def get_key_pair(key1, key2):
+    num1, mode1 = int(key1[:-1]), key1[-1]
+    num2, mode2 = int(key2[:-1]), key2[-1]
+    if num1 == num2 and mode1 != mode2:
+        return f"{num1}A-{num1}B"
+    return None
+
+def key_transition_score(state, prev_key, current_key, rel, target_energy, recent_keys_set, max_fifths):
+    """Puntaje armónico de pasar de prev_key a current_key (según el estado de la generación).
+
+    None si la transición no se permite. No incluye el random ni el término de BPM.
+    """
+    prev_mode = prev_key[-1]
+    if not check_repetition_pattern(current_key, state["last_two_keys"]):
+        return None
+    
+    current_pair = get_key_pair(prev_key, current_key)
+    if rel == "switch" and current_pair:
+        if state["switch_pair"] == current_pair:
+            if state["switch_pair_count"] >= 2:
+                return None
+    
+    score = 0
+
+    # 🔥 PENALIZACIÓN FUERTE SI LA KEY YA SE USÓ RECIENTEMENTE
+    if current_key in recent_keys_set:
+        score -= 500
+    
+    # 🔥 PENALIZACIÓN ADICIONAL SI ES LA MISMA KEY QUE LA ANTERIOR
+    if current_key == prev_key:
+        score -= 200
+
+    fifth_penalty = 0
+    if rel == "fifth":
+        if state["fifth_count"] >= max_fifths:
+            return None
+        if state["tracks_since_fifth"] < 10:
+            fifth_penalty = -300
+        else:
+            fifth_penalty = 100
+
+    if rel == "same":
+        if state["rep_count"] < 1:
+            score += 40
+        elif state["rep_count"] == 1:
+            score += 20
+        else:
+            score -= 300
+    elif rel == "up":
+        base_up_score = 200
+        if state["switch_pair_count"] >= 2:
+            base_up_score += 100
+        score += base_up_score
+    elif rel == "down":
+        score += 120
+    elif rel == "switch":
+        switch_score = 180
+        if current_pair and state["switch_pair"] == current_pair:
+            if state["switch_pair_count"] >= 1:
+                switch_score -= 80
+        score += switch_score
+    elif rel == "fifth":
+        score += fifth_penalty
+
+    if target_energy in ["build", "mid_peak"] and prev_mode == "A" and current_key.endswith("B"):
+        score += 150
+
+    if target_energy in ["warmup", "build"] and current_key.endswith("A"):
+        score += 80
+
+    return score
+
+def find_compatible_track(prev_track, target_energy, used_tracks_names, duration_hours=1, recent_keys=None, catalog=None, library=None, state=None):
+    """Encuentra el mejor track compatible con VARIEDAD FORZADA.
+
+    Con library (UserLibrary) también considera los tracks propios del usuario.
+    `state` es el de new_cattaneo_state() de la generación en curso (se actualiza
+    con el track elegido); sin él se evalúa como primer paso de un set.
+    """
+    if state is None:
+        state = new_cattaneo_state()
+    if catalog is None:
+        catalog = get_catalog()
+    
+    if recent_keys is None:
+        recent_keys = []
+    
+    # Pool estricto de la fase si le queda algún track sin usar; si no, el de margen
+    attempt = 1
+    if all(t["track"] in used_tracks_names for t in phase_candidates(catalog, library, target_energy)):
+        attempt = 2
+        if all(t["track"] in used_tracks_names for t in phase_candidates(catalog, library, target_energy, attempt=2)):
+            return None
+    
+    # Si no hay track previo, elegir uno al azar
+    if not prev_track:
+        candidates = [t for t in phase_candidates(catalog, library, target_energy, attempt) if t["track"] not in used_tracks_names]
+        chosen = random.choice(candidates).copy()
+        chosen["stage"] = target_energy
+        return chosen
+    
+    prev_key = prev_track.get("key", "7A")
+    
+    max_fifths = get_max_fifths_allowed(duration_hours)
+
+    if state["last_phase"] != target_energy:
+        state["rep_count"] = 0
+        state["last_phase"] = target_energy
+
+    # 🔥 PENALIZACIÓN POR KEYS RECIENTES (últimas 5)
+    recent_keys_set = set(recent_keys[-5:]) if len(recent_keys) > 0 else set()
+    
+    # Ventana de BPM alrededor del anterior: bpm_step_max de la fase o el default.
+    # Si ningún candidato armónico entra, se repite sin ventana (el puntaje
+    # de suavidad igual favorece los saltos chicos).
+    prev_bpm = track_bpm_value(prev_track)
+    windows = [None]
+    smoothness_weight = 0
+    if prev_bpm is not None:
+        step_max = ENERGY_RANGES_PRO.get(target_energy, {}).get("bpm_step_max", BPM_STEP_MAX)
+        windows.insert(0, (prev_bpm - step_max, prev_bpm + step_max))
+        smoothness_weight = BPM_SMOOTHNESS_WEIGHT
+    else:
+        prev_bpm = 0.0
+    rand = random.random
+    
+    for window in windows:
+        scored = []
+        # Solo los buckets de keys compatibles con prev_key (grafo de transiciones).
+        # Todo el puntaje salvo el random y el BPM depende de la key: se calcula una vez por bucket.
+        for tracks, bucket, bpms, rel in compatible_candidates(catalog, library, prev_key, target_energy, attempt, window):
+            if not bucket:
+                continue
+            score = key_transition_score(state, prev_key, tracks[bucket[0]]["key"], rel, target_energy, recent_keys_set, max_fifths)
+            if score is None:
+                continue
+            score += 20  # random.uniform(20, 40) = 20 + 20 * random()
+            for i, bpm in zip(bucket, bpms):
+                t = tracks[i]
+                if t["track"] not in used_tracks_names:
+                    scored.append((score - smoothness_weight * abs(bpm - prev_bpm) + 20 * rand(), t))
+        if scored:
+            break
+
+    if not scored:
+        return None
+    
+    scored.sort(key=itemgetter(0), reverse=True)
+    
+    # 🔥 SELECCIÓN CON VARIEDAD: Top 10% con algo de randomness
+    top_candidates = scored[:max(1, len(scored) // 10)]
+    ganador = random.choice(top_candidates)[1].copy()
+    ganador_key = ganador["key"]
+    ganador_rel = camelot_relation(prev_key, ganador_key)
+
+    state["last_two_keys"].append(ganador_key)
+    if len(state["last_two_keys"]) > 2:
+        state["last_two_keys"].pop(0)
+    
+    ganador_pair = get_key_pair(prev_key, ganador_key)
+    if ganador_rel == "switch" and ganador_pair:
+        if state["switch_pair"] == ganador_pair:
+            state["switch_pair_count"] += 1
+        else:
+            state["switch_pair"] = ganador_pair
+            state["switch_pair_count"] = 1
+    else:
+        state["switch_pair"] = None
+        state["switch_pair_count"] = 0
+    
+    if ganador_rel == "fifth":
+        state["tracks_since_fifth"] = 0
+        state["fifth_count"] += 1
+    else:
+        state["tracks_since_fifth"] += 1
+
+    if ganador_key == prev_key:
+        state["rep_count"] += 1
+    else:
+        state["rep_count"] = 0
+
+    ganador["stage"] = target_energy
+    return ganador
+
+# ==============================
+# GRAFO DE TRANSICIONES (CSR)
+# ==============================
+# Qué track puede seguir a cuál depende solo de las keys (CAMELOT_RELATIONS)
+# y de los pools de cada fase, así que el grafo track -> sucesores se guarda
+# factorizado en dos CSR en vez de arista por arista (con 100k tracks serían
+# miles de millones):
+#   KEY_SUCCESSOR_*: key -> keys que pueden seguirla, con su relación
+#   TransitionGraph: (fase, attempt, key) -> índices de los tracks del pool,
+#   ordenados por BPM (los que están a ±N BPM salen con bisect)
+# Los sucesores de un track en una fase son los slices de las keys
+# compatibles con la suya. El grafo se guarda en disco junto al catálogo.
+RELATION_NAMES = ("same", "up", "down", "switch", "fifth")
+KEY_INDEX = {k: i for i, k in enumerate(CAMELOT_KEYS)}
+GRAPH_FORMAT = 2  # subir si cambia el layout o is_track_valid_for_phase
+
+# Salto máximo de BPM entre tracks seguidos si la fase no define bpm_step_max
+BPM_STEP_MAX = 3
+# Puntos que se restan por cada BPM de diferencia con el track anterior
+BPM_SMOOTHNESS_WEIGHT = 12
+
+def track_bpm_value(track):
+    """BPM numérico del track; None si falta o no es un número."""
+    try:
+        bpm = float(track.get("bpm"))
+    except (TypeError, ValueError):
+        return None
+    return bpm if bpm > 0 else None
+
+def _key_successor_csr():
+    offsets, targets, relations = array("i", [0]), array("b"), array("b")
+    for k1 in CAMELOT_KEYS:
+        for j, k2 in enumerate(CAMELOT_KEYS):
+            rel = CAMELOT_RELATIONS[(k1, k2)]
+            if rel != "invalid":
+                targets.append(j)
+                relations.append(RELATION_NAMES.index(rel))
+        offsets.append(len(targets))
+    return offsets, targets, relations
+
+KEY_SUCCESSOR_OFFSETS, KEY_SUCCESSORS, KEY_SUCCESSOR_RELATIONS = _key_successor_csr()
+
+def key_index(key):
+    """Posición de la key en CAMELOT_KEYS ('08A' y '8a' también valen); None si no es Camelot."""
+    index = KEY_INDEX.get(key)
+    if index is None and key:
+        try:
+            index = KEY_INDEX.get(f"{int(key[:-1])}{key[-1].upper()}")
+        except ValueError:
+            pass
+    return index
+
+def key_successors(key):
+    """(índice de key, relación) de las keys que pueden seguir a `key`."""
+    k = key_index(key)
+    if k is None:
+        return ()
+    return [(KEY_SUCCESSORS[j], RELATION_NAMES[KEY_SUCCESSOR_RELATIONS[j]])
+            for j in range(KEY_SUCCESSOR_OFFSETS[k], KEY_SUCCESSOR_OFFSETS[k + 1])]
+
+class TransitionGraph:
+    """Pools por fase agrupados por key en arrays compactos.
+
+    Para cada (fase, attempt) hay `order`, con los índices de los tracks
+    del pool ordenados por key y dentro de cada key por BPM, `bpms`
+    alineado con `order`, y 25 `offsets`: los de la key k son
+    order[offsets[k]:offsets[k + 1]]. `keys` tiene la key de cada track
+    (-1 si no es Camelot).
+    """
+
+    def __init__(self, keys, pools):
+        self.keys = keys
+        self.pools = pools  # (fase, attempt) -> (offsets, order, bpms)
+
+    @classmethod
+    def build(cls, tracks):
+        keys = array("b", [-1]) * len(tracks)
+        buckets = {(phase, attempt): [[] for _ in CAMELOT_KEYS]
+                   for phase in ENERGY_RANGES_PRO for attempt in (1, 2)}
+        for i, t in enumerate(tracks):
+            k = key_index(t.get("key"))
+            if k is None:
+                continue  # sin key válida no entra en ningún pool
+            keys[i] = k
+            for phase in ENERGY_RANGES_PRO:
+                if is_track_valid_for_phase(t, phase):
+                    buckets[(phase, 1)][k].append(i)
+                if is_track_valid_for_phase(t, phase, attempt=2):
+                    buckets[(phase, 2)][k].append(i)
+        bpm_of = [track_bpm_value(t) or 0.0 for t in tracks]
+        pools = {}
+        for pool_key, by_key in buckets.items():
+            offsets, order, bpms = array("i", [0]), array("i"), array("f")
+            for indices in by_key:
+                indices.sort(key=bpm_of.__getitem__)
+                order.extend(indices)
+                bpms.extend(bpm_of[i] for i in indices)
+                offsets.append(len(order))
+            pools[pool_key] = (offsets, order, bpms)
+        return cls(keys, pools)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        total = self.keys.itemsize * len(self.keys)
+        for arrays in self.pools.values():
+            total += sum(a.itemsize * len(a) for a in arrays)
+        return total
+
+    def pool(self, phase, attempt=1):
+        """Índices del pool completo de la fase."""
+        return self.pools[(phase, 2 if attempt > 1 else 1)][1]
+
+    def bucket(self, phase, attempt, k, bpm_range=None):
+        """Índices y BPMs del pool de la fase con key k (slice del CSR).
+
+        Con bpm_range=(mínimo, máximo) solo los que caen adentro (bisect).
+        """
+        offsets, order, bpms = self.pools[(phase, 2 if attempt > 1 else 1)]
+        start, end = offsets[k], offsets[k + 1]
+        if bpm_range is not None:
+            start = bisect.bisect_left(bpms, bpm_range[0], start, end)
+            end = bisect.bisect_right(bpms, bpm_range[1], start, end)
+        return order[start:end], bpms[start:end]
+
+    def successors(self, index, phase, attempt=1):
+        """(índice, relación) de los tracks que pueden seguir al track `index` en la fase."""
+        k = self.keys[index]
+        if k < 0:
+            return
+        for target, rel in key_successors(CAMELOT_KEYS[k]):
+            for j in self.bucket(phase, attempt, target)[0]:
+                yield j, rel
+
+def graph_path(path=CATALOG_PATH):
+    return os.path.splitext(path)[0] + ".graph"
+
+def _graph_header(mtime, count):
+    rules = hashlib.sha1(json.dumps(ENERGY_RANGES_PRO, sort_keys=True).encode()).hexdigest()[:12]
+    return {"format": GRAPH_FORMAT, "catalog_mtime": mtime, "tracks": count, "rules": rules,
+            "byteorder": sys.byteorder, "itemsize": array("i").itemsize}
+
+def load_transition_graph(mtime, count, path=CATALOG_PATH):
+    """Grafo guardado para esta versión del catálogo; None si falta o quedó viejo."""
+    if mtime is None:
+        return None
+    try:
+        with open(graph_path(path), "rb") as f:
+            header = json.loads(f.readline())
+            if {k: header.get(k) for k in ("format", "catalog_mtime", "tracks", "rules", "byteorder", "itemsize")} \
+                    != _graph_header(mtime, count):
+                return None
+            keys = array("b")
+            keys.fromfile(f, count)
+            pools = {}
+            for phase, attempt, size in header["pools"]:
+                offsets, order, bpms = array("i"), array("i"), array("f")
+                offsets.fromfile(f, len(CAMELOT_KEYS) + 1)
+                order.fromfile(f, size)
+                bpms.fromfile(f, size)
+                pools[(phase, attempt)] = (offsets, order, bpms)
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"⚠️ Grafo de transiciones ilegible, se reconstruye: {e}")
+        return None
+    return TransitionGraph(keys, pools)
+
+def save_transition_graph(graph, mtime, path=CATALOG_PATH):
+    """Escribe el grafo al lado del catálogo (temporal + os.replace)."""
+    header = _graph_header(mtime, len(graph))
+    header["pools"] = [[phase, attempt, len(order)] for (phase, attempt), (_, order, _) in graph.pools.items()]
+    target = graph_path(path)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            graph.keys.tofile(f)
+            for arrays in graph.pools.values():
+                for a in arrays:
+                    a.tofile(f)
+        os.replace(tmp_path, target)
+    except OSError as e:
+        print(f"⚠️ No se pudo guardar el grafo de transiciones: {e}")
+
+def compatible_candidates(catalog, library, prev_key, phase, attempt=1, bpm_range=None):
+    """Buckets (tracks, índices, bpms, relación) de la fase cuyas keys pueden seguir a prev_key."""
+    sources = (catalog, library) if library else (catalog,)
+    return [(source.tracks, *source.graph.bucket(phase, attempt, target, bpm_range), rel)
+            for target, rel in key_successors(prev_key) for source in sources]
+
+# ==============================
+# TRACKS SIMILARES (KD-TREE)
+# ==============================
+# "Algo parecido a este": vecinos más cercanos sobre BPM, energy, stage y la
+# key (posición en la rueda Camelot como punto del círculo + modo A/B).
+# Hay un KD-tree por key con las otras tres dimensiones; la distancia entre
+# keys es una constante por árbol, así que una consulta solo recorre los
+# árboles de las keys armónicamente válidas y les suma esa constante.
+SIMILAR_WEIGHTS = {"bpm": 0.5, "energy": 1.0, "stage": 1.0, "key": 2.0, "mode": 1.0}
+SIMILAR_DEFAULT_K = 10
+SIMILAR_MAX_K = 50
+SIMILAR_SWAP_CHOICES = 3  # change_track con "similar": elige entre los 3 más cercanos
+
+def _key_distance2(k1, k2):
+    """Distancia² entre dos keys: cuerda en el círculo de la rueda + cambio de modo."""
+    angle1 = 2 * math.pi * int(k1[:-1]) / 12
+    angle2 = 2 * math.pi * int(k2[:-1]) / 12
+    chord2 = (math.cos(angle1) - math.cos(angle2)) ** 2 + (math.sin(angle1) - math.sin(angle2)) ** 2
+    mode = 0 if k1[-1] == k2[-1] else 1
+    return SIMILAR_WEIGHTS["key"] ** 2 * chord2 + SIMILAR_WEIGHTS["mode"] ** 2 * mode
+
+KEY_DISTANCE2 = [[_key_distance2(k1, k2) for k2 in CAMELOT_KEYS] for k1 in CAMELOT_KEYS]
+
+def similarity_point(track):
+    """(bpm, energy, stage) escalados; None si al track le falta bpm o energy."""
+    bpm = track_bpm_value(track)
+    try:
+        energy = float(track.get("energy"))
+    except (TypeError, ValueError):
+        return None
+    if bpm is None:
+        return None
+    stage = str(track.get("stage") or "").lower()
+    stage = STAGE_ALIASES.get(stage, stage)
+    # Sin stage conocido: el medio del recorrido
+    position = PHASE_ORDER.index(stage) if stage in PHASE_ORDER else (len(PHASE_ORDER) - 1) / 2
+    return (bpm * SIMILAR_WEIGHTS["bpm"], energy * SIMILAR_WEIGHTS["energy"], position * SIMILAR_WEIGHTS["stage"])
+
+class KDTree:
+    """KD-tree estático armado por mediana, con los nodos implícitos en arrays.
+
+    El subárbol [lo, hi) tiene la raíz en mid = (lo + hi) // 2, el izquierdo
+    en [lo, mid) y el derecho en [mid + 1, hi); el eje es depth % dims.
+    """
+
+    def __init__(self, points, ids):
+        self.dims = len(points[0]) if points else 0
+        items = list(zip(points, ids))
+        stack = [(0, len(items), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= 1:
+                continue
+            axis = depth % self.dims
+            items[lo:hi] = sorted(items[lo:hi], key=lambda item: item[0][axis])
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+        self.points = [p for p, _ in items]
+        self.ids = [i for _, i in items]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, best, k, base=0.0, skip=None):
+        """Suma a `best` (heap de (-distancia², id), tope k) los vecinos de query.
+
+        `base` se suma a todas las distancias; `skip(id)` descarta puntos.
+        """
+        points, ids, dims = self.points, self.ids, self.dims
+        stack = [(0, len(ids), 0, base)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if lo >= hi or (len(best) >= k and bound >= -best[0][0]):
+                continue
+            mid = (lo + hi) // 2
+            point = points[mid]
+            d2 = base
+            for a, b in zip(query, point):
+                d2 += (a - b) * (a - b)
+            if (len(best) < k or d2 < -best[0][0]) and not (skip and skip(ids[mid])):
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, ids[mid]))
+                else:
+                    heapq.heapreplace(best, (-d2, ids[mid]))
+            axis = depth % dims
+            diff = query[axis] - point[axis]
+            far_bound = base + diff * diff
+            if diff < 0:
+                stack.append((mid + 1, hi, depth + 1, far_bound))
+                stack.append((lo, mid, depth + 1, bound))
+            else:
+                stack.append((lo, mid, depth + 1, far_bound))
+                stack.append((mid + 1, hi, depth + 1, bound))
+
+class SimilarityIndex:
+    """Un KDTree por key Camelot sobre los tracks del catálogo."""
+
+    def __init__(self, tracks, trees):
+        self.tracks = tracks
+        self.trees = trees  # índice de key -> KDTree
+
+    @classmethod
+    def build(cls, catalog):
+        by_key = {}
+        for i, t in enumerate(catalog.tracks):
+            k = catalog.graph.keys[i]
+            point = similarity_point(t) if k >= 0 else None
+            if point is not None:
+                points, ids = by_key.setdefault(k, ([], []))
+                points.append(point)
+                ids.append(i)
+        return cls(catalog.tracks, {k: KDTree(points, ids) for k, (points, ids) in by_key.items()})
+
+    def query(self, track, k=SIMILAR_DEFAULT_K, from_key=None, exclude=()):
+        """Los k tracks más parecidos a `track` cuya key puede seguir a from_key.
+
+        from_key es por defecto la key del propio track. `exclude` son
+        nombres de tracks a saltear. Devuelve [(distancia, track)].
+        """
+        point = similarity_point(track)
+        own_key = key_index(track.get("key"))
+        if point is None or own_key is None:
+            return []
+        tracks = self.tracks
+        skip = lambda i: tracks[i].get("track") in exclude
+        best = []
+        # Árboles más cercanos primero: la cota del heap poda más en los siguientes
+        targets = sorted((KEY_DISTANCE2[own_key][target], target)
+                         for target, _ in key_successors(from_key or track.get("key")))
+        for base, target in targets:
+            tree = self.trees.get(target)
+            if tree is None or (len(best) >= k and base >= -best[0][0]):
+                continue
+            tree.search(point, best, k, base=base, skip=skip)
+        return [(math.sqrt(-d2), tracks[i]) for d2, i in sorted(best, reverse=True)]
+
+def get_similarity_index(catalog):
+    return catalog.derived("similarity_index", SimilarityIndex.build)
+
+@bp.route("/api/similar/<path:track_name>")
+@login_required
+def similar_tracks(track_name):
+    """Vecinos más cercanos del track que además son transiciones armónicas válidas."""
+    catalog = get_catalog()
+    artist = request.args.get("artist")
+    track = catalog.find(artist, track_name) if artist else catalog.by_name.get(track_name)
+    if track is None:
+        return jsonify({"error": "Track no encontrado"}), 404
+    try:
+        k = max(1, min(int(request.args.get("k", SIMILAR_DEFAULT_K)), SIMILAR_MAX_K))
+    except ValueError:
+        return jsonify({"error": "k inválido"}), 400
+    neighbours = get_similarity_index(catalog).query(track, k, exclude={track.get("track")})
+    return tracks_response([t for _, t in neighbours], catalog=catalog,
+                           distances=[round(d, 3) for d, _ in neighbours])
+
+# ==============================
+# ASSETS ESTÁTICOS, COMPRESIÓN Y CACHÉ HTTP
+# ==============================
+# CSS/JS/imágenes de static/ se sirven con el hash del contenido en el nombre
+# (/assets/css/app.<hash>.css) y caché de un año: si el archivo cambia, cambia
+# la URL. Las respuestas de texto se comprimen con brotli (si está instalado)
+# o gzip a partir de COMPRESS_MIN_BYTES.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_HASH_LENGTH = 12
+_ASSET_NAME_RE = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{%d})(?P<ext>\.[A-Za-z0-9]+)$" % ASSET_HASH_LENGTH)
+_file_digests = {}
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_MAX_BYTES = 5 * 1024 * 1024  # archivos más grandes se mandan tal cual
+COMPRESS_LEVELS = {"br": 5, "gzip": 6}
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+    "application/javascript", "application/json", "application/xml", "image/svg+xml",
+}
+# Cuerpos ya comprimidos por (ETag, encoding): assets y páginas que se repiten
+COMPRESSED_CACHE = TTLCache(ttl=3600, maxsize=256)
+
+def file_digest(path):
+    """Hash del contenido del archivo; se recalcula solo si cambia el mtime."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _file_digests.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:ASSET_HASH_LENGTH]
+    _file_digests[path] = (mtime, digest)
+    return digest
+
+@bp.app_template_global()
+def asset_url(filename):
+    """URL con el hash del contenido para un archivo de static/."""
+    digest = file_digest(os.path.join(current_app.static_folder, filename))
+    if digest is None:
+        return url_for("static", filename=filename)
+    stem, ext = os.path.splitext(filename)
+    return url_for("main.asset", filename=f"{stem}.{digest}{ext}")
+
+@bp.route("/assets/<path:filename>")
+def asset(filename):
+    match = _ASSET_NAME_RE.match(filename)
+    if not match:
+        abort(404)
+    real_name = match["stem"] + match["ext"]
+    # Un hash que ya no corresponde (p. ej. en medio de un deploy) se sirve sin caché
+    fresh = file_digest(os.path.join(current_app.static_folder, real_name)) == match["digest"]
+    response = send_from_directory(current_app.static_folder, real_name, max_age=ASSET_MAX_AGE if fresh else None)
+    if fresh:
+        response.cache_control.immutable = True
+    return response
+
+def template_digest(name):
+    return file_digest(os.path.join(current_app.root_path, current_app.template_folder, name))
+
+def _choose_encoding():
+    if brotli is not None and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESS_LEVELS["br"])
+    return gzip.compress(data, compresslevel=COMPRESS_LEVELS["gzip"], mtime=0)
+
+@bp.after_app_request
+def compress_response(response):
+    """Comprime respuestas de texto si el cliente lo acepta y superan el umbral.
+
+    Las respuestas streameadas (exports, zip) se dejan pasar sin tocar; los
+    archivos de send_file sí se comprimen y se cachean por ETag.
+    """
+    if (response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    if response.direct_passthrough:
+        length = response.content_length  # send_file: el largo ya viene en el header
+    elif response.is_streamed:
+        return response
+    else:
+        length = response.calculate_content_length()
+    if length is None or not COMPRESS_MIN_BYTES <= length <= COMPRESS_MAX_BYTES:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    cache_key = (etag, encoding) if etag else None
+    body = COMPRESSED_CACHE.get(cache_key) if cache_key else None
+    if body is None:
+        response.direct_passthrough = False
+        body = compress_body(response.get_data(), encoding)
+        if cache_key:
+            COMPRESSED_CACHE.set(cache_key, body)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        # Otra representación del mismo recurso: el ETag pasa a ser débil
+        response.set_etag(etag, weak=True)
+    return response
+
+@bp.route("/login", methods=["GET", "POST"])
+def login():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    if request.method == "POST":
+        email = request.form["email"]
+        password = request.form["password"]
+        user = User.query.filter_by(email=email).first()
+        if user and user.check_password(password):
+            login_user(user)
+            remember_user(user)
+        else:
+            flash("Email o contraseña inválidos")
+    return redirect(url_for("main.index", login_attempt=True)) 
+
+@bp.route("/signup", methods=["GET", "POST"])
+def signup():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    if request.method == "POST":
+        email = request.form["email"]
+        password = request.form["password"]
+        if User.query.filter_by(email=email).first():
+            flash("Ese email ya está registrado.")
+            return redirect(url_for("main.index", signup_attempt=True)) 
+        new_user = User(email=email)
+        new_user.set_password(password)
+        db.session.add(new_user)
+        db.session.commit()
+        flash("¡Registro exitoso! Ya puedes iniciar sesión.")
+    return redirect(url_for("main.index", signup_attempt=True)) 
+
+@bp.route("/logout")
+@login_required
+def logout():
+    logout_user()
+    session.pop(USER_SESSION_KEY, None)
+    return redirect(url_for("main.index"))
+
+@bp.route("/")
+def index():
+    show_signup = request.args.get("signup_attempt", False)
+    response = make_response(render_template("index.html", user=current_user, show_signup=show_signup))
+    # La página depende del usuario: se revalida siempre y, si no cambió, 304
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@bp.route("/healthz")
+def healthz():
+    """Liveness: el proceso responde."""
+    return jsonify({"status": "ok"}), 200
+
+@bp.route("/readyz")
+def readyz():
+    """Readiness: 200 recién cuando el catálogo está cargado.
+
+    Sin gunicorn (p. ej. `flask run`) nadie llama a warmup: la primera
+    consulta lo dispara en segundo plano y responde 503 mientras tanto.
+    """
+    if not READY.is_set():
+        warmup_async()
+        return jsonify({"status": "warming_up"}), 503
+    return jsonify({"status": "ready", "catalog_version": get_catalog().version, **BOOT_STATS}), 200
+
+@bp.route("/api/search")
+@login_required 
+def api_search():
+    catalog = get_catalog()
+    q = request.args.get("q", "").lower()
+    energy_web = request.args.get("energy", "").lower() 
+    page = int(request.args.get("page", 1))
+    per_page = 100 
+    results = []
+    
+    web_to_internal = {
+        "warm-up": "warmup",
+        "building": "build",
+        "mid-peak": "mid_peak",
+        "peak time": "peaktime",
+        "driving": "driving",
+        "closing": "closing"
+    }
+    
+    target_stage = web_to_internal.get(energy_web)
+
+    if target_stage:
+        indices = catalog.by_stage.get(target_stage, [])
+    else:
+        indices = range(len(catalog.tracks))
+
+    for i in indices:
+        if q and q not in catalog.search_text[i]: continue
+        results.append(catalog.tracks[i])
+        
+    start = (page - 1) * per_page
+    end = start + per_page
+    paginated_results = results[start:end]
+    return tracks_response(paginated_results, catalog=catalog, has_more=end < len(results))
+
+def consume_trial_generation(data, exhausted_message="Has agotado tus 2 pruebas gratuitas."):
+    """Límites del plan trial: devuelve la respuesta 403 o None (y descuenta un uso)."""
+    if current_user.role != 'trial':
+        return None
+    if parse_set_minutes(data) > 60: 
+        return jsonify({"error": "Los usuarios de prueba solo pueden generar sets de 1 hora."}), 403
+    if not current_user.trial_uses_left or current_user.trial_uses_left <= 0: 
+        return jsonify({"error": exhausted_message}), 403
+    # UPDATE condicional: dos requests en paralelo no pueden gastar la misma prueba
+    uses_left = db.session.execute(
+        db.update(User).where(User.id == current_user.id, User.trial_uses_left > 0)
+        .values(trial_uses_left=User.trial_uses_left - 1)
+        .returning(User.trial_uses_left)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    db.session.commit()
+    update_current_user(trial_uses_left=uses_left or 0)
+    if uses_left is None:
+        return jsonify({"error": exhausted_message}), 403
+    return None
+
+def iter_generated_set(phases, catalog, library=None, start_name="", hours=1, recent=None):
+    """Va entregando los tracks del set a medida que se eligen (uno por fase del plan).
+
+    Con recent (RecentTracks) evita también los tracks de los sets anteriores.
+    """
+    state = new_cattaneo_state()
+    tracks = catalog.tracks
+    used_tracks = set()
+    avoid = avoided_tracks(used_tracks, recent)
+    
+    first = None
+    target_energy_first = phases[0]
+
+    if start_name:
+        for t in itertools.chain(tracks, library.tracks if library else ()):
+            full = f"{t.get('artist','')} - {t.get('track','')}".lower()
+            if start_name in full:
+                first = t.copy()
+                break
+    
+    if not first:
+        first = random_phase_track(catalog, library, target_energy_first)
+        for _ in range(FRESHNESS_FIRST_TRACK_TRIES):
+            if first is None or first["track"] not in avoid:
+                break
+            first = random_phase_track(catalog, library, target_energy_first)
+        first = (first or random.choice(tracks)).copy()
+    
+    first["stage"] = target_energy_first
+    yield first
+    
+    prev = first
+    used_tracks.add(first["track"])
+    recent_keys = [first["key"]]
+    
+    for i in range(1, len(phases)):
+        target_energy = phases[i]
+        chosen = find_fresh_compatible_track(prev, target_energy, avoid, used_tracks, duration_hours=hours,
+                                             recent_keys=recent_keys, catalog=catalog, library=library, state=state)
+        if not chosen:
+            fallback_tracks = [t for t in phase_candidates(catalog, library, target_energy, attempt=2) if t["track"] not in used_tracks]
+            if not fallback_tracks:
+                continue
+            chosen = random.choice(fallback_tracks).copy()
+        chosen["stage"] = target_energy
+        used_tracks.add(chosen["track"])
+        recent_keys.append(chosen["key"])
+        prev = chosen
+        yield chosen
+
+@bp.route("/generate", methods=["POST"])
+@login_required 
+def generate():
+    data = request.json or {}
+    denied = consume_trial_generation(data)
+    if denied:
+        return denied
+    
+    minutes = parse_set_minutes(data)
+    # Snapshot fijo para todo el set aunque entre un reload en el medio
+    catalog = get_catalog()
+    phases = pick_phase_plan(minutes, catalog)
+    setlist = list(iter_generated_set(phases, catalog, request_library(data),
+                                      data.get("start_track", "").lower(), minutes / 60, request_recent_tracks(data)))
+    record_generated_set(current_user.id, setlist)
+    db.session.commit()
+    return generated_set_response(setlist, catalog, data)
+
+@bp.route("/generate/stream", methods=["POST"])
+@login_required
+def generate_stream():
+    """Como /generate, pero manda cada track apenas se elige.
+
+    NDJSON por defecto ({"event": ..., ...} por línea); con
+    Accept: text/event-stream, Server-Sent Events. Eventos: "start" (largo
+    del plan), "track" (el track con su nivel de energía y key para los
+    gráficos) y "done".
+    """
+    data = request.json or {}
+    denied = consume_trial_generation(data)
+    if denied:
+        return denied
+    
+    minutes = parse_set_minutes(data)
+    catalog = get_catalog()
+    phases = pick_phase_plan(minutes, catalog)
+    library = request_library(data)
+    recent = request_recent_tracks(data)
+    start_name = data.get("start_track", "").lower()
+    user_id = current_user.id
+    fields = requested_track_fields()
+    sse = request.accept_mimetypes.best_match(["application/x-ndjson", "text/event-stream"]) == "text/event-stream"
+    encode = current_app.json.encode
+    
+    def frame(event, payload):
+        if sse:
+            return b"event: " + event.encode() + b"\ndata: " + encode(payload) + b"\n\n"
+        return encode({"event": event, **payload}) + b"\n"
+    
+    def events():
+        yield frame("start", {"total": len(phases), "minutes": minutes})
+        setlist = []
+        for track in iter_generated_set(phases, catalog, library, start_name, minutes / 60, recent):
+            setlist.append(track)
+            yield frame("track", {"index": len(setlist) - 1, "track": project_track(track, fields),
+                                  "energy": energy_chart_level(track), "key": track.get("key")})
+        record_generated_set(user_id, setlist)
+        db.session.commit()
+        yield frame("done", {"count": len(setlist)})
+    
+    response = current_app.response_class(stream_with_context(events()),
+                                          mimetype="text/event-stream" if sse else "application/x-ndjson")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # que el proxy no junte el stream
+    return response
+
+@bp.route("/api/change_track/<int:index>", methods=["POST"])
+@login_required 
+def change_track(index):
+    data = request.json or {}
+    setlist_in = data.get("current_setlist", []) 
+    if index < 0 or index >= len(setlist_in): return jsonify({"error": "Index out of range"}), 400
+    
+    prev_track = setlist_in[index - 1] if index > 0 else None
+    used_track_names = {t["track"] for t in setlist_in}
+    avoid = avoided_tracks(used_track_names, request_recent_tracks(data))
+    
+    target_stage = setlist_in[index].get("stage", "warmup")
+    
+    if prev_track:
+        if data.get("similar"):
+            # "Algo parecido a este": entre los vecinos más cercanos del track actual que
+            # puedan seguir al anterior, uno de los primeros (para no ciclar entre dos)
+            neighbours = get_similarity_index(get_catalog()).query(
+                setlist_in[index], SIMILAR_SWAP_CHOICES, from_key=prev_track.get("key"), exclude=avoid
+            )
+            replacement_track = random.choice(neighbours)[1].copy() if neighbours else None
+        else:
+            replacement_track = find_fresh_compatible_track(
+                prev_track, target_stage, avoid, used_track_names, library=request_library(data)
+            )
+        if replacement_track: 
+            replacement_track["stage"] = target_stage
+            return jsonify(project_track(replacement_track, requested_track_fields()))
+        else: return jsonify({"error": "No compatible alternative found"}), 404
+    return jsonify({"error": "Cannot change the first track via this endpoint"}), 400
+
+@bp.route("/api/generate_locked", methods=["POST"])
+@login_required 
+def generate_locked():
+    data = request.json or {}
+    denied = consume_trial_generation(data, exhausted_message="Has agotado tus pruebas.")
+    if denied:
+        return denied
+    
+    minutes = parse_set_minutes(data)
+    hours = minutes / 60
+    locked_setlist = data.get("locked_setlist", [])
+    fixed_setlist = [t for t in locked_setlist if t.get("isLocked")]
+    catalog = get_catalog()
+    library = request_library(data)
+    phases = pick_phase_plan(minutes, catalog)
+    
+    if len(fixed_setlist) > len(phases): fixed_setlist = fixed_setlist[:len(phases)]
+    setlist = copy.deepcopy(fixed_setlist)
+    used = {t["track"] for t in setlist}
+    avoid = avoided_tracks(used, request_recent_tracks(data))
+    state = new_cattaneo_state()
+    
+    for i in range(len(setlist), len(phases)):
+        if not setlist: break
+        prev = setlist[-1]
+        target_energy = phases[i]
+        chosen = find_fresh_compatible_track(prev, target_energy, avoid, used, duration_hours=hours,
+                                             catalog=catalog, library=library, state=state)
+        if chosen:
+            if "isLocked" in chosen: del chosen["isLocked"]
+            chosen["stage"] = target_energy
+            setlist.append(chosen)
+            used.add(chosen["track"])
+        else: break
+    record_generated_set(current_user.id, setlist)
+    db.session.commit()
+    return generated_set_response(setlist, catalog, data)
+
+# ==============================
+# LIBRERÍA PERSONAL (OVERLAY SOBRE EL CATÁLOGO)
+# ==============================
+# Cada usuario puede guardar sus propios tracks (p. ej. desde la búsqueda de
+# Spotify). La generación los ve como una capa encima del catálogo: recorre
+# los pools del snapshot compartido y después los de la librería, sin
+# copiar ni reconstruir los índices globales.
+LIBRARY_MAX_TRACKS = int(os.getenv("LIBRARY_MAX_TRACKS", "5000"))
+# Overlays armados por user_id -> (library_version, UserLibrary); LRU entre usuarios activos
+LIBRARY_CACHE = TTLCache(ttl=3600, maxsize=int(os.getenv("LIBRARY_CACHE_SIZE", "500")))
+
+class UserLibrary:
+    """Índices de la librería de un usuario, del mismo tipo que los de Catalog.
+
+    Se arma en O(tamaño de la librería) y no se muta: cualquier cambio
+    sube User.library_version y la próxima lectura arma uno nuevo.
+    """
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.graph = TransitionGraph.build(tracks)
+        self.phase_pools = phase_pools_from_graph(tracks, self.graph)
+
+    def phase_pool(self, phase, attempt=1):
+        pools = self.phase_pools.get(phase)
+        if pools is None:
+            return self.tracks
+        return pools[1] if attempt > 1 else pools[0]
+
+    def __len__(self):
+        return len(self.tracks)
+
+def get_user_library(user):
+    """Overlay del usuario; solo consulta la DB si cambió su library_version."""
+    version = user.library_version
+    if version is None:
+        return None  # nunca guardó nada
+    cached = LIBRARY_CACHE.get(user.id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    rows = db.session.execute(
+        db.select(LibraryTrack).filter_by(user_id=user.id).order_by(LibraryTrack.id)
+    ).scalars()
+    library = UserLibrary([row.to_track() for row in rows])
+    LIBRARY_CACHE.set(user.id, (version, library))
+    return library
+
+def request_library(data):
+    """Librería del usuario logueado, salvo que el request mande "use_library": false."""
+    if data.get("use_library") is False:
+        return None
+    return get_user_library(current_user) or None
+
+def bump_library_version(user_id):
+    """Sube User.library_version (sin commit) y devuelve la versión nueva."""
+    return db.session.execute(
+        db.update(User).where(User.id == user_id)
+        .values(library_version=db.func.coalesce(User.library_version, 0) + 1)
+        .returning(User.library_version)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+def phase_candidates(catalog, library, phase, attempt=1):
+    """Pool de la fase en el catálogo seguido del de la librería (sin copiar ninguno)."""
+    pool = catalog.phase_pool(phase, attempt)
+    if not library:
+        return pool
+    return itertools.chain(pool, library.phase_pool(phase, attempt))
+
+def random_phase_track(catalog, library, phase, attempt=1):
+    """Track al azar (uniforme) entre el pool del catálogo y el de la librería."""
+    pools = [catalog.phase_pool(phase, attempt)]
+    if library:
+        pools.append(library.phase_pool(phase, attempt))
+    index = random.randrange(sum(map(len, pools)) or 1)
+    for pool in pools:
+        if index < len(pool):
+            return pool[index]
+        index -= len(pool)
+    return None
+
+@bp.route("/api/library", methods=["GET"])
+@login_required
+def get_library():
+    library = get_user_library(current_user)
+    return jsonify({"tracks": library.tracks if library else []})
+
+@bp.route("/api/library", methods=["POST"])
+@login_required
+def add_to_library():
+    """Agrega uno o varios tracks ({"tracks": [...]} o un track suelto)."""
+    data = request.json or {}
+    raw_tracks = data.get("tracks") if isinstance(data.get("tracks"), list) else [data]
+    rows, errors = {}, []
+    for index, raw in enumerate(raw_tracks):
+        try:
+            if not isinstance(raw, dict):
+                raise IngestError("no es un objeto")
+            track = coerce_track(raw)
+        except IngestError as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+        # Hash de largo fijo: artista + título pueden pasar los 255 de la columna
+        rows.setdefault(dedupe_hash(track), track)
+    
+    existing = set()
+    if rows:
+        existing = set(db.session.execute(
+            db.select(LibraryTrack.dedupe_key)
+            .filter_by(user_id=current_user.id)
+            .where(LibraryTrack.dedupe_key.in_(list(rows)))
+        ).scalars())
+    new_rows = {key: track for key, track in rows.items() if key not in existing}
+    if not new_rows:
+        return jsonify({"added": 0, "duplicates": len(existing), "errors": errors}), 400 if errors else 200
+    
+    count = db.session.execute(
+        db.select(db.func.count(LibraryTrack.id)).filter_by(user_id=current_user.id)
+    ).scalar()
+    if count + len(new_rows) > LIBRARY_MAX_TRACKS:
+        return jsonify({"error": f"La librería admite hasta {LIBRARY_MAX_TRACKS} tracks."}), 400
+    
+    for key, track in new_rows.items():
+        db.session.add(LibraryTrack(
+            user_id=current_user.id, dedupe_key=key,
+            artist=track["artist"][:200], track=track["track"][:200],
+            bpm=track["bpm"], key=track["key"], energy=track["energy"], stage=track["stage"] or None,
+            spotify_id=track.get("spotify_id"), image=track.get("image"), preview_url=track.get("preview_url"),
+        ))
+    version = bump_library_version(current_user.id)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otro request guardó el mismo track entre la consulta y el INSERT
+        db.session.rollback()
+        return jsonify({"error": "El track ya está en tu librería."}), 409
+    update_current_user(library_version=version)
+    return jsonify({"added": len(new_rows), "duplicates": len(existing), "errors": errors})
+
+@bp.route("/api/library/<int:track_id>", methods=["DELETE"])
+@login_required
+def remove_from_library(track_id):
+    deleted = db.session.execute(
+        db.delete(LibraryTrack).where(LibraryTrack.id == track_id, LibraryTrack.user_id == current_user.id)
+    ).rowcount
+    if not deleted:
+        db.session.rollback()
+        return jsonify({"error": "Track no encontrado"}), 404
+    version = bump_library_version(current_user.id)
+    db.session.commit()
+    update_current_user(library_version=version)
+    return jsonify({"success": True})
+
+# ==============================
+# FRESCURA ENTRE SETS (BLOOM FILTERS)
+# ==============================
+# Cada set generado deja un bloom filter con sus tracks (RecentSet, unos 2
+# bytes por track). Con "avoid_recent_sets": N la generación carga los
+# últimos N en una sola consulta y los chequea en memoria, en el mismo lugar
+# que used_tracks. Un falso positivo solo deja afuera un track que no se
+# había usado; si evitar los sets anteriores deja una fase sin candidatos
+# compatibles, se repite un track antes que romper la armonía.
+FRESHNESS_MAX_SETS = min(int(os.getenv("FRESHNESS_MAX_SETS", "10")), 64)  # una máscara de 64 bits por posición
+BLOOM_BITS_PER_TRACK = 16
+BLOOM_HASHES = 7  # con 16 bits por track: ~0.1% de falsos positivos por set
+FRESHNESS_FIRST_TRACK_TRIES = 20
+# Posiciones de los bits en 1 de cada valor de byte
+BYTE_SET_BITS = [tuple(b for b in range(8) if value >> b & 1) for value in range(256)]
+
+def bloom_hashes(name):
+    """Dos hashes de 32 bits del nombre, estables entre procesos (los filtros van a la DB)."""
+    h = int.from_bytes(hashlib.blake2b(name.casefold().encode(), digest_size=8).digest(), "little")
+    return h & 0xFFFFFFFF, (h >> 32) | 1
+
+def bloom_filter_bits(names):
+    """Bloom filter de los nombres; el tamaño en bits es potencia de 2 (≥ 512)."""
+    size = 1 << max(9, (len(names) * BLOOM_BITS_PER_TRACK - 1).bit_length())
+    bits = bytearray(size // 8)
+    for name in names:
+        h1, h2 = bloom_hashes(name)
+        for i in range(BLOOM_HASHES):
+            index = (h1 + i * h2) & (size - 1)
+            bits[index >> 3] |= 1 << (index & 7)
+    return bytes(bits)
+
+class RecentTracks:
+    """Unión de los bloom filters de los últimos sets del usuario.
+
+    Los filtros del mismo tamaño se guardan "bit-sliced": por posición, una
+    máscara con un bit por set. Un nombre está en algún set si el AND de las
+    máscaras de sus BLOOM_HASHES posiciones no da 0, así el chequeo cuesta
+    lo mismo con 1 set que con FRESHNESS_MAX_SETS.
+    """
+
+    def __init__(self, blooms):
+        by_size = {}
+        for bits in blooms:
+            by_size.setdefault(len(bits), []).append(bits)
+        self.groups = []
+        for size, group in by_size.items():
+            slices = array("Q", bytes(size * 64))
+            for j, bits in enumerate(group):
+                flag = 1 << j
+                for byte_index, value in enumerate(bits):
+                    if value:
+                        base = byte_index << 3
+                        for b in BYTE_SET_BITS[value]:
+                            slices[base | b] |= flag
+            self.groups.append((size * 8 - 1, slices))
+
+    def __contains__(self, name):
+        h1, h2 = bloom_hashes(name)
+        for mask, slices in self.groups:
+            hits = -1
+            for i in range(BLOOM_HASHES):
+                hits &= slices[(h1 + i * h2) & mask]
+                if not hits:
+                    break
+            else:
+                return True
+        return False
+
+class AvoidedTracks:
+    """Nombres a evitar: los usados en este set y los de los últimos sets del usuario.
+
+    Va donde iba el set de used_tracks (solo se consulta con `in`); los
+    tracks nuevos se siguen agregando a `used`. Lo de los sets anteriores se
+    memoiza por nombre: cada track se hashea una vez por generación.
+    """
+
+    def __init__(self, used, recent):
+        self.used = used
+        self.recent = recent
+        self._seen = {}
+
+    def __contains__(self, name):
+        if name in self.used:
+            return True
+        hit = self._seen.get(name)
+        if hit is None:
+            hit = self._seen[name] = name in self.recent
+        return hit
+
+def request_recent_tracks(data):
+    """RecentTracks de los últimos N sets del usuario si el request pide "avoid_recent_sets": N."""
+    try:
+        count = min(int(data.get("avoid_recent_sets") or 0), FRESHNESS_MAX_SETS)
+    except (TypeError, ValueError):
+        count = 0
+    if count <= 0:
+        return None
+    blooms = db.session.execute(
+        db.select(RecentSet.bloom).filter_by(user_id=current_user.id).order_by(RecentSet.id.desc()).limit(count)
+    ).scalars().all()
+    return RecentTracks(blooms) if blooms else None
+
+def avoided_tracks(used, recent):
+    return AvoidedTracks(used, recent) if recent else used
+
+def find_fresh_compatible_track(prev_track, target_energy, avoid, used, **kwargs):
+    """find_compatible_track evitando también los sets anteriores; si así no hay, solo los de este set."""
+    chosen = find_compatible_track(prev_track, target_energy, avoid, **kwargs)
+    if chosen is None and avoid is not used:
+        chosen = find_compatible_track(prev_track, target_energy, used, **kwargs)
+    return chosen
+
+def record_generated_set(user_id, setlist):
+    """Guarda el filtro del set y borra los más viejos que FRESHNESS_MAX_SETS (sin commit)."""
+    if not setlist:
+        return
+    names = [t["track"] for t in setlist]
+    db.session.add(RecentSet(user_id=user_id, track_count=len(names), bloom=bloom_filter_bits(names)))
+    db.session.execute(
+        db.delete(RecentSet).where(
+            RecentSet.user_id == user_id,
+            RecentSet.id.not_in(
+                db.select(RecentSet.id).filter_by(user_id=user_id).order_by(RecentSet.id.desc()).limit(FRESHNESS_MAX_SETS)
+            ),
+        ).execution_options(synchronize_session=False)
+    )
+
+# ==============================
+# 🎵 NUEVO: ENDPOINT PARA OBTENER PREVIEW (SPOTIFY + YOUTUBE)
+# ==============================
+@bp.route("/api/get_preview", methods=["POST"])
+@login_required
+def get_preview():
+    """
+    Busca preview de un track:
+    1. Si ya tiene Spotify/YouTube ID, lo retorna
+    2. Si no, encola la búsqueda (Spotify y después YouTube) y responde 202 "pending"
+    3. El resolver guarda el resultado en track_preview (no en el JSON)
+    4. El cliente vuelve a consultar hasta recibir el ID + tipo
+    """
+    data = request.json or {}
+    artist = data.get("artist", "")
+    track_name = data.get("track", "")
+    
+    if not artist or not track_name:
+        return jsonify({"error": "Missing artist or track"}), 400
+    
+    track_found = get_catalog().find(artist, track_name)
+    
+    if not track_found:
+        return jsonify({"error": "Track not found in database"}), 404
+    
+    # IDs que ya resolvió algún worker (tabla track_preview) encima de los del catálogo
+    if not track_found.get("spotify_id") and not track_found.get("youtube_id"):
+        track_found = {**track_found, **preview_ids(artist, track_name)}
+    
+    # Si ya tiene spotify_id, retornarlo
+    if track_found.get("spotify_id"):
+        return jsonify({
+            "type": "spotify",
+            "id": track_found["spotify_id"]
+        }), 200
+    
+    # Si ya tiene youtube_id, retornarlo
+    if track_found.get("youtube_id"):
+        return jsonify({
+            "type": "youtube",
+            "id": track_found["youtube_id"]
+        }), 200
+    
+    # Buscar en segundo plano (Spotify y después YouTube); el cliente vuelve a consultar
+    job = preview_resolver.submit(artist, track_name)
+    
+    if job["status"] == "done":
+        return jsonify({
+            "type": job["type"],
+            "id": job["id"]
+        }), 200
+    
+    if job["status"] == "pending":
+        return jsonify({"status": "pending", "retry_after": 1}), 202
+    
+    if job["status"] == "unavailable":
+        return jsonify({"error": "Preview providers unavailable"}), 503
+    
+    # No se encontró preview
+    return jsonify({"error": "No preview found"}), 404
+
+# ==============================
+# WEBHOOK DE MERCADOPAGO (INBOX + WORKERS)
+# ==============================
+# El endpoint solo guarda la notificación en webhook_event (único por
+# payment_id) y responde 200 al instante. Un pool de threads por proceso
+# consulta el pago al SDK fuera del request, con reintentos y backoff.
+# Cada evento se toma con un UPDATE condicional, así que aunque varios
+# workers (o varios procesos de gunicorn) lo vean, lo aplica uno solo.
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))  # 0 = solo `flask --app app process-webhooks`
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "5"))
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_BACKOFF_BASE = 30  # segundos; se duplica en cada intento
+WEBHOOK_BACKOFF_MAX = 3600
+WEBHOOK_LEASE = 300  # un evento "processing" más viejo que esto se considera abandonado
+
+# Estados de MP que todavía pueden terminar en "approved": se vuelven a consultar
+MP_PENDING_STATUSES = {"pending", "in_process", "authorized"}
+
+class WebhookRetry(Exception):
+    """El pago todavía no está en un estado final: reintentar más tarde."""
+
+def webhook_backoff(attempts):
+    """Segundos hasta el próximo intento (exponencial con jitter)."""
+    delay = min(WEBHOOK_BACKOFF_BASE * 2 ** max(attempts - 1, 0), WEBHOOK_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+def enqueue_webhook_event(payment_id, topic, payload):
+    """Guarda la notificación en el inbox. Devuelve True si el payment_id es nuevo."""
+    db.session.add(WebhookEvent(payment_id=payment_id, topic=topic, payload=payload))
+    try:
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+    # Ya estaba: MP vuelve a notificar cuando el pago cambia de estado, así que
+    # un evento descartado se re-arma; uno pendiente o aplicado queda igual.
+    db.session.execute(
+        db.update(WebhookEvent)
+        .where(WebhookEvent.payment_id == payment_id, WebhookEvent.status.in_(["skipped", "failed"]))
+        .values(status="pending", attempts=0, next_attempt_at=datetime.utcnow(), last_error=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return False
+
+def _due_webhook_filter(now):
+    stale = now - timedelta(seconds=WEBHOOK_LEASE)
+    return db.or_(
+        db.and_(WebhookEvent.status == "pending", WebhookEvent.next_attempt_at <= now),
+        db.and_(WebhookEvent.status == "processing", WebhookEvent.claimed_at < stale),
+    )
+
+def due_webhook_event_ids(limit=20):
+    """IDs de eventos listos para procesar (pendientes vencidos o abandonados)."""
+    now = datetime.utcnow()
+    return db.session.scalars(
+        db.select(WebhookEvent.id)
+        .where(_due_webhook_filter(now))
+        .order_by(WebhookEvent.next_attempt_at)
+        .limit(limit)
+    ).all()
+
+def claim_webhook_event(event_id):
+    """Toma el evento de forma atómica. Devuelve su claimed_at, o None si lo tomó otro."""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        db.update(WebhookEvent)
+        .where(WebhookEvent.id == event_id, _due_webhook_filter(now))
+        .values(status="processing", claimed_at=now, attempts=WebhookEvent.attempts + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return now if result.rowcount == 1 else None
+
+def apply_mp_payment(payment_id):
+    """Consulta el pago en MercadoPago y, si está aprobado, activa el plan.
+
+    Devuelve (estado_final, nota) sin commitear; lanza WebhookRetry (o
+    cualquier error del SDK) si hay que volver a intentar.
+    """
+    payment_info = get_mp_sdk().payment().get(payment_id)
+    if payment_info.get("status") != 200:
+        raise RuntimeError(f"MercadoPago respondió {payment_info.get('status')}")
+    response = payment_info["response"]
+    payment_status = response.get("status")
+    
+    if payment_status in MP_PENDING_STATUSES:
+        raise WebhookRetry(f"Pago en estado: {payment_status}")
+    if payment_status != "approved":
+        return "skipped", f"Pago en estado: {payment_status}"
+    
+    user_id = response.get("external_reference")
+    if not user_id:
+        return "failed", "Pago sin external_reference"
+    
+    user = db.session.get(User, int(user_id))
+    if not user:
+        return "failed", f"Usuario {user_id} no encontrado"
+    
+    if user.last_payment_id == str(payment_id):
+        return "done", "Pago ya aplicado"
+    
+    items = response.get("additional_info", {}).get("items", [])
+    title = items[0].get("title", "") if items else ""
+    
+    if "Mensual" in title:
+        user.pro_until = datetime.utcnow() + timedelta(days=30)
+        user.plan = 'monthly'
+    elif "Anual" in title:
+        user.pro_until = datetime.utcnow() + timedelta(days=365)
+        user.plan = 'annual'
+    
+    user.role = 'owner'
+    user.last_payment_id = str(payment_id)
+    return "done", f"Pago aprobado para user {user_id}, plan: {user.plan}"
+
+def process_webhook_event(event_id):
+    """Procesa un evento del inbox si este worker logra tomarlo. Devuelve el estado final."""
+    claimed_at = claim_webhook_event(event_id)
+    if claimed_at is None:
+        return None
+    event = db.session.get(WebhookEvent, event_id)
+    values = {}
+    try:
+        status, note = apply_mp_payment(event.payment_id)
+        values = {"status": status, "last_error": None if status == "done" else note,
+                  "processed_at": datetime.utcnow()}
+    except Exception as e:
+        db.session.rollback()
+        note = str(e) or repr(e)
+        if event.attempts >= WEBHOOK_MAX_ATTEMPTS:
+            values = {"status": "failed", "last_error": note, "processed_at": datetime.utcnow()}
+        else:
+            retry_at = datetime.utcnow() + timedelta(seconds=webhook_backoff(event.attempts))
+            values = {"status": "pending", "last_error": note, "next_attempt_at": retry_at}
+    
+    # Cerrar el evento solo si sigue siendo nuestro; los cambios al usuario van
+    # en la misma transacción, así un pago nunca se aplica dos veces.
+    changed_users = [obj.id for obj in db.session.dirty if isinstance(obj, User)]
+    result = db.session.execute(
+        db.update(WebhookEvent)
+        .where(WebhookEvent.id == event_id, WebhookEvent.status == "processing",
+               WebhookEvent.claimed_at == claimed_at)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        print(f"⚠️ Webhook {event.payment_id}: el evento fue tomado por otro worker")
+        return None
+    db.session.commit()
+    for user_id in changed_users:
+        forget_user(user_id)
+    icon = {"done": "✅", "pending": "🔁", "skipped": "ℹ️"}.get(values["status"], "❌")
+    print(f"{icon} Webhook {event.payment_id} (intento {event.attempts}): {values['status']} - {note}")
+    return values["status"]
+
+class WebhookWorkerPool:
+    """Threads que drenan el inbox de webhooks dentro del proceso web."""
+
+    BATCH = 20
+
+    def __init__(self, workers, poll_interval):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._app = None
+        self._pid = None
+
+    def start(self, app):
+        """Arranca el pool en este proceso (después del fork; idempotente)."""
+        if self.workers <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._app = app
+            self._inflight = set()
+            self._executor = ThreadPoolExecutor(self.workers, "mp-webhook")
+            threading.Thread(target=self._dispatch_loop, name="mp-webhook-dispatch", daemon=True).start()
+            self._pid = os.getpid()
+
+    def notify(self):
+        """Despierta al dispatcher (hay un evento nuevo en el inbox)."""
+        self._wake.set()
+
+    def _dispatch_loop(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                with self._app.app_context():
+                    event_ids = due_webhook_event_ids(self.BATCH)
+            except Exception as e:
+                print(f"⚠️ Webhook dispatcher: {e!r}")
+                continue
+            for event_id in event_ids:
+                with self._lock:
+                    if event_id in self._inflight:
+                        continue
+                    self._inflight.add(event_id)
+                self._executor.submit(self._run, event_id)
+            if len(event_ids) == self.BATCH:
+                self._wake.set()  # hay más atrasados: seguir sin esperar
+
+    def _run(self, event_id):
+        try:
+            with self._app.app_context():
+                process_webhook_event(event_id)
+        except Exception as e:
+            print(f"⚠️ Webhook worker: evento {event_id} falló: {e!r}")
+        finally:
+            with self._lock:
+                self._inflight.discard(event_id)
+
+webhook_pool = WebhookWorkerPool(WEBHOOK_WORKERS, WEBHOOK_POLL_INTERVAL)
+
+@click.command("process-webhooks")
+@with_appcontext
+def process_webhooks_command():
+    """Procesa en primer plano los eventos de webhook vencidos (cron o WEBHOOK_WORKERS=0)."""
+    processed = 0
+    while True:
+        event_ids = due_webhook_event_ids()
+        if not event_ids:
+            break
+        for event_id in event_ids:
+            if process_webhook_event(event_id):
+                processed += 1
+    print(f"✅ {processed} eventos de webhook procesados")
+
+@bp.route("/api/mercadopago-webhook", methods=["POST"])
+def mercadopago_webhook():
+    try:
+        data = request.get_json(silent=True) or {}
+        
+        x_signature = request.headers.get('x-signature')
+        x_request_id = request.headers.get('x-request-id')
+        
+        if not x_signature or not x_request_id:
+            current_app.logger.warning("Webhook sin headers de MercadoPago")
+            return jsonify({"status": "invalid headers"}), 400
+        
+        topic = data.get("topic") or data.get("type")
+        
+        if topic != "payment":
+            return jsonify({"status": "not a payment notification"}), 200
+        
+        payment_id = data.get("data", {}).get("id") or data.get("id")
+        
+        if not payment_id:
+            return jsonify({"status": "no payment_id"}), 400
+        
+        # Sin llamadas a MercadoPago acá: se encola y se procesa en el pool
+        created = enqueue_webhook_event(str(payment_id), topic, request.get_data(as_text=True))
+        webhook_pool.start(current_app._get_current_object())
+        webhook_pool.notify()
+        
+        if not created:
+            current_app.logger.info(f"Notificación repetida para pago {payment_id}")
+        return jsonify({"status": "queued" if created else "duplicate"}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error en webhook: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@bp.route("/create-payment", methods=["POST"])
+@login_required
+def create_payment():
+    if check_pro(current_user): 
+        return jsonify({"error": "Ya eres usuario PRO activo."}), 400
+    
+    data = request.get_json() or {}
+    subscription_type = data.get("type") 
+    
+    if subscription_type == 'monthly':
+        price, title = 10000.00, "Suscripción PRO Mensual"
+    elif subscription_type == 'annual':
+        price, title = 50000.00, "Suscripción PRO Anual"
+    else: 
+        return jsonify({"error": "Tipo de suscripción inválido"}), 400
+
+    preference_data = {
+        "items": [
+            {
+                "title": title,
+                "quantity": 1,
+                "unit_price": price,
+                "currency_id": "ARS"
+            }
+        ],
+        "payer": {
+            "email": current_user.email
+        },
+        "external_reference": str(current_user.id),
+        "notification_url": "https://www.progressivejourney.net/api/mercadopago-webhook",
+        "auto_return": "approved",
+        "back_urls": {
+            "success": "https://www.progressivejourney.net/?payment=success",
+            "pending": "https://www.progressivejourney.net/?payment=pending",
+            "failure": "https://www.progressivejourney.net/?payment=failure"
+        }
+    }
+
+    preference = get_mp_sdk().preference().create(preference_data)
+    return jsonify({"preference_id": preference["response"]["id"]}), 200
+
+# ==============================
+# EXPORTADORES (TXT / CSV / M3U8 / REKORDBOX XML / TRAKTOR NML)
+# ==============================
+# Cada formato es un generador que va emitiendo el archivo en pedazos (str),
+# así la respuesta se streamea y el bulk zip no arma nada entero en memoria.
+EXPORT_PRODUCT = "Progressive Journey"
+EXPORT_GENRE = "Progressive House"
+
+# Nombres de tonalidad por pitch class (0 = C), como los muestra Rekordbox
+PITCH_NAMES = ["C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B"]
+
+def camelot_to_pitch(camelot):
+    """'8A' -> (9, True) = A menor; None si la key no es Camelot válida."""
+    try:
+        number, mode = int(camelot[:-1]), camelot[-1].upper()
+    except (ValueError, TypeError, IndexError):
+        return None
+    if not 1 <= number <= 12 or mode not in "AB":
+        return None
+    # Cada paso del wheel es una quinta (7 semitonos); 8B = C mayor, 8A = A menor
+    major_root = (number * 7 + 4) % 12
+    if mode == "B":
+        return major_root, False
+    return (major_root + 9) % 12, True
+
+# (pitch class, menor) -> Camelot
+PITCH_TO_CAMELOT = {camelot_to_pitch(c): c for c in CAMELOT_KEYS}
+
+def rekordbox_tonality(key):
+    pitch = camelot_to_pitch(normalize_key(key))
+    if pitch is None:
+        return key or ""
+    root, minor = pitch
+    return PITCH_NAMES[root] + ("m" if minor else "")
+
+def traktor_key_value(key):
+    """Valor de MUSICAL_KEY en NML: 0-11 mayores (C..B), 12-23 menores (Cm..Bm)."""
+    pitch = camelot_to_pitch(normalize_key(key))
+    if pitch is None:
+        return None
+    root, minor = pitch
+    return root + (12 if minor else 0)
+
+def track_duration_seconds(track):
+    """Duración del track en segundos si el catálogo la tiene (duration, duration_ms o 'm:ss')."""
+    if track.get("duration_ms"):
+        try:
+            return round(float(track["duration_ms"]) / 1000)
+        except (TypeError, ValueError):
+            return None
+    value = track.get("duration") or track.get("length")
+    if not value:
+        return None
+    try:
+        if isinstance(value, str) and ":" in value:
+            minutes, seconds = value.split(":", 1)
+            return int(minutes) * 60 + int(seconds)
+        return round(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def _track_bpm(track):
+    try:
+        return float(track.get("bpm") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _track_filename(track):
+    return f"{track.get('artist', '')} - {track.get('track', '')}.mp3"
+
+def export_txt(setlist, title):
+    for i, t in enumerate(setlist, 1):
+        yield f"{i}. {t.get('artist', '')} - {t.get('track', '')} | {t.get('bpm', '')} | {t.get('key', '')}\n"
+
+def export_csv(setlist, title):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["#", "Artist", "Track", "BPM", "Key", "Camelot", "Energy", "Stage", "Duration"])
+    for i, t in enumerate(setlist, 1):
+        writer.writerow([i, t.get("artist", ""), t.get("track", ""), t.get("bpm", ""), t.get("key", ""),
+                         normalize_key(t.get("key")), t.get("energy", ""), t.get("stage", ""),
+                         track_duration_seconds(t) or ""])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def export_m3u8(setlist, title):
+    yield "#EXTM3U\n"
+    yield f"#PLAYLIST:{title}\n"
+    for t in setlist:
+        # -1 = duración desconocida (válido en M3U extendido)
+        duration = track_duration_seconds(t) or -1
+        yield f"#EXTINF:{duration},{t.get('artist', '')} - {t.get('track', '')}\n"
+        yield _track_filename(t) + "\n"
+
+def export_rekordbox_xml(setlist, title):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<DJ_PLAYLISTS Version="1.0.0">\n'
+    yield f'  <PRODUCT Name={quoteattr(EXPORT_PRODUCT)} Version="1.0" Company={quoteattr(EXPORT_PRODUCT)}/>\n'
+    yield f'  <COLLECTION Entries="{len(setlist)}">\n'
+    for i, t in enumerate(setlist, 1):
+        comment = f"Energy {t.get('energy', '')} - {t.get('stage', '')}"
+        yield (
+            f'    <TRACK TrackID="{i}" Name={quoteattr(str(t.get("track", "")))}'
+            f' Artist={quoteattr(str(t.get("artist", "")))} Genre={quoteattr(EXPORT_GENRE)}'
+            f' Kind="MP3 File" TotalTime="{track_duration_seconds(t) or 0}"'
+            f' AverageBpm="{_track_bpm(t):.2f}" Tonality={quoteattr(rekordbox_tonality(t.get("key")))}'
+            f' Comments={quoteattr(comment)} TrackNumber="{i}"/>\n'
+        )
+    yield '  </COLLECTION>\n  <PLAYLISTS>\n    <NODE Type="0" Name="ROOT" Count="1">\n'
+    yield f'      <NODE Name={quoteattr(title)} Type="1" KeyType="0" Entries="{len(setlist)}">\n'
+    for i in range(1, len(setlist) + 1):
+        yield f'        <TRACK Key="{i}"/>\n'
+    yield '      </NODE>\n    </NODE>\n  </PLAYLISTS>\n</DJ_PLAYLISTS>\n'
+
+def export_traktor_nml(setlist, title):
+    yield '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n<NML VERSION="19">\n'
+    yield f'  <HEAD COMPANY={quoteattr(EXPORT_PRODUCT)} PROGRAM={quoteattr(EXPORT_PRODUCT)}/>\n'
+    yield f'  <COLLECTION ENTRIES="{len(setlist)}">\n'
+    for t in setlist:
+        key_value = traktor_key_value(t.get("key"))
+        yield (
+            f'    <ENTRY TITLE={quoteattr(str(t.get("track", "")))} ARTIST={quoteattr(str(t.get("artist", "")))}>\n'
+            f'      <LOCATION DIR="/:" FILE={quoteattr(_track_filename(t))} VOLUME=""/>\n'
+            f'      <INFO GENRE={quoteattr(EXPORT_GENRE)} KEY={quoteattr(normalize_key(t.get("key")) or "")}'
+            f' PLAYTIME="{track_duration_seconds(t) or 0}" COMMENT={quoteattr(str(t.get("stage", "")))}/>\n'
+            f'      <TEMPO BPM="{_track_bpm(t):.6f}" BPM_QUALITY="100.000000"/>\n'
+        )
+        if key_value is not None:
+            yield f'      <MUSICAL_KEY VALUE="{key_value}"/>\n'
+        yield '    </ENTRY>\n'
+    yield '  </COLLECTION>\n  <PLAYLISTS>\n    <NODE TYPE="FOLDER" NAME="$ROOT">\n      <SUBNODES COUNT="1">\n'
+    yield f'        <NODE TYPE="PLAYLIST" NAME={quoteattr(title)}>\n'
+    yield f'          <PLAYLIST ENTRIES="{len(setlist)}" TYPE="LIST" UUID="{uuid.uuid4().hex}">\n'
+    for t in setlist:
+        yield f'            <ENTRY><PRIMARYKEY TYPE="TRACK" KEY={quoteattr("/:" + _track_filename(t))}/></ENTRY>\n'
+    yield '          </PLAYLIST>\n        </NODE>\n      </SUBNODES>\n    </NODE>\n  </PLAYLISTS>\n</NML>\n'
+
+# formato -> (extensión, mimetype, generador)
+EXPORT_FORMATS = {
+    "txt": ("txt", "text/plain", export_txt),
+    "csv": ("csv", "text/csv", export_csv),
+    "m3u8": ("m3u8", "audio/x-mpegurl", export_m3u8),
+    "rekordbox": ("xml", "application/xml", export_rekordbox_xml),
+    "traktor": ("nml", "application/xml", export_traktor_nml),
+}
+EXPORT_FORMAT_ALIASES = {"m3u": "m3u8", "xml": "rekordbox", "nml": "traktor"}
+
+def resolve_export_format(fmt):
+    fmt = EXPORT_FORMAT_ALIASES.get(fmt.lower(), fmt.lower())
+    return fmt if fmt in EXPORT_FORMATS else None
+
+EXPORT_REQUIRED_FIELDS = ("artist", "track")
+
+def setlist_error(setlist):
+    """Motivo por el que el setlist no se puede exportar, o None si está bien.
+
+    Se valida entero antes de streamear: una vez enviado el 200 ya no hay
+    forma de avisar que una fila venía mal.
+    """
+    if not isinstance(setlist, list) or not setlist:
+        return "El setlist tiene que ser una lista de tracks"
+    for i, track in enumerate(setlist, 1):
+        if not isinstance(track, dict):
+            return f"Track {i}: no es un objeto"
+        missing = [field for field in EXPORT_REQUIRED_FIELDS if not track.get(field)]
+        if missing:
+            return f"Track {i}: falta {', '.join(missing)}"
+    return None
+
+def iter_export(setlist, fmt, title):
+    """Genera el archivo en bytes UTF-8, pedazo a pedazo."""
+    for chunk in EXPORT_FORMATS[fmt][2](setlist, title):
+        yield chunk.encode("utf-8")
+
+def export_response(chunks, fmt, filename, cache_control=None):
+    ext, mimetype, _ = EXPORT_FORMATS[fmt]
+    # El charset lo agrega la clase de respuesta (text/* y application/xml); .m3u8 ya es UTF-8 por definición
+    response = current_app.response_class(chunks, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}.{ext}"'
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+    return response
+
+# Exports de sets compartidos (inmutables): bytes ya generados por (share_id, formato)
+EXPORT_CACHE = TTLCache(ttl=3600, maxsize=500)
+
+def cached_shared_export(share_id, fmt, setlist, title):
+    """Streamea el export y lo guarda en EXPORT_CACHE al terminar."""
+    parts = []
+    for chunk in iter_export(setlist, fmt, title):
+        parts.append(chunk)
+        yield chunk
+    EXPORT_CACHE.set((share_id, fmt), b"".join(parts))
+
+class _ZipSink:
+    """Destino no-seekable para zipfile: junta lo escrito hasta que se drena."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_zip_export(sets, fmt):
+    """Zip streameado de varios sets: `sets` itera (nombre, setlist, título)."""
+    ext = EXPORT_FORMATS[fmt][0]
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, setlist, title in sets:
+            with zf.open(f"{name}.{ext}", mode="w") as entry:
+                for chunk in iter_export(setlist, fmt, title):
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
+
+# IDs de sets compartidos: aleatorios (no adivinables ni secuenciales) y sin
+# consultar antes si existen. Con 36^6 ≈ 2.200 millones de IDs, incluso con
+# 10M sets un choque tiene ~0,5% de probabilidad.
+SHARE_ID_ALPHABET = string.ascii_lowercase + string.digits
+SHARE_ID_LENGTH = 6
+SHARE_ID_MAX_ATTEMPTS = 5
+
+def new_share_id(length=SHARE_ID_LENGTH):
+    return ''.join(secrets.choice(SHARE_ID_ALPHABET) for _ in range(length))
+
+def create_shared_set(**fields):
+    """Inserta un SharedSet con ID nuevo (reintentando si choca) y devuelve el ID."""
+    for attempt in range(SHARE_ID_MAX_ATTEMPTS):
+        # Si choca dos veces seguidas, alargar el ID (la columna admite hasta 10)
+        share_id = new_share_id(SHARE_ID_LENGTH + attempt // 2)
+        db.session.add(SharedSet(id=share_id, **fields))
+        try:
+            db.session.commit()
+            return share_id
+        except IntegrityError:
+            db.session.rollback()
+    raise RuntimeError("No se pudo generar un ID único para el set compartido")
+
+@bp.route("/api/share_set", methods=["POST"])
+@login_required
+def share_set():
+    """Guarda un set y genera un link único para compartir."""
+    data = request.json or {}
+    setlist = data.get("setlist", [])
+    
+    if not setlist or len(setlist) == 0:
+        return jsonify({"error": "No hay setlist para compartir"}), 400
+    if not isinstance(setlist, list) or not all(isinstance(t, dict) for t in setlist):
+        return jsonify({"error": "Setlist inválido"}), 400
+    
+    # Un solo INSERT en el caso normal; si el ID ya existe, la PK lo rechaza y se reintenta.
+    # Los gráficos se calculan acá una vez y /set/<id> solo los lee.
+    share_id = create_shared_set(
+        user_id=current_user.id,
+        setlist_json=json.dumps(setlist),
+        analytics_json=json.dumps(SetAnalytics(setlist).as_dict()),
+        duration_minutes=parse_set_minutes(data)
+    )
+    
+    # Retornar el link
+    share_url = f"https://www.progressivejourney.net/set/{share_id}"
+    return jsonify({"share_url": share_url, "share_id": share_id}), 200
+
+
+@bp.route("/set/<share_id>")
+def view_shared_set(share_id):
+    """Página pública para ver un set compartido."""
+    # Incrementar views en la primaria, también cuando el navegador ya tiene
+    # la página (304); el set en sí no cambia y se lee de la réplica
+    result = db.session.execute(
+        db.update(SharedSet).where(SharedSet.id == share_id).values(views=SharedSet.views + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if result.rowcount == 0:
+        return render_template("404.html"), 404
+    
+    # Los sets no cambian: el ETag depende solo del ID y del template. Por eso
+    # la página no trae el contador de views (quedaría viejo en cada 304):
+    # lo pide aparte a /set/<id>/views, que no se cachea
+    etag = f"{share_id}-{template_digest('shared_set.html')}"
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response
+    
+    shared_set = read_replica_first(
+        db.select(SharedSet.setlist_json, SharedSet.analytics_json, SharedSet.duration_hours,
+                  SharedSet.duration_minutes, SharedSet.created_at)
+        .where(SharedSet.id == share_id)
+    )
+    
+    # Parsear el setlist (los sets compartidos antes de guardar los gráficos los calculan acá)
+    setlist = json.loads(shared_set.setlist_json)
+    if shared_set.analytics_json:
+        analytics = json.loads(shared_set.analytics_json)
+    else:
+        analytics = SetAnalytics(setlist).as_dict()
+    
+    response = make_response(render_template(
+        "shared_set.html",
+        setlist=setlist,
+        analytics=analytics,
+        duration=(shared_set.duration_minutes or (shared_set.duration_hours or 1) * 60) / 60,
+        created_at=shared_set.created_at,
+        share_id=share_id
+    ))
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+@bp.route("/set/<share_id>/views")
+def shared_set_views(share_id):
+    """Contador de views de un set compartido (fuera del HTML cacheado)."""
+    views = db.session.execute(db.select(SharedSet.views).where(SharedSet.id == share_id)).scalar()
+    if views is None:
+        return jsonify({"error": "Set no encontrado"}), 404
+    response = jsonify({"views": views})
+    response.cache_control.no_store = True
+    return response
+
+def shared_set_title(share_id):
+    return f"{EXPORT_PRODUCT} - {share_id}"
+
+@bp.route("/api/export/<fmt>", methods=["POST"])
+@login_required
+def export_setlist(fmt):
+    """Exporta el setlist enviado en el body (set recién generado, sin compartir)."""
+    fmt = resolve_export_format(fmt)
+    if not fmt:
+        return jsonify({"error": "Formato no soportado"}), 404
+    data = request.get_json(silent=True) or {}
+    setlist = data.get("setlist") or []
+    if not setlist:
+        return jsonify({"error": "No hay setlist para exportar"}), 400
+    error = setlist_error(setlist)
+    if error:
+        return jsonify({"error": error}), 400
+    title = str(data.get("title") or EXPORT_PRODUCT)
+    return export_response(iter_export(setlist, fmt, title), fmt, "setlist")
+
+@bp.route("/set/<share_id>/export/<fmt>")
+def export_shared_set(share_id, fmt):
+    """Exporta un set compartido; el resultado se cachea por (share_id, formato)."""
+    fmt = resolve_export_format(fmt)
+    if not fmt:
+        return jsonify({"error": "Formato no soportado"}), 404
+    cache_control = "public, max-age=3600"
+    cached = EXPORT_CACHE.get((share_id, fmt))
+    if cached is not None:
+        return export_response([cached], fmt, f"set-{share_id}", cache_control)
+    
+    row = read_replica_first(db.select(SharedSet.setlist_json).where(SharedSet.id == share_id))
+    if row is None:
+        return jsonify({"error": "Set no encontrado"}), 404
+    chunks = cached_shared_export(share_id, fmt, json.loads(row.setlist_json), shared_set_title(share_id))
+    return export_response(chunks, fmt, f"set-{share_id}", cache_control)
+
+@bp.route("/api/export/bulk/<fmt>", methods=["GET", "POST"])
+@login_required
+def export_bulk(fmt):
+    """Zip con los sets compartidos del usuario (todos, o los IDs pedidos), streameado."""
+    fmt = resolve_export_format(fmt)
+    if not fmt:
+        return jsonify({"error": "Formato no soportado"}), 404
+    data = request.get_json(silent=True) or {}
+    share_ids = data.get("share_ids") or [i for i in request.args.get("ids", "").split(",") if i]
+    if not isinstance(share_ids, list) or not all(isinstance(i, str) for i in share_ids):
+        return jsonify({"error": "share_ids tiene que ser una lista de IDs"}), 400
+    
+    query = db.select(SharedSet.id, SharedSet.setlist_json).where(SharedSet.user_id == current_user.id)
+    if share_ids:
+        query = query.where(SharedSet.id.in_(share_ids))
+    query = query.order_by(SharedSet.created_at).execution_options(yield_per=50)
+    
+    def sets():
+        for share_id, setlist_json in db.session.execute(query):
+            yield f"set-{share_id}", json.loads(setlist_json), shared_set_title(share_id)
+    
+    response = current_app.response_class(stream_with_context(iter_zip_export(sets(), fmt)),
+                                          mimetype="application/zip")
+    response.headers["Content-Disposition"] = f'attachment; filename="sets-{fmt}.zip"'
+    return response
+
+# ==============================
+# ENDPOINTS DE SPOTIFY CON OAUTH
+# ==============================
+
+@bp.route("/spotify/login")
+@login_required
+def spotify_login():
+    """Redirige al usuario a Spotify para autenticarse."""
+    auth_manager = get_spotify_oauth(current_user.id, show_dialog=True)
+    
+    auth_url = auth_manager.get_authorize_url()
+    return redirect(auth_url)
+
+
+@bp.route("/spotify/callback")
+@login_required
+def spotify_callback():
+    """Callback después de que el usuario autoriza en Spotify."""
+    auth_manager = get_spotify_oauth(current_user.id)
+    
+    code = request.args.get('code')
+    if code:
+        # check_cache=False: siempre canjear el code nuevo (se guarda vía el token store)
+        token_info = auth_manager.get_access_token(code, as_dict=False, check_cache=False)
+        if token_info:
+            print(f"✅ Usuario {current_user.id} autenticado en Spotify")
+            return redirect("/?spotify_connected=true")
+    
+    return redirect("/?spotify_error=true")
+
+
+@bp.route("/api/spotify/search", methods=["GET"])
+@login_required
+def spotify_search():
+    """Busca canciones en Spotify con OAuth (sin 403)."""
+    import spotipy
+    query = request.args.get("q", "")
+    if not query:
+        return jsonify({"tracks": []}), 200
+    
+    try:
+        # Obtener cliente autenticado del usuario
+        sp = get_spotify_client(current_user.id)
+        
+        # Verificar si el usuario está autenticado
+        token_info = sp.auth_manager.get_cached_token()
+        if not token_info:
+            return jsonify({
+                "error": "not_authenticated",
+                "message": "Necesitas conectar tu cuenta de Spotify primero"
+            }), 401
+        
+        # Buscar en Spotify
+        results = sp.search(q=query, type='track', limit=20)
+        items = results['tracks']['items']
+        tracks = []
+        
+        # Un solo request de audio_features para todos los IDs (los cacheados ni se piden)
+        features_by_id = get_audio_features(sp, [item['id'] for item in items])
+        
+        for item in items:
+            track_id = item['id']
+            
+            # Valores por defecto
+            bpm = 122
+            key_camelot = "8A"
+            energy = 5
+            
+            audio_features = features_by_id.get(track_id)
+            if audio_features:
+                # BPM real
+                bpm = round(audio_features['tempo'])
+                
+                # Key real (convertir a Camelot)
+                spotify_key = audio_features['key']
+                spotify_mode = audio_features['mode']
+                key_camelot = convert_spotify_key(spotify_key, spotify_mode)
+                
+                # Energy real
+                energy = round(audio_features['energy'] * 10)
+            
+            track_data = {
+                "spotify_id": track_id,
+                "artist": item['artists'][0]['name'],
+                "track": item['name'],
+                "album": item['album']['name'],
+                "image": item['album']['images'][0]['url'] if item['album']['images'] else None,
+                "preview_url": item['preview_url'],
+                "bpm": bpm,
+                "key": key_camelot,
+                "energy": energy,
+            }
+            tracks.append(track_data)
+        
+        return jsonify({"tracks": tracks}), 200
+    
+    except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 401:
+            return jsonify({
+                "error": "not_authenticated",
+                "message": "Tu sesión de Spotify expiró. Volvé a conectar."
+            }), 401
+        return jsonify({"error": str(e)}), 500
+    
+    except Exception as e:
+        print(f"❌ Error en Spotify search: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# audio_features por spotify_id, compartido entre usuarios del proceso
+AUDIO_FEATURES_CACHE = TTLCache(ttl=24 * 3600, maxsize=50000)
+AUDIO_FEATURES_BATCH = 100  # máximo de IDs que acepta el endpoint de Spotify
+
+def get_audio_features(sp, track_ids):
+    """audio_features de varios tracks: cache primero, el resto en lotes de 100."""
+    features_by_id = {}
+    missing = []
+    for track_id in track_ids:
+        cached = AUDIO_FEATURES_CACHE.get(track_id)
+        if cached is None:
+            missing.append(track_id)
+        elif cached:
+            features_by_id[track_id] = cached
+    
+    for start in range(0, len(missing), AUDIO_FEATURES_BATCH):
+        batch = missing[start:start + AUDIO_FEATURES_BATCH]
+        try:
+            batch_features = sp.audio_features(batch) or []
+        except Exception as audio_error:
+            print(f"⚠️ Error en audio_features: {audio_error}")
+            continue
+        for track_id, features in zip(batch, batch_features):
+            # False = Spotify no tiene features para ese track (no volver a pedirlo)
+            AUDIO_FEATURES_CACHE.set(track_id, features or False)
+            if features:
+                features_by_id[track_id] = features
+    
+    return features_by_id
+
+def convert_spotify_key(key_number, mode):
+    """Convierte key de Spotify (0-11) a Camelot."""
+    camelot_minor = {
+        0: "5A", 1: "12A", 2: "7A", 3: "2A", 4: "9A", 5: "4A",
+        6: "11A", 7: "6A", 8: "1A", 9: "8A", 10: "3A", 11: "10A"
+    }
+    
+    camelot_major = {
+        0: "8B", 1: "3B", 2: "10B", 3: "5B", 4: "12B", 5: "7B",
+        6: "2B", 7: "9B", 8: "4B", 9: "11B", 10: "6B", 11: "1B"
+    }
+    
+    if mode == 0:  # Minor
+        return camelot_minor.get(key_number, "8A")
+    else:  # Major
+        return camelot_major.get(key_number, "8B")
+
+# Nivel del gráfico de energía por fase (el mismo que dibuja el front)
+ENERGY_CHART_LEVELS = {
+    "warmup": 3,
+    "build": 5,
+    "mid_peak": 7,
+    "midpeaks": 7,
+    "peak_time": 9,
+    "peaktime": 9,
+    "driving": 10,
+    "closing": 6
+}
+
+# Todas las keys del Camelot Wheel, en el orden en que se dibujan
+WHEEL_KEYS = [
+    "12A", "1A", "2A", "3A", "4A", "5A", "6A", "7A", "8A", "9A", "10A", "11A",
+    "12B", "1B", "2B", "3B", "4B", "5B", "6B", "7B", "8B", "9B", "10B", "11B"
+]
+
+def energy_chart_level(track):
+    return ENERGY_CHART_LEVELS.get(str(track.get("stage", "warmup")).lower(), 5)
+
+class SetAnalytics:
+    """Datos del gráfico de energía y del Key Wheel de un set, en una pasada.
+
+    Misma forma que /api/get_energy_data y /api/get_key_wheel_data: se
+    devuelven junto con el set generado y se guardan con los sets compartidos.
+    """
+
+    def __init__(self, tracks=()):
+        self.energy = []
+        self.key_sequence = []
+        self.key_counts = {}
+        for track in tracks:
+            self.add(track)
+
+    def add(self, track):
+        key = track.get("key", "8A")
+        self.energy.append(energy_chart_level(track))
+        self.key_sequence.append(key)
+        self.key_counts[key] = self.key_counts.get(key, 0) + 1
+
+    def energy_data(self):
+        return {"labels": [f"#{i}" for i in range(1, len(self.energy) + 1)], "data": self.energy}
+
+    def key_wheel_data(self):
+        return {"key_counts": self.key_counts, "key_sequence": self.key_sequence, "all_keys": WHEEL_KEYS}
+
+    def as_dict(self):
+        return {"energy": self.energy_data(), "key_wheel": self.key_wheel_data()}
+
+def generated_set_response(setlist, catalog, data):
+    """Set generado con sus gráficos: {"tracks": [...], "analytics": {...}}.
+
+    Con "analytics": false en el body, la lista sola como antes.
+    """
+    if data.get("analytics", True) is False:
+        return tracks_response(setlist, catalog=catalog)
+    return tracks_response(setlist, catalog=catalog, analytics=SetAnalytics(setlist).as_dict())
+
+@bp.route("/api/get_energy_data", methods=["POST"])
+@login_required
+def get_energy_data():
+    """Retorna datos para el gráfico de energía."""
+    data = request.json or {}
+    setlist = data.get("setlist", [])
+    
+    if not setlist:
+        return jsonify({"error": "No setlist provided"}), 400
+    
+    return jsonify(SetAnalytics(setlist).energy_data()), 200
+
+
+@bp.route("/api/get_key_wheel_data", methods=["POST"])
+@login_required
+def get_key_wheel_data():
+    """Retorna datos para el Key Wheel."""
+    data = request.json or {}
+    setlist = data.get("setlist", [])
+    
+    if not setlist:
+        return jsonify({"error": "No setlist provided"}), 400
+    
+    return jsonify(SetAnalytics(setlist).key_wheel_data()), 200
+
+@bp.route("/api/submit_crypto_payment", methods=["POST"])
+@login_required
+def submit_crypto_payment():
+    """Usuario envía comprobante de pago USDT (multipart, el archivo va directo a disco)."""
+    plan = request.form.get("plan")  # 'monthly' o 'annual'
+    tx_id = request.form.get("tx_id", "")
+    screenshot = request.files.get("screenshot")
+    
+    if not plan or plan not in ['monthly', 'annual']:
+        return jsonify({"error": "Plan inválido"}), 400
+    
+    if not screenshot:
+        return jsonify({"error": "Falta la captura de pantalla"}), 400
+    
+    ext = detect_image_ext(screenshot.stream.read(16))
+    screenshot.stream.seek(0)
+    if not ext:
+        return jsonify({"error": "El comprobante tiene que ser una imagen (PNG, JPG, GIF o WEBP)"}), 400
+    
+    store = get_screenshot_store()
+    try:
+        screenshot_ref = store.save_stream(screenshot.stream, ext, current_app.config["SCREENSHOT_MAX_BYTES"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 413
+    downscale_screenshot(store, screenshot_ref)
+    
+    # Determinar monto
+    amount = 10.0 if plan == 'monthly' else 45.0
+    
+    # Crear solicitud de pago
+    payment_request = PaymentRequest(
+        user_id=current_user.id,
+        plan=plan,
+        amount_usdt=amount,
+        tx_id=tx_id,
+        screenshot_path=screenshot_ref,
+        status='pending'
+    )
+    
+    db.session.add(payment_request)
+    db.session.commit()
+    
+    current_app.logger.info(f"✅ Nueva solicitud de pago USDT: User {current_user.email}, Plan {plan}, Amount {amount} USDT")
+    
+    return jsonify({
+        "success": True,
+        "message": "Comprobante enviado correctamente. Será revisado en 24hs."
+    }), 200
+
+@bp.app_errorhandler(413)
+def request_too_large(error):
+    return jsonify({"error": "Archivo demasiado grande"}), 413
+
+@bp.app_errorhandler(SetDurationError)
+def invalid_set_duration(error):
+    return jsonify({"error": str(error)}), 400
+
+@bp.app_errorhandler(PoolTimeoutError)
+def database_busy(error):
+    """Pool de conexiones agotado (DB_POOL_TIMEOUT): 503 para que el cliente reintente."""
+    db.session.rollback()
+    current_app.logger.warning(f"⚠️ Pool de conexiones agotado: {error}")
+    response = jsonify({"error": "El servidor está ocupado, probá de nuevo en unos segundos."})
+    response.status_code = 503
+    response.headers["Retry-After"] = "2"
+    return response
+
+
+@bp.route("/admin")
+@login_required
+def admin_panel():
+    """Panel de administración para aprobar pagos."""
+    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
+    
+    if current_user.email != ADMIN_EMAIL:
+        current_app.logger.debug("Acceso al panel de admin denegado a %s", current_user.email)
+        return "❌ Acceso denegado", 403
+    
+    # Obtener solicitudes pendientes (usuario en el mismo query, sin el blob del comprobante)
+    pending_requests = PaymentRequest.query.options(db.joinedload(PaymentRequest.user)).filter_by(status='pending').order_by(PaymentRequest.created_at.desc()).all()
+    
+    # Obtener historial (últimas 50): una consulta por estado para que cada una
+    # recorra el índice (status, processed_at) y corte en 50 filas. Solo lectura:
+    # va a la réplica si hay una (unos segundos de lag no importan acá)
+    history = []
+    for status in ('approved', 'rejected'):
+        history += db.session.execute(
+            db.select(PaymentRequest).options(db.joinedload(PaymentRequest.user)).filter_by(status=status)
+            .order_by(PaymentRequest.processed_at.desc()).limit(50),
+            bind_arguments=replica_bind()
+        ).scalars().all()
+    history = sorted(history, key=lambda r: r.processed_at or datetime.min, reverse=True)[:50]
+    
+    return render_template('admin.html', pending=pending_requests, history=history)
+
+@bp.route("/admin/screenshot/<int:request_id>")
+@login_required
+def admin_screenshot(request_id):
+    """Sirve el comprobante de un pago (archivo, o base64 decodificado por partes)."""
+    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
+    
+    if current_user.email != ADMIN_EMAIL:
+        return "❌ Acceso denegado", 403
+    
+    screenshot_ref = db.session.query(PaymentRequest.screenshot_path).filter_by(id=request_id).scalar()
+    if screenshot_ref:
+        store = get_screenshot_store()
+        if request.args.get("thumb") and os.path.exists(store.path(thumbnail_ref(screenshot_ref))):
+            screenshot_ref = thumbnail_ref(screenshot_ref)
+        if not os.path.exists(store.path(screenshot_ref)):
+            return jsonify({"error": "Comprobante no encontrado"}), 404
+        return send_file(store.path(screenshot_ref), max_age=86400, conditional=True)
+    
+    screenshot = db.session.query(PaymentRequest.screenshot_data).filter_by(id=request_id).scalar()
+    if not screenshot:
+        return jsonify({"error": "Comprobante no encontrado"}), 404
+    
+    # data:image/png;base64,AAAA...
+    mimetype = "image/png"
+    if screenshot.startswith("data:"):
+        header, _, screenshot = screenshot.partition(",")
+        mimetype = header[5:].split(";")[0] or mimetype
+    
+    def generate_chunks(encoded, chunk_chars=64 * 1024):
+        # chunk_chars múltiplo de 4: cada parte decodifica sola
+        for start in range(0, len(encoded), chunk_chars):
+            yield base64.b64decode(encoded[start:start + chunk_chars])
+    
+    response = current_app.response_class(generate_chunks(screenshot), mimetype=mimetype)
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+@bp.route("/admin/approve/<int:request_id>", methods=["POST"])
+@login_required
+def approve_payment(request_id):
+    """Aprobar solicitud de pago."""
+    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
+    
+    if current_user.email != ADMIN_EMAIL:
+        return jsonify({"error": "No autorizado"}), 403
+    
+    payment_req = PaymentRequest.query.get(request_id)
+    if not payment_req:
+        return jsonify({"error": "Solicitud no encontrada"}), 404
+    
+    if payment_req.status != 'pending':
+        return jsonify({"error": "Esta solicitud ya fue procesada"}), 400
+    
+    # Activar usuario PRO
+    user = payment_req.user
+    user.role = 'owner'
+    
+    if payment_req.plan == 'monthly':
+        user.pro_until = datetime.utcnow() + timedelta(days=30)
+        user.plan = 'monthly'
+    else:
+        user.pro_until = datetime.utcnow() + timedelta(days=365)
+        user.plan = 'annual'
+    
+    # Marcar solicitud como aprobada
+    payment_req.status = 'approved'
+    payment_req.processed_at = datetime.utcnow()
+    
+    user_id = user.id
+    db.session.commit()
+    forget_user(user_id)
+    
+    current_app.logger.info(f"✅ Pago aprobado: User {user.email}, Plan {payment_req.plan}")
+    
+    return jsonify({"success": True, "message": f"Usuario {user.email} activado como PRO"}), 200
+
+
+@bp.route("/admin/reject/<int:request_id>", methods=["POST"])
+@login_required
+def reject_payment(request_id):
+    """Rechazar solicitud de pago."""
+    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
+    
+    if current_user.email != ADMIN_EMAIL:
+        return jsonify({"error": "No autorizado"}), 403
+    
+    payment_req = PaymentRequest.query.get(request_id)
+    if not payment_req:
+        return jsonify({"error": "Solicitud no encontrada"}), 404
+    
+    if payment_req.status != 'pending':
+        return jsonify({"error": "Esta solicitud ya fue procesada"}), 400
+    
+    payment_req.status = 'rejected'
+    payment_req.processed_at = datetime.utcnow()
+    
+    db.session.commit()
+    
+    current_app.logger.info(f"❌ Pago rechazado: User {payment_req.user.email}")
+    
+    return jsonify({"success": True, "message": "Solicitud rechazada"}), 200
+
+@bp.route("/admin/reload_catalog", methods=["POST"])
+@login_required
+def admin_reload_catalog():
+    """Recarga tracks.json en segundo plano sin reiniciar workers."""
+    ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "default@example.com")
+    
+    if current_user.email != ADMIN_EMAIL:
+        return jsonify({"error": "No autorizado"}), 403
+    
+    reload_catalog_async()
+    
+    return jsonify({
+        "success": True,
+        "message": "Recarga del catálogo iniciada",
+        "current_version": get_catalog().version
+    }), 202
+
+@bp.route("/make_me_owner_secret_route_12345")
+@login_required
+def make_me_owner():
+    """Ruta temporal para hacerte owner"""
+    if current_user.email == "elidj269@gmail.com":  # ← CAMBIÁ ESTO POR TU EMAIL REAL
+        user = db.session.get(User, current_user.id)
+        user.role = 'owner'
+        user.pro_until = datetime.utcnow() + timedelta(days=365)
+        user.plan = 'annual'
+        db.session.commit()
+        remember_user(user)
+        return "✅ Ahora sos OWNER!"
+    return "❌ No autorizado"
+
+# ==============================
+# APP FACTORY
+# ==============================
+def create_app(config=None):
+    """Construye la app: config, extensiones, rutas y comandos CLI.
+
+    No toca la base ni las APIs externas: el esquema se crea con
+    `flask --app app init-db` y los clientes externos en su primer uso.
+    """
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'fallback-key-change-in-production')
+    app.config['SQLALCHEMY_DATABASE_URI'] = get_database_url()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Réplica de lectura opcional (sets compartidos, exports, historial del admin)
+    replica_url = get_database_url('DATABASE_REPLICA_URL', None)
+    if replica_url:
+        app.config['SQLALCHEMY_BINDS'] = {"replica": {"url": replica_url, **get_engine_options(replica_url)}}
+    # Precargar el catálogo al construir la app (con `gunicorn --preload` queda
+    # en el master y los workers lo heredan copy-on-write)
+    app.config['PRELOAD_CATALOG'] = os.getenv('PRELOAD_CATALOG', '0') == '1'
+    # Comprobantes de pago: directorio local y tope de tamaño del upload
+    app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', os.path.join(basedir, 'instance', 'screenshots'))
+    app.config['SCREENSHOT_MAX_BYTES'] = int(os.getenv('SCREENSHOT_MAX_BYTES', str(8 * 1024 * 1024)))
+    app.config['MAX_CONTENT_LENGTH'] = app.config['SCREENSHOT_MAX_BYTES'] + 64 * 1024
+    # Listas de tracks armadas con fragmentos JSON precodificados por track: le
+    # gana al json de la stdlib, pero no a orjson (por eso el default depende)
+    app.config['JSON_TRACK_FRAGMENTS'] = os.getenv('JSON_TRACK_FRAGMENTS', '0' if orjson else '1') == '1'
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', get_engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(process_webhooks_command)
+    app.cli.add_command(ingest_catalog_command)
+
+    if app.config['PRELOAD_CATALOG']:
+        warmup()
+
+    BOOT_STATS["boot_ms"] = round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)
+    print(f"🚀 App lista en {BOOT_STATS['boot_ms']} ms (pid {os.getpid()})")
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    with app.app_context():
+        bootstrap_db()
+    warmup()
+
+    app.run(debug=True, port=5000)
@@ -0,0 +1,30 @@
+# Configuración de gunicorn: `gunicorn -c gunicorn.conf.py app:app`
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+
+# Con preload la app (y el catálogo, si PRELOAD_CATALOG=1) se carga una sola
+# vez en el master y los workers la heredan copy-on-write.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    # Congela los objetos ya cargados en el master: el GC de los workers no
+    # los recorre, así sus páginas de memoria siguen compartidas.
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    # Cada worker termina el warmup (catálogo + índices) antes de aceptar
+    # requests; si el master ya lo hizo con preload, no hace nada.
+    import app
+    # Conexiones que el master haya abierto antes del fork (preload) no se
+    # comparten: cada worker arma su propio pool (primaria y réplica)
+    with app.app.app_context():
+        for engine in app.db.engines.values():
+            engine.dispose(close=False)
+    app.warmup()
+    # Pool de webhooks: drena lo que haya quedado en el inbox (p. ej. tras un deploy)
+    app.webhook_pool.start(app.app)
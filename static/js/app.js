@@ -0,0 +1,756 @@
+// Variables globales
+let selectedEnergy = '';
+let currentPage = 1;
+let isLoading = false;
+let hasMore = true;
+let isGenerating = false;
+let currentSetlist = []; 
+let lockedTracks = []; 
+
+function toggleAuthForm(formType) {
+    document.getElementById('loginForm').style.display = (formType === 'login') ? 'block' : 'none';
+    document.getElementById('signupForm').style.display = (formType === 'signup') ? 'block' : 'none';
+}
+
+function showPaymentOptions() {
+    document.getElementById('paymentOptions').style.display = 'flex';
+    selectPlan('monthly');
+}
+
+function copyToClipboard(text) {
+    navigator.clipboard.writeText(text).then(() => alert("¡Dirección copiada!"));
+}
+
+function filterEnergy(energy) {
+    selectedEnergy = energy;
+    isGenerating = false;
+    resetAndSearch();
+}
+
+function resetAndSearch() {
+    currentPage = 1;
+    hasMore = true;
+    document.getElementById('results').innerHTML = ''; 
+    searchPreview(false, selectedEnergy); 
+}
+
+async function searchPreview(append = false, stage = selectedEnergy) {
+    if (isLoading || (!hasMore && append)) return;
+    isLoading = true;
+    
+    const query = document.getElementById('trackSearch').value;
+    const endpoint = `/api/search?q=${encodeURIComponent(query)}&page=${currentPage}&energy=${encodeURIComponent(stage)}`;
+
+    try {
+        const res = await fetch(endpoint);
+        const data = await res.json();
+        renderList(data.tracks, false, append);
+        hasMore = data.has_more;
+        isLoading = false;
+    } catch (e) {
+        console.error("Error:", e);
+        isLoading = false;
+    }
+}
+
+window.onscroll = function() {
+    if (isGenerating) return;
+    if ((window.innerHeight + window.scrollY) >= document.body.offsetHeight - 800) {
+        if (!isLoading && hasMore) {
+            currentPage++;
+            searchPreview(true); 
+        }
+    }
+};
+
+function selectTrackForStart(artist, track) {
+    document.getElementById('trackSearch').value = artist + " - " + track;
+    resetAndSearch();
+}
+
+// "Sin tracks de mis últimos N sets" (0 = se pueden repetir)
+function recentSetsToAvoid() {
+    const select = document.getElementById('freshnessSelect');
+    return select ? parseInt(select.value) : 0;
+}
+
+async function generateSet() {
+    isGenerating = true;
+    const startTrack = document.getElementById('trackSearch').value;
+    const hours = document.getElementById('hoursSelect').value;
+    const container = document.getElementById('results');
+    
+    container.innerHTML = '<p style="text-align:center; padding: 20px;">Generando set inteligente...</p>';
+
+    let endpoint = '/generate';
+    let bodyData = { start_track: startTrack, hours: hours, avoid_recent_sets: recentSetsToAvoid() };
+
+    const hasLockedTracks = currentSetlist.length > 0 && lockedTracks.some(locked => locked === true);
+
+    if (hasLockedTracks) {
+        endpoint = '/api/generate_locked';
+        bodyData.locked_setlist = currentSetlist.map((track, index) => {
+            const trackCopy = {...track}; 
+            if (lockedTracks[index]) trackCopy.isLocked = true;
+            return trackCopy;
+        });
+    }
+    
+    try {
+        if (!hasLockedTracks) {
+            await generateSetStreaming(bodyData);
+            isGenerating = false;
+            return;
+        }
+
+        const res = await fetch(endpoint, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(bodyData)
+        });
+
+        if (res.status === 403) {
+            const errorData = await res.json();
+            alert(errorData.error);
+            isGenerating = false;
+            return;
+        }
+
+        // {tracks, analytics}: los datos de los gráficos vienen con el set
+        const data = await res.json();
+        const tracks = Array.isArray(data) ? data : data.tracks;
+        
+        currentSetlist = tracks;
+        lockedTracks = new Array(tracks.length).fill(false);
+        
+        renderList(tracks, true, false);
+        document.getElementById('exportTools').style.display = 'flex';
+        renderVisualizations(data.analytics);
+    } catch (e) {
+        container.innerHTML = '<p style="text-align:center; padding: 20px;">Error al generar.</p>';
+    }
+    
+    isGenerating = false;
+}
+
+// El server manda cada track apenas lo elige (NDJSON): la lista y los gráficos se van armando
+async function generateSetStreaming(bodyData) {
+    const res = await fetch('/generate/stream', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json', 'Accept': 'application/x-ndjson'},
+        body: JSON.stringify(bodyData)
+    });
+    if (res.status === 403) {
+        const errorData = await res.json();
+        alert(errorData.error);
+        return;
+    }
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let newline;
+        while ((newline = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, newline);
+            buffer = buffer.slice(newline + 1);
+            if (line) handleGenerationEvent(JSON.parse(line));
+        }
+    }
+}
+
+function handleGenerationEvent(message) {
+    if (message.event === 'start') {
+        currentSetlist = [];
+        lockedTracks = [];
+        document.getElementById('exportTools').style.display = 'flex';
+        renderVisualizations();
+    } else if (message.event === 'track') {
+        currentSetlist.push(message.track);
+        lockedTracks.push(false);
+        energyChart.data.labels.push(`#${currentSetlist.length}`);
+        energyChart.data.datasets[0].data.push(message.energy);
+        scheduleSetRender();
+    }
+}
+
+// Un render por frame aunque lleguen varios tracks juntos
+let setRenderPending = false;
+function scheduleSetRender() {
+    if (setRenderPending) return;
+    setRenderPending = true;
+    requestAnimationFrame(() => {
+        setRenderPending = false;
+        renderList(currentSetlist, true, false);
+        renderKeyWheel();
+        energyChart.update('none');
+    });
+}
+
+function getEnergyStyle(energy) {
+    if (!energy) return 'color: #fff; border-color: #fff;';
+    const e = energy.toLowerCase();
+    if (e.includes('warm')) return 'color: var(--warm); border-color: var(--warm)';
+    if (e.includes('build')) return 'color: var(--build); border-color: var(--build)';
+    if (e.includes('mid')) return 'color: var(--mid); border-color: var(--mid)';
+    if (e.includes('peak')) return 'color: var(--peak); border-color: var(--peak)';
+    if (e.includes('driv')) return 'color: var(--driving); border-color: var(--driving)';
+    if (e.includes('clos')) return 'color: var(--closing); border-color: var(--closing)';
+    return 'color: #fff; border-color: #fff;';
+}
+
+function renderList(tracks, isFullSet = false, append = false) {
+    const container = document.getElementById('results');
+    const header = document.getElementById('trackHeader');
+    
+    if (!append) container.innerHTML = '';
+    
+    if (!tracks || tracks.length === 0) {
+        if (!append) container.innerHTML = '<p style="text-align:center; padding: 20px;">No hay resultados.</p>';
+        return;
+    }
+
+    if (isFullSet) {
+    header.classList.add('has-actions');
+    header.innerHTML = '<div>#</div><div></div><div>Track</div><div>BPM</div><div>Key</div><div>Energy</div><div>Acción</div>';
+} else {
+    header.classList.remove('has-actions');
+    header.innerHTML = '<div>#</div><div>Track</div><div>BPM</div><div>Key</div><div>Energy</div>';
+}
+
+    const html = tracks.map((t, i) => {
+        const indexShow = isFullSet ? (i + 1) : "";
+        const stageLabel = t.stage || t.energy || "Track";
+        const lockIcon = lockedTracks[i] ? '🔒' : '🔓';
+        const lockHtml = isFullSet ? `<div class="col-lock ${lockedTracks[i]?'locked':''}" onclick="lockTrack(${i})">${lockIcon}</div>` : '';
+        const actionButtonHtml = isFullSet ? `<div class="col-actions"><button onclick="changeTrack(${i})">Cambiar</button><button onclick="changeTrack(${i}, true)" title="Cambiar por uno parecido">Similar</button></div>` : '';
+        const previewButtonHtml = '';
+        const clickAttr = !isFullSet ? `onclick="selectTrackForStart('${(t.artist||'').replace(/'/g,"\\'")}', '${(t.track||'').replace(/'/g,"\\'")}')"` : '';
+
+        return `
+            <div class="track-item ${!isFullSet ? 'selectable' : ''} ${isFullSet ? 'has-actions' : ''}" ${clickAttr} id="trackItem${i}">
+                <div class="col-num">${indexShow}</div>
+                ${lockHtml}
+                <div class="col-track">${t.artist} - ${t.track}</div>
+                <div class="col-bpm">${t.bpm}</div>
+                <div class="col-key">${t.key}</div>
+                <div><span class="energy-badge" style="${getEnergyStyle(stageLabel)}">${stageLabel}</span></div>
+                ${actionButtonHtml}
+                ${previewButtonHtml}
+            </div>
+        `;
+    }).join('');
+
+    if (append) {
+        container.insertAdjacentHTML('beforeend', html);
+    } else {
+        container.innerHTML = html;
+    }
+}
+
+function downloadFile(content, fileName, mimeType) {
+    const blob = new Blob([content], { type: mimeType });
+    const url = URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = url; a.download = fileName; a.click();
+}
+
+// Los archivos se generan en el server (escapado correcto y todos los campos)
+async function exportSet(format) {
+    if (!currentSetlist || currentSetlist.length === 0) return;
+    try {
+        const res = await fetch(`/api/export/${format}`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ setlist: currentSetlist })
+        });
+        if (!res.ok) {
+            alert('❌ No se pudo exportar el set.');
+            return;
+        }
+        const blob = await res.blob();
+        const match = (res.headers.get('Content-Disposition') || '').match(/filename="([^"]+)"/);
+        downloadFile(blob, match ? match[1] : `setlist.${format}`, blob.type);
+    } catch (e) { console.error(e); }
+}
+
+function lockTrack(index) {
+    if (index === 0) return;
+    lockedTracks[index] = !lockedTracks[index];
+    renderList(currentSetlist, true, false);
+}
+
+async function changeTrack(index, similar = false) {
+    if (index === 0 || lockedTracks[index]) return;
+    try {
+        const res = await fetch(`/api/change_track/${index}`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ current_setlist: currentSetlist, similar: similar, avoid_recent_sets: recentSetsToAvoid() })
+        });
+        if (res.ok) {
+            const newTrack = await res.json();
+            currentSetlist[index] = newTrack;
+            renderList(currentSetlist, true, false); 
+        }
+    } catch (e) { console.error(e); }
+}
+
+let selectedPlan = 'monthly';
+
+function selectPlan(plan) {
+    selectedPlan = plan;
+    document.getElementById('btnMonthly').classList.toggle('active', plan === 'monthly');
+    document.getElementById('btnAnnual').classList.toggle('active', plan === 'annual');
+}
+
+function closePaymentModal() {
+    document.getElementById('paymentOptions').style.display = 'none';
+}
+
+function closeCryptoModal() {
+    document.getElementById('cryptoPaymentModal').style.display = 'none';
+}
+
+function showCryptoPayment() {
+    const amount = selectedPlan === 'monthly' ? '10 USDT' : '45 USDT';
+    const planName = selectedPlan === 'monthly' ? 'Mensual' : 'Anual';
+    
+    document.getElementById('cryptoAmount').textContent = amount;
+    document.getElementById('cryptoPlan').textContent = planName;
+    
+    document.getElementById('paymentOptions').style.display = 'none';
+    document.getElementById('cryptoPaymentModal').style.display = 'flex';
+}
+
+async function submitCryptoPayment(event) {
+    event.preventDefault();
+    
+    const fileInput = document.getElementById('paymentScreenshot');
+    const txId = document.getElementById('txId').value;
+    
+    if (!fileInput.files[0]) {
+        alert('Por favor seleccioná una captura de pantalla.');
+        return;
+    }
+    
+    // Multipart: el archivo viaja tal cual (sin base64) y el server lo guarda en disco
+    const formData = new FormData();
+    formData.append('plan', selectedPlan);
+    formData.append('tx_id', txId);
+    formData.append('screenshot', fileInput.files[0]);
+    
+    try {
+        const res = await fetch('/api/submit_crypto_payment', {
+            method: 'POST',
+            body: formData
+        });
+        
+        const data = await res.json();
+        
+        if (res.ok) {
+            alert('✅ Comprobante enviado correctamente. Tu cuenta será activada en 24hs hábiles.');
+            closeCryptoModal();
+            document.getElementById('cryptoPaymentForm').reset();
+        } else {
+            alert('❌ Error: ' + data.error);
+        }
+    } catch (error) {
+        console.error('Error:', error);
+        alert('❌ Hubo un error al enviar el comprobante. Intenta de nuevo.');
+    }
+}
+
+async function handleMercadoPago() {
+    try {
+        const res = await fetch('/create-payment', {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ type: selectedPlan })
+        });
+        if (!res.ok) return;
+        const data = await res.json();
+        const mp = new MercadoPago('APP_USR-7eac6494-286c-4d75-8b99-117df00b0220', { locale: 'es-AR' });
+        document.querySelectorAll('.btn-mercadopago').forEach(btn => btn.style.display = 'none');
+        mp.checkout({ preference: { id: data.preference_id }, render: { container: '#payment-widget-container', label: 'Pagar' } });
+    } catch (e) { console.error(e); }
+}
+
+let currentShareUrl = '';
+
+async function shareSet() {
+    if (!currentSetlist || currentSetlist.length === 0) {
+        alert('Primero debes generar un set para compartirlo.');
+        return;
+    }
+    
+    // Primero obtenemos referencias a los elementos
+    const modal = document.getElementById('shareModal');
+    const linkDisplay = document.getElementById('shareLinkDisplay');
+    
+    // Verificamos que existan
+    if (!modal || !linkDisplay) {
+        console.error('Modal de compartir no encontrado en el DOM');
+        alert('Error: No se pudo abrir el modal de compartir.');
+        return;
+    }
+    
+    const hours = document.getElementById('hoursSelect').value;
+    
+    // Ahora sí mostramos el modal
+    modal.style.display = 'flex';
+    linkDisplay.textContent = 'Generando link único...';
+    
+    try {
+        const res = await fetch('/api/share_set', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ setlist: currentSetlist, hours: parseFloat(hours) })
+        });
+        
+        if (!res.ok) throw new Error('Error al generar link');
+        
+        const data = await res.json();
+        currentShareUrl = data.share_url;
+        linkDisplay.textContent = currentShareUrl;
+    } catch (e) {
+        console.error('Error:', e);
+        alert('Hubo un error al generar el link. Intenta de nuevo.');
+        closeShareModal();
+    }
+}
+
+function closeShareModal() {
+    document.getElementById('shareModal').style.display = 'none';
+}
+
+function shareToFacebook() {
+    const url = encodeURIComponent(currentShareUrl);
+    const text = encodeURIComponent('🎧 Check out this Progressive House set I generated with AI!');
+    window.open(`https://www.facebook.com/sharer/sharer.php?u=${url}&quote=${text}`, '_blank');
+}
+
+function shareToTwitter() {
+    const url = encodeURIComponent(currentShareUrl);
+    const text = encodeURIComponent('🎧 Just generated an epic Progressive House set with AI! Check it out:');
+    window.open(`https://twitter.com/intent/tweet?text=${text}&url=${url}`, '_blank');
+}
+
+function shareToInstagram() {
+    copyShareLink();
+    alert('📷 Link copiado! Ahora puedes pegarlo en tu Instagram Story o Bio.');
+}
+
+function shareToWhatsApp() {
+    const url = encodeURIComponent(currentShareUrl);
+    const text = encodeURIComponent('🎧 Mira este set de Progressive House que generé con AI: ');
+    window.open(`https://wa.me/?text=${text}${url}`, '_blank');
+}
+
+function copyShareLink() {
+    navigator.clipboard.writeText(currentShareUrl).then(() => {
+        const display = document.getElementById('shareLinkDisplay');
+        const originalText = display.textContent;
+        display.textContent = '✅ Link copiado al portapapeles!';
+        display.style.background = 'rgba(0, 255, 140, 0.2)';
+        setTimeout(() => {
+            display.textContent = originalText;
+            display.style.background = '#000';
+        }, 2000);
+    });
+}
+
+function toggleSpotifySearch() {
+    const container = document.getElementById('spotifySearchContainer');
+    const btn = document.querySelector('.btn-toggle-spotify');
+    if (container.style.display === 'none') {
+        container.style.display = 'block';
+        btn.classList.add('active');
+    } else {
+        container.style.display = 'none';
+        btn.classList.remove('active');
+    }
+}
+
+function handleSpotifySearchKeyup(event) {
+    if (event.key === 'Enter') searchSpotify();
+}
+
+async function searchSpotify() {
+    const query = document.getElementById('spotifySearchInput').value.trim();
+    const resultsContainer = document.getElementById('spotifyResults');
+    
+    if (!query) {
+        resultsContainer.innerHTML = '';
+        return;
+    }
+    
+    resultsContainer.innerHTML = '<p class="spotify-no-results">Buscando en Spotify...</p>';
+    
+    try {
+        const res = await fetch(`/api/spotify/search?q=${encodeURIComponent(query)}`);
+        const data = await res.json();
+        
+        if (res.status === 401) {
+            resultsContainer.innerHTML = `<p class="spotify-no-results">⚠️ ${data.message}<br><a href="/spotify/login" style="color: #1DB954;">Click acá para conectar tu cuenta</a></p>`;
+            return;
+        }
+        
+        if (!data.tracks || data.tracks.length === 0) {
+            resultsContainer.innerHTML = '<p class="spotify-no-results">No se encontraron resultados.</p>';
+            return;
+        }
+        
+        renderSpotifyResults(data.tracks);
+    } catch (error) {
+        console.error('Error searching Spotify:', error);
+        resultsContainer.innerHTML = '<p class="spotify-no-results">Error al buscar. Intenta de nuevo.</p>';
+    }
+}
+
+function renderSpotifyResults(tracks) {
+    const resultsContainer = document.getElementById('spotifyResults');
+    const html = tracks.map((track, idx) => {
+        const trackDataStr = JSON.stringify(track).replace(/'/g, "\\'").replace(/"/g, '&quot;');
+        const previewUrl = track.preview_url || '';
+        return `
+        <div class="spotify-track-item">
+            <img src="${track.image || '/static/default-album.png'}" alt="${track.track}" class="spotify-album-art">
+            <div class="spotify-track-info">
+                <div class="spotify-track-name">${track.track}</div>
+                <div class="spotify-artist-name">${track.artist}</div>
+                <div class="spotify-track-meta">
+                    ${track.bpm ? `<span>🎵 ${track.bpm} BPM</span>` : ''}
+                    ${track.key ? `<span>🎹 ${track.key}</span>` : ''}
+                    ${track.energy ? `<span>⚡ Energy: ${track.energy}/10</span>` : ''}
+                </div>
+            </div>
+            <div>
+                <button class="spotify-preview-btn" data-preview="${previewUrl}" data-spotify-id="${track.spotify_id}" onclick="playSpotifySearchPreview(this)" id="search-preview-${idx}">▶️ Play</button>
+            </div>
+            <div>
+                <button class="btn-add-spotify-track" data-track='${trackDataStr}' onclick="addSpotifyTrackToSetFixed(this)">➕ Agregar</button>
+                <button class="btn-add-spotify-track btn-save-library" data-track='${trackDataStr}' onclick="saveSpotifyTrackToLibrary(this)">💾 Mi librería</button>
+            </div>
+        </div>`;
+    }).join('');
+    resultsContainer.innerHTML = html;
+}
+
+let currentSearchAudio = null;
+
+function playSpotifySearchPreview(button) {
+    const spotifyId = button.getAttribute('data-spotify-id');
+    const previewUrl = button.getAttribute('data-preview');
+    
+    // Si clickeamos el mismo botón que ya está abierto, cerrar el player
+    const existingPlayer = button.closest('.spotify-track-item').querySelector('.spotify-inline-player');
+    if (existingPlayer) {
+        existingPlayer.remove();
+        button.textContent = '▶️ Play';
+        button.classList.remove('playing');
+        return;
+    }
+    
+    // Cerrar cualquier otro player abierto
+    document.querySelectorAll('.spotify-inline-player').forEach(player => player.remove());
+    document.querySelectorAll('.spotify-preview-btn').forEach(btn => {
+        btn.textContent = '▶️ Play';
+        btn.classList.remove('playing');
+    });
+    
+    // Crear el reproductor embebido de Spotify
+    const playerContainer = document.createElement('div');
+    playerContainer.className = 'spotify-inline-player';
+    playerContainer.innerHTML = `
+        <iframe 
+            style="border-radius:12px; margin-top: 10px;" 
+            src="https://open.spotify.com/embed/track/${spotifyId}?utm_source=generator&theme=0" 
+            width="100%" 
+            height="152" 
+            frameBorder="0" 
+            allowfullscreen="" 
+            allow="autoplay; clipboard-write; encrypted-media; fullscreen; picture-in-picture" 
+            loading="lazy">
+        </iframe>
+    `;
+    
+    // Insertar el reproductor debajo del track
+    const trackItem = button.closest('.spotify-track-item');
+    trackItem.appendChild(playerContainer);
+    
+    // Cambiar el botón a "Cerrar"
+    button.textContent = '✖️ Cerrar';
+    button.classList.add('playing');
+}
+
+function addSpotifyTrackToSetFixed(button) {
+    const trackDataStr = button.getAttribute('data-track');
+    const track = JSON.parse(trackDataStr.replace(/&quot;/g, '"'));
+    let stage = 'warmup';
+    if (track.bpm && track.energy) {
+        if (track.bpm < 120 && track.energy < 5) stage = 'warmup';
+        else if (track.bpm >= 120 && track.bpm < 123 && track.energy >= 4 && track.energy < 7) stage = 'build';
+        else if (track.bpm >= 121 && track.bpm < 124 && track.energy >= 6 && track.energy < 9) stage = 'mid_peak';
+        else if (track.bpm >= 123 && track.bpm < 125 && track.energy >= 7) stage = 'peak_time';
+        else if (track.bpm >= 124 && track.energy >= 8) stage = 'driving';
+        else if (track.bpm >= 120 && track.bpm < 125 && track.energy >= 4 && track.energy < 8) stage = 'closing';
+    }
+    const newTrack = {
+        artist: track.artist, track: track.track, bpm: track.bpm || 120,
+        key: track.key || '8A', energy: track.energy || 5, stage: stage, spotify_id: track.spotify_id
+    };
+    currentSetlist.push(newTrack);
+    lockedTracks.push(false);
+    renderList(currentSetlist, true, false);
+    document.getElementById('exportTools').style.display = 'flex';
+    alert(`✅ "${track.track}" agregado al set!`);
+}
+
+// Guarda el track en la librería personal: la generación lo puede elegir desde ahí
+async function saveSpotifyTrackToLibrary(button) {
+    const track = JSON.parse(button.getAttribute('data-track').replace(/&quot;/g, '"'));
+    button.disabled = true;
+    try {
+        const res = await fetch('/api/library', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(track)
+        });
+        const data = await res.json();
+        if (!res.ok) {
+            alert(data.error || (data.errors && data.errors.length ? data.errors[0].error : 'No se pudo guardar.'));
+            button.disabled = false;
+            return;
+        }
+        button.textContent = data.added ? '✅ Guardado' : '✅ Ya estaba';
+    } catch (error) {
+        console.error('Error saving to library:', error);
+        button.disabled = false;
+    }
+}
+
+async function playPreview(index) {
+    const track = currentSetlist[index];
+    document.getElementById('previewModal').style.display = 'flex';
+    document.getElementById('previewTrackTitle').textContent = track.track;
+    document.getElementById('previewTrackArtist').textContent = track.artist;
+    document.getElementById('previewPlayerContainer').innerHTML = '<p style="color: #5d7a8c;">Buscando preview...</p>';
+    if (track.spotify_id) {
+        showSpotifyEmbed(track.spotify_id);
+        return;
+
+    }
+    try {
+        // El server responde 202 mientras busca en segundo plano: reintentar
+        let res;
+        for (let attempt = 0; attempt < 15; attempt++) {
+            res = await fetch('/api/get_preview', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ artist: track.artist, track: track.track })
+            });
+            if (res.status !== 202) break;
+            const pending = await res.json();
+            await new Promise(resolve => setTimeout(resolve, (pending.retry_after || 1) * 1000));
+        }
+        if (!res.ok || res.status === 202) {
+            document.getElementById('previewPlayerContainer').innerHTML = '<p style="color: #ff0040;">❌ No se encontró preview para este track</p>';
+            return;
+        }
+        const data = await res.json();
+       if (data.type === 'spotify') {
+    currentSetlist[index].spotify_id = data.id;
+    showSpotifyEmbed(data.id);
+} else {
+    document.getElementById('previewPlayerContainer').innerHTML = '<p style="color: #ff0040;">❌ Solo se pueden reproducir previews de Spotify</p>';
+}
+    } catch (error) {
+        console.error('Error fetching preview:', error);
+        document.getElementById('previewPlayerContainer').innerHTML = '<p style="color: #ff0040;">❌ Error al buscar preview</p>';
+    }
+}
+
+function closePreviewModal() {
+    document.getElementById('previewModal').style.display = 'none';
+    document.getElementById('previewPlayerContainer').innerHTML = '';
+}
+
+let energyChart = null;
+
+// Sin analytics del server (streaming, cambios locales) se calculan desde currentSetlist
+function renderVisualizations(analytics) {
+    document.getElementById('visualizations').style.display = 'grid';
+    renderEnergyChart(analytics && analytics.energy);
+    renderKeyWheel(analytics && analytics.key_wheel);
+}
+
+function renderEnergyChart(energy) {
+    const energyMap = { warmup: 3, build: 5, mid_peak: 7, midpeaks: 7, peak_time: 9, peaktime: 9, driving: 10, closing: 6 };
+    const labels = energy ? energy.labels : currentSetlist.map((_, i) => `#${i + 1}`);
+    const data = energy ? energy.data : currentSetlist.map(t => energyMap[(t.stage || '').toLowerCase()] || 5);
+    const ctx = document.getElementById('energyChart').getContext('2d');
+    if (energyChart) energyChart.destroy();
+    energyChart = new Chart(ctx, {
+        type: 'line',
+        data: {
+            labels: labels,
+            datasets: [{
+                label: 'Energy Level', data: data, borderColor: '#00ff8c', backgroundColor: 'rgba(0, 255, 136, 0.1)',
+                borderWidth: 3, fill: true, tension: 0.4, pointRadius: 5, pointHoverRadius: 7,
+                pointBackgroundColor: '#00ff8c', pointBorderColor: '#fff', pointBorderWidth: 2
+            }]
+        },
+        options: {
+            responsive: true, maintainAspectRatio: false,
+            plugins: {
+                legend: { display: false },
+                tooltip: { backgroundColor: 'rgba(0, 26, 38, 0.95)', titleColor: '#00ff8c', bodyColor: '#fff', borderColor: '#00f2ff', borderWidth: 2, padding: 12, displayColors: false }
+            },
+            scales: {
+                y: { beginAtZero: true, max: 10, ticks: { color: '#00d4ff', font: { size: 12, weight: 'bold' }}, grid: { color: 'rgba(0, 242, 255, 0.1)' }},
+                x: { ticks: { color: '#00ff8c', font: { size: 11 }}, grid: { color: 'rgba(0, 255, 140, 0.1)' }}
+            }
+        }
+    });
+}
+
+function renderKeyWheel(keyWheel) {
+    const wheel = document.getElementById('keyWheel');
+    wheel.innerHTML = '';
+    const keysA = ["12A", "1A", "2A", "3A", "4A", "5A", "6A", "7A", "8A", "9A", "10A", "11A"];
+    const keysB = ["12B", "1B", "2B", "3B", "4B", "5B", "6B", "7B", "8B", "9B", "10B", "11B"];
+    const allKeys = [...keysA, ...keysB];
+    let keyCounts = {};
+    if (keyWheel) {
+        keyCounts = keyWheel.key_counts;
+    } else {
+        currentSetlist.forEach(t => keyCounts[t.key] = (keyCounts[t.key] || 0) + 1);
+    }
+    const centerX = 150, centerY = 150;
+    allKeys.forEach((key, index) => {
+        const isB = key.endsWith('B');
+        const radius = isB ? 120 : 85; // Keys B más afuera
+        const keyNumber = parseInt(key.match(/\d+/)[0]);
+        const adjustedIndex = keyNumber - 1; // Usar el número de la key como índice
+        const angle = (adjustedIndex / 12) * 2 * Math.PI - Math.PI / 2;
+        const x = centerX + radius * Math.cos(angle);
+        const y = centerY + radius * Math.sin(angle);
+        const btn = document.createElement('div');
+        btn.className = 'key-button';
+        btn.textContent = key;
+        btn.style.left = `${x - 17.5}px`;
+        btn.style.top = `${y - 17.5}px`;
+        if (keyCounts[key]) {
+            btn.classList.add('active');
+            if (keyCounts[key] > 2) btn.classList.add('used-multiple');
+            btn.title = `Usado ${keyCounts[key]} ${keyCounts[key] === 1 ? 'vez' : 'veces'}`;
+        }
+        wheel.appendChild(btn);
+    });
+}
@@ -0,0 +1,70 @@
+"""Frescura: con "avoid_recent_sets": N no vuelven tracks de los últimos N sets.
+
+Correr desde la raíz del repo: `python -m pytest -q`.
+"""
+import json
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as app_module
+from app import RecentSet, User, create_app, db
+
+STAGES = ["warmup", "build", "mid_peak", "peak_time", "driving", "closing"]
+KEYS = [f"{n}{m}" for n in range(1, 13) for m in "AB"]
+
+
+def write_catalog(path, size=3000):
+    """Catálogo sintético amplio: alcanza para armar sets sin repetir."""
+    rng = random.Random(1)
+    tracks = [
+        {"artist": f"Artist {i % 400}", "track": f"Track {i}", "bpm": rng.randint(114, 127),
+         "key": rng.choice(KEYS), "energy": rng.randint(1, 10), "stage": rng.choice(STAGES)}
+        for i in range(size)
+    ]
+    path.mkdir()
+    (path / "tracks.json").write_text(json.dumps(tracks), encoding="utf-8")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # CATALOG_PATH es relativo ("data/tracks.json"): el catálogo de prueba va en el cwd
+    write_catalog(tmp_path / "data")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app_module, "_catalog", None)
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+    })
+    with app.app_context():
+        db.create_all()
+        user = User(email="dj@example.com", role="owner", plan="lifetime",
+                    pro_until=datetime.utcnow() + timedelta(days=30))
+        user.set_password("secret")
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post("/login", data={"email": "dj@example.com", "password": "secret"})
+    yield client
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+def generate(client, **body):
+    response = client.post("/generate", json={"hours": 1, "analytics": False, **body})
+    assert response.status_code == 200
+    return [t["track"] for t in response.get_json()]
+
+
+def test_avoid_recent_sets_excludes_last_n_sets(client):
+    random.seed(7)
+    recent = [generate(client) for _ in range(2)]
+
+    fresh = generate(client, avoid_recent_sets=2)
+
+    assert fresh
+    assert not set(fresh) & set(recent[0] + recent[1])
+    with client.application.app_context():
+        assert db.session.query(RecentSet).count() == 3
@@ -0,0 +1,54 @@
+"""Ingesta de arrays JSON grandes: filas rotas se descartan sin perder las buenas.
+
+Correr desde la raíz del repo: `python -m pytest -q`.
+"""
+import io
+import json
+
+from app import IngestError, ingest_catalog, iter_json_array
+
+GOOD_ROWS = 20000
+BAD_ROW = '{"artist": "Roto", "track": oops, "artists": [{"name": "x"}, {"name": "y"}]}'
+
+
+def track_row(i):
+    # Arrays de objetos anidados y strings con "}, {" adentro: parecen fin de fila
+    return json.dumps({
+        "artist": f"Artist {i}", "track": f"Track {i}", "bpm": 124, "key": "8A", "energy": 5,
+        "artists": [{"name": f"Artist {i}"}, {"name": "feat. }, {"}],
+        "comments": 'raro: "}, {" \\ fin',
+    })
+
+
+def json_array(rows):
+    return '{"tracks": [\n' + ",\n".join(rows) + "\n]}\n"
+
+
+def test_iter_json_array_skips_only_the_broken_row():
+    rows = [track_row(i) for i in range(200)]
+    rows.insert(100, BAD_ROW)
+
+    # Chunks chicos: casi todas las filas quedan cortadas entre dos lecturas
+    items = list(iter_json_array(io.StringIO(json_array(rows)), chunk_size=64))
+
+    errors = [item for item in items if isinstance(item, IngestError)]
+    tracks = [item for item in items if not isinstance(item, IngestError)]
+    assert len(errors) == 1
+    assert [t["track"] for t in tracks] == [f"Track {i}" for i in range(200)]
+    assert items.index(errors[0]) == 100
+
+
+def test_ingest_catalog_keeps_every_good_row(tmp_path):
+    rows = [track_row(i) for i in range(GOOD_ROWS)]
+    rows.insert(GOOD_ROWS // 2, BAD_ROW)
+    source = tmp_path / "library.json"
+    source.write_text(json_array(rows), encoding="utf-8")
+    output = tmp_path / "tracks.json"
+    report = io.StringIO()
+
+    stats = ingest_catalog([(str(source), "json")], output=str(output), report=report)
+
+    assert stats == {"read": GOOD_ROWS + 1, "written": GOOD_ROWS, "duplicates": 0, "rejected": 1}
+    assert len(json.loads(output.read_text(encoding="utf-8"))) == GOOD_ROWS
+    rejected = [json.loads(line) for line in report.getvalue().splitlines()]
+    assert [(r["row"], r["error"].startswith("JSON inválido")) for r in rejected] == [(GOOD_ROWS // 2 + 1, True)]